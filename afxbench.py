@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+## coding=UTF-8
+#
+# AFX_bot: a simple Telegram bot in Python
+# Copyright (C) 2016 Anfauglir Kz. <anfauglirkz@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline throughput/latency benchmark of the AFXBot update loop.
+
+AFXBot runs against FakeBot, a local stand-in for telegram.Bot, and a
+generated resp_db. get_mesg() is driven with a configurable traffic mix;
+per-handler p50/p99 latency and total updates/s are reported. A handler's
+latency runs until it returned and every send it queued was sent, so
+--send-latency and pacing show up in it.
+
+    python3 afxbench.py --updates 20000 --keywords 5000
+
+With --replay, updates captured by AFXBot (config record_dir) are fed instead,
+at their original pace times --speed, or as fast as possible with --speed 0.
+--config runs them against a copy of a real config, strings and resp_db.
+
+    python3 afxbench.py --replay captures/*.afxrec --speed 2 --config config.json
+"""
+
+__author__ = 'Anfauglir'
+
+import logging
+import telegram
+import random
+import json
+import sqlite3
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+import afxbot
+
+
+class FakeMessage:
+    """
+    This object describes what FakeBot returns for a sent message.
+
+    Attributes:
+        message_id (int):
+        chat_id (int):
+        text (str):
+        photo (list):
+            One object with file_id when a photo was sent.
+    """
+
+    class Photo:
+        def __init__(self,
+                     file_id):
+            self.file_id = file_id
+
+    def __init__(self,
+                 message_id,
+                 chat_id,
+                 text = None,
+                 photo = None):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.text = text
+        self.photo = [self.Photo(photo)] if photo else []
+
+
+class FakeBot:
+    """
+    This object describes a local stand-in for telegram.Bot.
+
+    Sends are recorded instead of leaving the host; getUpdates hands out
+    queued synthetic updates.
+
+    Attributes:
+        sent (list):
+            (method, chat_id, payload) of every send call.
+        updates (list):
+            Pending telegram.Update objects for getUpdates.
+        latency (float):
+            Seconds every send call sleeps, to mimic a network round trip.
+    """
+
+    def __init__(self,
+                 latency = 0):
+        self.sent = []
+        self.updates = []
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.next_message_id = 1
+
+    def record(self,
+               method,
+               chat_id,
+               text = None,
+               photo = None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            mid = self.next_message_id
+            self.next_message_id += 1
+            self.sent.append((method, chat_id, text if text is not None else photo))
+
+        return FakeMessage(mid, chat_id, text, photo)
+
+    def getUpdates(self,
+                   offset = None,
+                   limit = 100,
+                   timeout = 0,
+                   **kwargs):
+        with self.lock:
+            if offset is not None:
+                self.updates = [u for u in self.updates if u.update_id >= offset]
+            return self.updates[:limit]
+
+    def sendMessage(self,
+                    chat_id,
+                    text,
+                    reply_to_message_id = None,
+                    **kwargs):
+        return self.record('sendMessage', chat_id, text = text)
+
+    def sendPhoto(self,
+                  chat_id,
+                  photo,
+                  reply_to_message_id = None,
+                  **kwargs):
+        if hasattr(photo, 'read'):
+            photo = 'FILE_' + os.path.basename(getattr(photo, 'name', 'upload'))
+        return self.record('sendPhoto', chat_id, photo = photo)
+
+    def setWebhook(self,
+                   *args,
+                   **kwargs):
+        return True
+
+
+def make_update(bot,
+                update_id,
+                chat_id,
+                user_id,
+                text):
+    """
+    Returns:
+        telegram.Update of a text message, deserialized as get_mesg would see it.
+    """
+    data = {'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'},
+                        'from': {'id': user_id, 'first_name': 'bench', 'is_bot': False},
+                        'text': text}}
+    return telegram.Update.de_json(data, bot)
+
+
+def make_resp_db(file_name,
+                 keywords,
+                 responses,
+                 symptoms,
+                 pictures):
+    """
+    Create a resp_db with the same tables as resp_db.example.sqlite.
+
+    Returns:
+        List of generated keywords.
+    """
+    db = sqlite3.connect(file_name)
+    c = db.cursor()
+    c.execute('CREATE TABLE resp (IIDX INTEGER PRIMARY KEY, keyword TEXT, cont TEXT, gid INTEGER NOT NULL DEFAULT -1)')
+    c.execute('CREATE TABLE resp_get (IIDX INTEGER PRIMARY KEY, keyword TEXT, cont TEXT, tag TEXT DEFAULT null, gid INTEGER NOT NULL DEFAULT -1)')
+    c.execute('CREATE TABLE symptom (IIDX INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, before TEXT NOT NULL, after TEXT NOT NULL, gid INTEGER NOT NULL DEFAULT -1)')
+    c.execute('CREATE TABLE symptom_get (IIDX INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, before TEXT NOT NULL, after TEXT NOT NULL, gid INTEGER NOT NULL DEFAULT -1)')
+
+    kws = ['kw{0:05d}'.format(i) for i in range(keywords)]
+    c.executemany('INSERT INTO resp (keyword, cont) VALUES (?, ?)',
+                  ((kw, 'response {0} of {1}'.format(j, kw)) for kw in kws for j in range(responses)))
+    c.executemany('INSERT INTO symptom (before, after) VALUES (?, ?)',
+                  (('sym{0:05d}'.format(i), random.choice(kws)) for i in range(symptoms)))
+    c.executemany('INSERT INTO resp_get (keyword, cont, tag) VALUES (?, ?, ?)',
+                  ((kw, 'PHOTO_{0}_{1}'.format(kw, j), random.choice([None, 'a', 'b'])) for kw in kws[:max(1, keywords // 10)] for j in range(pictures)))
+    db.commit()
+    db.close()
+
+    return kws
+
+
+class Traffic:
+    """
+    This object describes a generator of synthetic updates with a weighted mix.
+
+    Attributes:
+        mix (dict):
+            Kind -> weight. Kinds: hit, miss, get, roll, motd, flood.
+    """
+
+    DEFAULT_MIX = {'hit': 30, 'miss': 40, 'get': 10, 'roll': 8, 'motd': 2, 'flood': 10}
+
+    def __init__(self,
+                 bot,
+                 keywords,
+                 strs,
+                 chats,
+                 users = 200,
+                 mix = None):
+        self.bot = bot
+        self.keywords = keywords
+        self.get_keywords = keywords[:max(1, len(keywords) // 10)]
+        self.strs = strs
+        self.chats = chats
+        self.users = users
+        self.mix = mix or self.DEFAULT_MIX
+        self.kinds = list(self.mix.keys())
+        self.weights = [self.mix[k] for k in self.kinds]
+        self.update_id = 0
+
+    def text_of(self,
+                kind):
+        """Returns: (text, user_id) of one message of kind."""
+        user_id = random.randint(1, self.users)
+        if kind == 'hit':
+            return 'blah {0} blah'.format(random.choice(self.keywords)), user_id
+        if kind == 'miss':
+            return 'nothing to see here {0}'.format(random.random()), user_id
+        if kind == 'get':
+            return '/get {0}'.format(random.choice(self.get_keywords)), user_id
+        if kind == 'roll':
+            return random.choice(['/roll', '/roll 3d6', '/roll 2d20+3', '/roll 5d6s4', '/roll 10-20']), user_id
+        if kind == 'motd':
+            return random.choice(['/motd', random.choice(self.strs['q_motd_kws'])]), user_id
+        # flood: same user, same text
+        return 'FLOOD FLOOD FLOOD', 0
+
+    def batch(self,
+              size):
+        """Returns: list of size telegram.Update."""
+        out = []
+        for kind in random.choices(self.kinds, self.weights, k = size):
+            self.update_id += 1
+            text, user_id = self.text_of(kind)
+            out.append(make_update(self.bot, self.update_id, random.choice(self.chats), user_id, text))
+        return out
+
+
+class HandlerTimer:
+    """
+    This object describes latency samples collected around AFXBot handlers.
+
+    Sends are asynchronous, so a call is only sampled once it returned and
+    the futures of all sends it queued, nested handlers included, are done.
+    The handler itself does not wait for them.
+
+    Attributes:
+        samples (dict):
+            Handler name -> list of seconds.
+        outstanding (int):
+            Calls returned but still waiting for their sends.
+    """
+
+    HANDLERS = ['handle_update', 'handle_washsnake', 'handle_response', 'handle_cmd',
+                'handle_adm_cmd', 'handle_motd', 'handle_roll', 'handle_fortune_tell']
+    SENDS = ['send_generic_mesg', 'send_photo']
+
+    def __init__(self,
+                 afx):
+        self.samples = dict()
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        # Per thread stack of send futures, one list per running handler call.
+        self.local = threading.local()
+
+        for name in self.SENDS:
+            self.watch(afx, name)
+        for name in self.HANDLERS:
+            self.wrap(afx, name)
+
+    def watch(self,
+              afx,
+              name):
+        func = getattr(afx, name)
+
+        def watched(*args, **kwargs):
+            fut = func(*args, **kwargs)
+            for futs in getattr(self.local, 'stack', ()):
+                futs.append(fut)
+            return fut
+
+        setattr(afx, name, watched)
+
+    def wrap(self,
+             afx,
+             name):
+        func = getattr(afx, name)
+        samples = self.samples.setdefault(name, [])
+
+        def timed(*args, **kwargs):
+            stack = self.local.__dict__.setdefault('stack', [])
+            futs = []
+            stack.append(futs)
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+                self.finish(samples, t, futs)
+
+        setattr(afx, name, timed)
+
+    def finish(self,
+               samples,
+               t,
+               futs):
+        """Sample a call started at t once every future in futs is done."""
+        if not futs:
+            samples.append(time.perf_counter() - t)
+            return
+
+        left = [len(futs)]
+        with self.lock:
+            self.outstanding += 1
+
+        def done(fut):
+            with self.lock:
+                left[0] -= 1
+                if not left[0]:
+                    samples.append(time.perf_counter() - t)
+                    self.outstanding -= 1
+
+        for fut in futs:
+            fut.add_done_callback(done)
+
+    def drain(self,
+              timeout):
+        """Wait up to timeout seconds for the sends of every sampled call."""
+        deadline = time.monotonic() + timeout
+        while self.outstanding and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    @staticmethod
+    def percentile(sorted_samples,
+                   p):
+        if not sorted_samples:
+            return 0
+        return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p / 100.0))]
+
+    def report(self):
+        """Returns: list of (name, count, p50 ms, p99 ms, max ms)."""
+        rows = []
+        for name in self.HANDLERS:
+            s = sorted(self.samples[name])
+            if s:
+                rows.append((name, len(s), self.percentile(s, 50) * 1000, self.percentile(s, 99) * 1000, s[-1] * 1000))
+        return rows
+
+
+def copy_config(work_dir,
+                conf_file_name):
+    """
+    Copy a real config, its strings and resp_db into work_dir, so a run
+    does not touch them.
+
+    Returns:
+        The copied config, pointing at the copies.
+    """
+    with open(conf_file_name, 'r', encoding = 'utf8') as f:
+        config = json.loads(f.read())
+
+    base = os.path.dirname(os.path.abspath(conf_file_name))
+    for key in ['strings_json', 'resp_db']:
+        src = os.path.join(base, config[key])
+        shutil.copy(src, work_dir)
+        config[key] = os.path.basename(src)
+
+    # Nothing leaves the host, and nothing is recorded again.
+    for key in ['record_dir', 'metrics_port', 'webhook_url', 'motd_db']:
+        config.pop(key, None)
+    # Recorded updates are old by definition, 'skip' would drop them all.
+    config['stale_update_policy'] = 'replay'
+    return config
+
+
+def build_bot(work_dir,
+              args,
+              chats = None):
+    """
+    Returns:
+        (AFXBot, FakeBot, keywords, strings, chats) set up in work_dir.
+    """
+    fake = FakeBot(latency = args.send_latency)
+    pacing = {'send_rate_global': 1e9, 'send_rate_group_per_min': 1e9, 'send_rate_private': 1e9}
+
+    if args.config:
+        config = copy_config(work_dir, args.config)
+        config.update(pacing)
+        with open(os.path.join(work_dir, 'config.json'), 'w', encoding = 'utf8') as f:
+            json.dump(config, f)
+
+        afx = afxbot.AFXBot('config.json', bot = fake)
+        return afx, fake, afx.kw_list, afx.strs, config['operational_chats']
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'strings.example.json'), 'r', encoding = 'utf8') as f:
+        strs = json.loads(f.read())
+    strs.setdefault('r_invasive_random_angry_strs', ['ANGRY'])
+    with open(os.path.join(work_dir, 'strings.json'), 'w', encoding = 'utf8') as f:
+        json.dump(strs, f, ensure_ascii = False)
+
+    kws = make_resp_db(os.path.join(work_dir, 'resp_db.sqlite'), args.keywords, args.responses, args.symptoms, args.pictures)
+
+    if not chats:
+        chats = [-(1000 + i) for i in range(args.chats)]
+    config = {'strings_json': 'strings.json',
+              'bot_token': 'BENCH',
+              'resp_db': 'resp_db.sqlite',
+              'adm_ids': [999999],
+              'operational_chats': chats,
+              'restricted_chats': [],
+              'motd_only_chats': [],
+              'invasive_washsnake_chats': chats[:1]}
+    # Pacing is not under test here.
+    config.update(pacing)
+    with open(os.path.join(work_dir, 'config.json'), 'w', encoding = 'utf8') as f:
+        json.dump(config, f)
+
+    afx = afxbot.AFXBot('config.json', bot = fake)
+    return afx, fake, kws, strs, chats
+
+
+def feed(afx,
+         fake,
+         batch):
+    """Hand batch to afx through one getUpdates round."""
+    if batch:
+        fake.updates = batch
+        afx.LAST_UPDATE_ID = batch[0].update_id
+        afx.get_mesg()
+
+
+def capture_chats(files):
+    """
+    Returns:
+        Sorted chat ids found in capture files.
+    """
+    chats = set()
+    for file_name in files:
+        for received, data in afxbot.UpdateRecorder.read(file_name):
+            chat = data.get('message', dict()).get('chat')
+            if chat:
+                chats.add(chat['id'])
+    return sorted(chats)
+
+
+def replay(afx,
+           fake,
+           files,
+           speed,
+           batch_size):
+    """
+    Feed captured updates to afx, keeping their original spacing divided by
+    speed, or as fast as possible when speed is 0.
+
+    Returns:
+        Number of updates fed.
+    """
+    start = None
+    batch = []
+    done = 0
+
+    for file_name in files:
+        for received, data in afxbot.UpdateRecorder.read(file_name):
+            if start is None:
+                start = (time.perf_counter(), received)
+
+            if speed > 0:
+                delay = start[0] + (received - start[1]) / speed - time.perf_counter()
+                if delay > 0:
+                    feed(afx, fake, batch)
+                    batch = []
+                    time.sleep(delay)
+
+            batch.append(telegram.Update.de_json(data, fake))
+            done += 1
+            if len(batch) >= batch_size:
+                feed(afx, fake, batch)
+                batch = []
+
+    feed(afx, fake, batch)
+    return done
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = 'AFX_bot offline update loop benchmark.')
+    arg_parser.add_argument('--updates', type = int, default = 10000, help = 'Updates to feed')
+    arg_parser.add_argument('--batch', type = int, default = 100, help = 'Updates per getUpdates')
+    arg_parser.add_argument('--keywords', type = int, default = 2000, help = 'Keywords in resp_db')
+    arg_parser.add_argument('--responses', type = int, default = 3, help = 'Responses per keyword')
+    arg_parser.add_argument('--symptoms', type = int, default = 500, help = 'Symptom rows')
+    arg_parser.add_argument('--pictures', type = int, default = 3, help = 'Pictures per /get keyword')
+    arg_parser.add_argument('--chats', type = int, default = 20, help = 'Operational group chats')
+    arg_parser.add_argument('--mix', default = None, help = 'JSON kind -> weight, e.g. {"hit": 1, "miss": 1}')
+    arg_parser.add_argument('--send-latency', type = float, default = 0, help = 'Seconds per fake send call')
+    arg_parser.add_argument('--seed', type = int, default = 1)
+    arg_parser.add_argument('--json', action = 'store_true', help = 'Print report as JSON')
+    arg_parser.add_argument('--replay', nargs = '+', default = None, help = 'Capture files to feed instead of generated traffic')
+    arg_parser.add_argument('--speed', type = float, default = 0, help = 'Replay pace, 1 is real time, 0 as fast as possible')
+    arg_parser.add_argument('--config', default = None, help = 'Real config to run against (copied)')
+    args = arg_parser.parse_args()
+
+    if args.replay:
+        args.replay = [os.path.abspath(f) for f in args.replay]
+    if args.config:
+        args.config = os.path.abspath(args.config)
+
+    random.seed(args.seed)
+    logging.disable(logging.CRITICAL)
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix = 'afxbench_')
+    try:
+        os.chdir(work_dir)
+        t = time.perf_counter()
+        afx, fake, kws, strs, chats = build_bot(work_dir, args, capture_chats(args.replay) if args.replay else None)
+        init_time = time.perf_counter() - t
+
+        timer = HandlerTimer(afx)
+
+        t = time.perf_counter()
+        if args.replay:
+            done = replay(afx, fake, args.replay, args.speed, args.batch)
+        else:
+            traffic = Traffic(fake, kws, strs, chats, mix = json.loads(args.mix) if args.mix else None)
+            done = 0
+            while done < args.updates:
+                batch = traffic.batch(min(args.batch, args.updates - done))
+                feed(afx, fake, batch)
+                done += len(batch)
+        elapsed = time.perf_counter() - t
+
+        # Let queued sends drain before counting them.
+        timer.drain(10)
+
+        report = {'updates': done,
+                  'seconds': elapsed,
+                  'updates_per_sec': done / elapsed if elapsed else 0,
+                  'init_seconds': init_time,
+                  'sends': len(fake.sent),
+                  'handlers': [dict(zip(('name', 'count', 'p50_ms', 'p99_ms', 'max_ms'), r)) for r in timer.report()]}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    if args.json:
+        print(json.dumps(report, indent = 2))
+        return
+
+    print('updates: {0}  time: {1:.3f}s  => {2:.1f} updates/s  (init {3:.3f}s, sends {4})'.format(
+        report['updates'], report['seconds'], report['updates_per_sec'], report['init_seconds'], report['sends']))
+    print('{0:<20} {1:>8} {2:>10} {3:>10} {4:>10}'.format('handler', 'count', 'p50 ms', 'p99 ms', 'max ms'))
+    for h in report['handlers']:
+        print('{name:<20} {count:>8} {p50_ms:>10.3f} {p99_ms:>10.3f} {max_ms:>10.3f}'.format(**h))
+
+if __name__ == '__main__':
+    main()
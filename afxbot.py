@@ -24,41 +24,2012 @@ __author__ = 'Anfauglir'
 # 2. REize all command handler.  (optional)
 
 import logging
+import logging.handlers
 import telegram
 import re
 import random
 import json
+import os
 import sqlite3
 import string
 import http
 import hashlib
-import urllib
+import http.client
 import argparse
+import asyncio
+import threading
+import time
+import queue
+import bisect
+import heapq
+import atexit
+import functools
+import http.server
+import multiprocessing
+import struct
+import zlib
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 
 from datetime import date, datetime, timedelta
 from pathlib import Path
 
+class JsonLogFormatter(logging.Formatter):
+    """
+    This object describes a formatter writing each record as one JSON line.
+
+    Keys: ts, level, logger, thread, msg, and category / exc when present.
+    """
+
+    def format(self,
+               record):
+        entry = {'ts': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'msg': record.getMessage()}
+        category = getattr(record, 'category', None)
+        if category:
+            entry['category'] = category
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii = False, default = str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    This object describes a QueueHandler leaving all formatting to the
+    listener thread, so the caller only pays for queueing the record.
+    """
+
+    def prepare(self,
+                record):
+        return record
+
+
 class WashSnake:
     """
-    This object describes a anti-flood stat for given user.
+    This object describes a anti-flood stat for given user.
+
+    Attributes:
+        firsttime (float):
+            POSIX timestamp of the first message of the current run.
+        content (int):
+            Hash of the repeated message content.
+        responded (bool):
+
+        repeattimes (Optional[int]):
+    """
+
+    __slots__ = ('firsttime', 'content', 'responded', 'repeattimes')
+
+    def __init__(self,
+                 firsttime,
+                 content,
+                 repeattimes=0):
+        self.firsttime = firsttime
+        self.content = content
+
+        self.responded = False
+        self.repeattimes = repeattimes
+
+
+class WashSnakeTable:
+    """
+    This object describes bounded anti-flood state keyed by (chat_id, user_id).
+
+    Entries whose firsttime is older than ttl behave as absent: they are
+    dropped on lookup, and swept from the LRU end as new entries come in.
+    At most max_entries are kept; the least recently used ones go first.
+
+    Attributes:
+        ttl (float):
+            Seconds a run of repeated messages is tracked.
+        max_entries (int):
+            Hard cap of tracked users.
+    """
+
+    def __init__(self,
+                 ttl = 60,
+                 max_entries = 50000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,
+            key,
+            now):
+        """
+        Returns:
+            Live WashSnake of key, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if now - entry.firsttime >= self.ttl:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def hit(self,
+            key,
+            content,
+            now,
+            threshold = 2):
+        """
+        Count one message of key, all under the lock, so handlers on other
+        threads never see a half-updated entry.
+
+        Returns:
+            None when content starts a new run, otherwise (repeattimes,
+            respond) where respond is True once per run, when repeattimes
+            reaches threshold.
+        """
+        with self.lock:
+            entry = self.get(key, now)
+            if entry and entry.content == content:
+                entry.repeattimes += 1
+                respond = entry.repeattimes >= threshold and not entry.responded
+                if respond:
+                    entry.responded = True
+                return entry.repeattimes, respond
+
+            self.put(key, WashSnake(now, content), now)
+            return None
+
+    def put(self,
+            key,
+            entry,
+            now):
+        """Store entry as most recently used, then sweep and enforce the cap."""
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            # Sweep expired entries from the least recently used end.
+            while self.entries:
+                first = next(iter(self.entries.values()))
+                if now - first.firsttime < self.ttl:
+                    break
+                self.entries.popitem(last = False)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+
+class KeywordAutomaton:
+    """
+    This object describes an Aho-Corasick automaton over a set of keywords.
+
+    All keywords found in a message are collected within one pass over it.
+    Keywords can be added or removed afterwards; failure links are then
+    recomputed in memory on the next search.
+
+    Attributes:
+        words (set):
+            Keywords currently recognized.
+        goto (list):
+            Transition table, one dict(char -> state) per state.
+        fail (list):
+            Failure link for each state.
+        out (list):
+            Keyword ending exactly at each state, or None.
+        dict_link (list):
+            Nearest state along the failure chain that ends a keyword.
+    """
+
+    def __init__(self,
+                 keywords = ()):
+        self.words = set()
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [None]
+        self.dict_link = [0]
+        self.dirty = False
+
+        for kw in keywords:
+            self.add(kw)
+
+        self.build()
+
+    def add(self,
+            kw):
+        """Insert kw into the trie."""
+        if not kw or kw in self.words:
+            return
+
+        state = 0
+        for ch in kw:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.out.append(None)
+                self.dict_link.append(0)
+                self.goto[state][ch] = nxt
+            state = nxt
+
+        self.out[state] = kw
+        self.words.add(kw)
+        self.dirty = True
+
+    def remove(self,
+               kw):
+        """Stop recognizing kw. Its trie states are kept for later reuse."""
+        if kw not in self.words:
+            return
+
+        state = 0
+        for ch in kw:
+            state = self.goto[state][ch]
+
+        self.out[state] = None
+        self.words.discard(kw)
+        self.dirty = True
+
+    def build(self):
+        """Compute failure and dictionary links (BFS)."""
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        dict_link = self.dict_link
+
+        queue = list(goto[0].values())
+        for s in queue:
+            fail[s] = 0
+            dict_link[s] = 0
+
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[nxt] = f
+                dict_link[nxt] = f if out[f] else dict_link[f]
+
+        self.dirty = False
+
+    def find_all(self,
+                 text):
+        """
+        Returns:
+            Set of all keywords occurring in text.
+        """
+        if self.dirty:
+            self.build()
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        dict_link = self.dict_link
+        found = set()
+
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+
+            s = state if out[state] else dict_link[state]
+            while s:
+                found.add(out[s])
+                s = dict_link[s]
+
+        return found
+
+
+class ResponseStore:
+    """
+    This object describes an in-memory copy of the resp and resp_get tables.
+
+    Every index keeps IIDX arrays, so a random pick is one index draw and a
+    removal is one swap with the last element. Rows carry a weight; an
+    array whose weights differ gets a Walker alias table, built on its
+    first pick after a change, so weighted picks are O(1) too. resp_get indexes are
+    partitioned by gid, the group a picture was added in or -1 for the
+    global pool, so a lookup only touches that group's rows.
+
+    Attributes:
+        resp_rows (dict):
+            resp IIDX -> row dict.
+        resp_idx (dict):
+            keyword -> list of resp IIDX.
+        get_rows (dict):
+            resp_get IIDX -> row dict.
+        get_idx (dict):
+            (gid, keyword) -> list of resp_get IIDX.
+        get_tag_idx (dict):
+            (gid, keyword, tag) -> list of resp_get IIDX.
+        get_kw_count (dict):
+            keyword -> number of resp_get rows over all gids.
+        resp_alias, get_alias, get_tag_alias (dict):
+            Index key -> (prob, alias) over its array, None when uniform,
+            () when every weight is 0.
+            A missing key is built on the next pick.
+    """
+
+    # Draws before a recently picked row is accepted anyway.
+    REPEAT_TRIES = 8
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Forget all rows and indexes."""
+        self.resp_rows = dict()
+        self.resp_idx = dict()
+        self.get_rows = dict()
+        self.get_idx = dict()
+        self.get_tag_idx = dict()
+        self.get_kw_count = dict()
+
+        self.resp_alias = dict()
+        self.get_alias = dict()
+        self.get_tag_alias = dict()
+
+        # IIDX -> position in its array, one dict per index.
+        self.resp_pos = dict()
+        self.get_pos = dict()
+        self.get_tag_pos = dict()
+
+    def load(self,
+             db):
+        """
+        Read all rows of resp and resp_get from db.
+
+        Args:
+            db (sqlite3.Connection):
+                Response database.
+        """
+        self.clear()
+
+        c = db.cursor()
+        c.execute('SELECT IIDX, keyword, cont, weight FROM resp;')
+        for row in c:
+            self.add_resp(row['IIDX'], row['keyword'], row['cont'], row['weight'])
+
+        c.execute('SELECT IIDX, keyword, cont, tag, gid, weight FROM resp_get;')
+        for row in c:
+            self.add_get(row['IIDX'], row['keyword'], row['cont'], row['tag'], row['gid'], row['weight'])
+
+    @staticmethod
+    def _push(idx,
+              pos,
+              alias,
+              key,
+              iidx):
+        alias.pop(key, None)
+        arr = idx.setdefault(key, [])
+        pos[iidx] = len(arr)
+        arr.append(iidx)
+
+    @staticmethod
+    def _pop(idx,
+             pos,
+             alias,
+             key,
+             iidx):
+        alias.pop(key, None)
+        arr = idx[key]
+        i = pos.pop(iidx)
+        last = arr.pop()
+        if last != iidx:
+            arr[i] = last
+            pos[last] = i
+        if not arr:
+            del idx[key]
+
+    def add_resp(self,
+                 iidx,
+                 keyword,
+                 cont,
+                 weight = 1.0):
+        """Add one resp row."""
+        self.resp_rows[iidx] = {'IIDX': iidx, 'keyword': keyword, 'cont': cont, 'weight': weight}
+        self._push(self.resp_idx, self.resp_pos, self.resp_alias, keyword, iidx)
+
+    def remove_resp(self,
+                    iidx):
+        """
+        Remove one resp row.
+
+        Returns:
+            The removed row, or None when iidx is unknown.
+        """
+        row = self.resp_rows.pop(iidx, None)
+        if row:
+            self._pop(self.resp_idx, self.resp_pos, self.resp_alias, row['keyword'], iidx)
+        return row
+
+    def add_get(self,
+                iidx,
+                keyword,
+                cont,
+                tag = None,
+                gid = -1,
+                weight = 1.0):
+        """Add one resp_get row."""
+        self.get_rows[iidx] = {'IIDX': iidx, 'keyword': keyword, 'cont': cont, 'tag': tag, 'gid': gid, 'weight': weight}
+        self._push(self.get_idx, self.get_pos, self.get_alias, (gid, keyword), iidx)
+        if tag:
+            self._push(self.get_tag_idx, self.get_tag_pos, self.get_tag_alias, (gid, keyword, tag), iidx)
+        self.get_kw_count[keyword] = self.get_kw_count.get(keyword, 0) + 1
+
+    def remove_get(self,
+                   iidx):
+        """
+        Remove one resp_get row.
+
+        Returns:
+            The removed row, or None when iidx is unknown.
+        """
+        row = self.get_rows.pop(iidx, None)
+        if row:
+            kw = row['keyword']
+            self._pop(self.get_idx, self.get_pos, self.get_alias, (row['gid'], kw), iidx)
+            if row['tag']:
+                self._pop(self.get_tag_idx, self.get_tag_pos, self.get_tag_alias, (row['gid'], kw, row['tag']), iidx)
+            self.get_kw_count[kw] -= 1
+            if not self.get_kw_count[kw]:
+                del self.get_kw_count[kw]
+        return row
+
+    def move_get(self,
+                 iidx,
+                 gid):
+        """Move one resp_get row to partition gid."""
+        row = self.remove_get(iidx)
+        if row:
+            self.add_get(iidx, row['keyword'], row['cont'], row['tag'], gid, row['weight'])
+
+    def set_resp_weight(self,
+                        iidx,
+                        weight):
+        """
+        Returns:
+            The updated resp row, or None when iidx is unknown.
+        """
+        row = self.resp_rows.get(iidx)
+        if row:
+            row['weight'] = weight
+            self.resp_alias.pop(row['keyword'], None)
+        return row
+
+    def set_get_weight(self,
+                       iidx,
+                       weight):
+        """
+        Returns:
+            The updated resp_get row, or None when iidx is unknown.
+        """
+        row = self.get_rows.get(iidx)
+        if row:
+            row['weight'] = weight
+            self.get_alias.pop((row['gid'], row['keyword']), None)
+            self.get_tag_alias.pop((row['gid'], row['keyword'], row['tag']), None)
+        return row
+
+    def get_partition(self,
+                      gid,
+                      keyword = None):
+        """
+        Returns:
+            resp_get IIDX list of partition gid, of keyword only when given.
+        """
+        if keyword is not None:
+            return list(self.get_idx.get((gid, keyword), []))
+        return [i for (g, kw), arr in self.get_idx.items() if g == gid for i in arr]
+
+    def has_resp(self,
+                 keyword):
+        """Returns: True when keyword has any resp row."""
+        return keyword in self.resp_idx
+
+    def has_get(self,
+                keyword,
+                gid = None):
+        """
+        Returns:
+            True when keyword has any resp_get row; when gid is given, only
+            rows of partition gid and the global pool count.
+        """
+        if gid is None:
+            return keyword in self.get_kw_count
+        return any(self.get_idx.get((p, keyword)) for p in (gid, -1))
+
+    @staticmethod
+    def build_alias(weights):
+        """
+        Build the tables of Walker's alias method (Vose's variant).
+
+        Returns:
+            (prob, alias) lists, None when weights are all equal, or an
+            empty tuple when no weight is positive, so nothing is picked.
+        """
+        n = len(weights)
+        total = sum(weights)
+        if total <= 0:
+            return ()
+        if min(weights) == max(weights):
+            return None
+
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        return prob, alias
+
+    def sample(self,
+               rows,
+               arr,
+               alias,
+               key,
+               recent = None):
+        """
+        Weighted pick from arr, one alias table draw per try.
+
+        Args:
+            rows (dict):
+                IIDX -> row of the table arr belongs to.
+            arr (list):
+                Non-empty IIDX array of key.
+            alias (dict):
+                Alias tables of the index arr belongs to.
+            key:
+                Index key of arr.
+            recent (Optional[deque]):
+                IIDX picked lately for the same chat and keyword. Its last
+                len(arr) // 2 are avoided, so a pick stays O(1) expected.
+                The pick is appended.
+
+        Returns:
+            The picked row, None when every weight of arr is 0.
+        """
+        if key not in alias:
+            alias[key] = self.build_alias([rows[i]['weight'] for i in arr])
+        table = alias[key]
+        if table == ():
+            return None
+
+        avoid = list(recent)[-(len(arr) // 2):] if recent and len(arr) > 1 else ()
+        for _ in range(self.REPEAT_TRIES):
+            i = random.randrange(len(arr))
+            if table and random.random() >= table[0][i]:
+                i = table[1][i]
+            if arr[i] not in avoid:
+                break
+
+        if recent is not None:
+            recent.append(arr[i])
+        return rows[arr[i]]
+
+    def pick_resp(self,
+                  keyword,
+                  recent = None):
+        """
+        Returns:
+            Weighted random resp row of keyword, or None. See sample for recent.
+        """
+        arr = self.resp_idx.get(keyword)
+        if not arr:
+            return None
+        return self.sample(self.resp_rows, arr, self.resp_alias, keyword, recent)
+
+    def pick_get(self,
+                 keyword,
+                 tag = None,
+                 gid = -1,
+                 recent = None):
+        """
+        Partition gid is tried before the global pool, and (keyword, tag)
+        in either before keyword only; rows all weighted 0 count as none.
+
+        Returns:
+            Weighted random resp_get row, or None. See sample for recent.
+        """
+        parts = [gid, -1] if gid != -1 else [-1]
+        keys = []
+        if tag:
+            keys += [(self.get_tag_idx, self.get_tag_alias, (p, keyword, tag)) for p in parts]
+        keys += [(self.get_idx, self.get_alias, (p, keyword)) for p in parts]
+
+        for idx, alias, key in keys:
+            arr = idx.get(key)
+            if arr:
+                row = self.sample(self.get_rows, arr, alias, key, recent)
+                if row is not None:
+                    return row
+        return None
+
+    @staticmethod
+    def page(keys,
+             after = None,
+             limit = None):
+        """
+        Keyset page over keys: the smallest limit keys greater than after.
+
+        Returns:
+            Sorted list of keys.
+        """
+        if after is not None:
+            keys = (k for k in keys if k > after)
+        if limit is None:
+            return sorted(keys)
+        return heapq.nsmallest(limit, keys)
+
+    def list_resp(self,
+                  keyword,
+                  after = 0,
+                  limit = None):
+        """
+        Returns:
+            resp rows of keyword with IIDX > after ordered by IIDX, at most limit.
+        """
+        return [self.resp_rows[i] for i in self.page(self.resp_idx.get(keyword, []), after, limit)]
+
+    def list_get(self,
+                 keyword,
+                 gid = -1,
+                 after = 0,
+                 limit = None):
+        """
+        Returns:
+            resp_get rows of keyword in partition gid with IIDX > after
+            ordered by IIDX, at most limit.
+        """
+        return [self.get_rows[i] for i in self.page(self.get_idx.get((gid, keyword), []), after, limit)]
+
+
+class MotdStore:
+    """
+    This object describes MotDs of every chat, kept in SQLite with history.
+
+    Reads are served from current. set() updates current at once and queues
+    the row; a writer thread appends queued rows in one transaction after
+    delay seconds, so bursts of updates cost one write and a crash never
+    leaves a half-written file behind.
+
+    Attributes:
+        current (dict):
+            str(chat_id) -> {'msg': str, 'date': datetime.date}, latest MotD of each chat.
+        delay (float):
+            Seconds to collect updates before writing.
+    """
+
+    def __init__(self,
+                 logger,
+                 file_name = 'motd.sqlite',
+                 delay = 1.0):
+        self.logger = logger
+        self.delay = delay
+        self.current = dict()
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        self.db = sqlite3.connect(file_name, check_same_thread = False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS motd (IIDX INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, date TEXT NOT NULL, msg TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS motd_chat_date ON motd (chat_id, date)')
+        self.db.commit()
+
+        self.thread = threading.Thread(target = self.loop, name = 'MotdStore', daemon = True)
+        self.thread.start()
+
+    def load(self):
+        """Read the latest MotD of every chat into current."""
+        with self.lock:
+            rows = self.db.execute('SELECT chat_id, date, msg FROM motd WHERE IIDX IN '
+                                   '(SELECT MAX(IIDX) FROM motd GROUP BY chat_id)').fetchall()
+        for chat_id, day, msg in rows:
+            self.current[str(chat_id)] = {'msg': msg, 'date': date.fromisoformat(day)}
+
+    def migrate_json(self,
+                     file_name):
+        """
+        Import a legacy motd.json once, when the table is still empty.
+
+        Returns:
+            Number of imported MotDs.
+        """
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM motd LIMIT 1').fetchone():
+                return 0
+
+        try:
+            with open(file_name, 'r', encoding = 'utf8') as f:
+                motds = json.loads(f.read())
+        except FileNotFoundError:
+            return 0
+
+        rows = [(int(k), v['date'], v['msg']) for k, v in motds.items()]
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO motd (chat_id, date, msg) VALUES (?, ?, ?)', rows)
+
+        self.logger.info('imported {0} MOTDs from {1}'.format(len(rows), file_name))
+        return len(rows)
+
+    def set(self,
+            chat_id,
+            msg,
+            day):
+        """Make msg the MotD of chat_id for day; written to disk within delay seconds."""
+        self.current[str(chat_id)] = {'msg': msg, 'date': day}
+        with self.lock:
+            self.pending.append((chat_id, day.isoformat(), msg))
+        self.wakeup.set()
+
+    def history(self,
+                chat_id,
+                day):
+        """
+        Returns:
+            Last MotD of chat_id set on day, or None.
+        """
+        with self.lock:
+            for c, d, msg in reversed(self.pending):
+                if c == chat_id and d == day.isoformat():
+                    return msg
+
+            row = self.db.execute('SELECT msg FROM motd WHERE chat_id = ? AND date = ? ORDER BY IIDX DESC LIMIT 1',
+                                  (chat_id, day.isoformat())).fetchone()
+        return row[0] if row else None
+
+    def flush(self):
+        """Write queued MotDs now."""
+        with self.lock:
+            rows, self.pending = self.pending, []
+            if not rows:
+                return
+            try:
+                with self.db:
+                    self.db.executemany('INSERT INTO motd (chat_id, date, msg) VALUES (?, ?, ?)', rows)
+            except Exception:
+                self.pending[:0] = rows
+                raise
+
+        self.logger.info('wrote {0} MOTD updates'.format(len(rows)))
+
+    def loop(self):
+        """Writer thread: flush once updates have settled for delay seconds."""
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.delay)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('!!! MOTD write failed !!!')
+                self.wakeup.set()
+
+
+class DiceRoller:
+    """
+    This object describes a dice expression compiler and roller.
+
+    An expression is a sum of terms, each a constant or dice:
+
+        [count]d(sides|%)[kN|khN|klN][!][sN]
+
+    kh/kl keep the N highest/lowest dice (k is kh), ! re-rolls and adds every
+    die showing its maximum, and sN counts dice >= N as successes instead of
+    summing them. E.g. 4d6kh3, 2d20kl1+5, 6d10!s8, 3d6+1d4-2.
+
+    Attributes:
+        max_dice (int):
+            Max dice per request, explosions included.
+        max_terms (int):
+            Max terms per expression.
+        list_max (int):
+            Max dice listed one by one; larger terms are summarized.
+        time_limit (float):
+            Seconds one request may take.
+    """
+
+    TERM_RE = re.compile(r'\s*([+-]?)\s*(?:(\d*)d(\d+|%)((?:k[hl]?\d+|!|s\d+)*)|(\d+))')
+    MOD_RE = re.compile(r'(kh|kl|k|s)(\d+)|(!)')
+
+    def __init__(self,
+                 max_dice = 100000,
+                 max_terms = 20,
+                 list_max = 100,
+                 time_limit = 1.0):
+        self.max_dice = max_dice
+        self.max_terms = max_terms
+        self.list_max = list_max
+        self.time_limit = time_limit
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 1024)
+    def parse(expr):
+        """
+        Compile expr, which must be dice terms only.
+
+        Returns:
+            Tuple of (canonical text, terms). A term is (sign, value) for a
+            constant, or (sign, count, sides, keep, explode, success) for dice,
+            where keep is None or ('h'|'l', n) and success is None or a threshold.
+        Raises:
+            ValueError: when expr is not entirely a dice expression.
+        """
+        terms = []
+        text = []
+        pos = 0
+        while True:
+            m = DiceRoller.TERM_RE.match(expr, pos)
+            if not m or (terms and not m.group(1)):
+                break
+            pos = m.end()
+            sign = -1 if m.group(1) == '-' else 1
+
+            if m.group(5) is not None:
+                terms.append((sign, int(m.group(5))))
+            else:
+                count = int(m.group(2)) if m.group(2) else 1
+                sides = 100 if m.group(3) == '%' else int(m.group(3))
+
+                keep = None
+                explode = False
+                success = None
+                for kind, n, bang in DiceRoller.MOD_RE.findall(m.group(4)):
+                    if bang:
+                        explode = True
+                    elif kind == 's':
+                        success = int(n)
+                    else:
+                        keep = ('l' if kind == 'kl' else 'h', int(n))
+
+                terms.append((sign, count, sides, keep, explode, success))
+
+            text.append(re.sub(r'\s', '', m.group(0)))
+
+        if not terms:
+            raise ValueError('no dice expression')
+        if expr[pos:].strip():
+            raise ValueError('unexpected {0!r}'.format(expr[pos:].strip()))
+
+        return ''.join(text), tuple(terms)
+
+    def summarize(self,
+                  vals):
+        """Returns: short description of many dice."""
+        return '({0} dice: min {1}, max {2}, mean {3:.2f})'.format(len(vals), min(vals), max(vals), sum(vals) / len(vals))
+
+    def roll(self,
+             expr):
+        """
+        Roll expr.
+
+        Returns:
+            Text showing the dice and the total.
+        Raises:
+            ValueError: on syntax errors or when a guard is hit.
+        """
+        canonical, terms = self.parse(expr)
+        if len(terms) > self.max_terms:
+            raise ValueError('too many terms (max {0})'.format(self.max_terms))
+        budget = self.max_dice - sum(t[1] for t in terms if len(t) > 2)
+        if budget < 0:
+            raise ValueError('too many dice (max {0})'.format(self.max_dice))
+
+        deadline = time.monotonic() + self.time_limit
+        listed = self.list_max
+        total = 0
+        parts = []
+
+        for term in terms:
+            sign = term[0]
+            if len(term) == 2:
+                total += sign * term[1]
+                parts.append(('-' if sign < 0 else '+') + str(term[1]))
+                continue
+
+            sign, count, sides, keep, explode, success = term
+            if sides < 1 or (explode and sides < 2):
+                raise ValueError('d{0} cannot be rolled{1}'.format(sides, ' with !' if explode else ''))
+            faces = range(1, sides + 1)
+            vals = random.choices(faces, k = count)
+
+            if explode:
+                pending = vals.count(sides)
+                while pending:
+                    budget -= pending
+                    if budget < 0:
+                        raise ValueError('too many dice (max {0})'.format(self.max_dice))
+                    if time.monotonic() > deadline:
+                        raise ValueError('roll took too long')
+                    more = random.choices(faces, k = pending)
+                    vals += more
+                    pending = more.count(sides)
+
+            kept = vals
+            if keep:
+                kept = sorted(vals, reverse = keep[0] == 'h')[:keep[1]]
+
+            if len(vals) <= listed:
+                listed -= len(vals)
+                detail = '(' + ', '.join(map(str, vals)) + ')'
+                if keep:
+                    detail += ' -> (' + ', '.join(map(str, kept)) + ')'
+            elif vals:
+                detail = self.summarize(vals)
+                if keep:
+                    detail += ' -> ' + self.summarize(kept)
+            else:
+                detail = '()'
+
+            if success is not None:
+                value = sum(1 for v in kept if v >= success)
+                detail += ' >= {0}, 成功 {1} 次'.format(success, value)
+            else:
+                value = sum(kept)
+
+            total += sign * value
+            parts.append(('-' if sign < 0 else '+') + detail)
+
+            if time.monotonic() > deadline:
+                raise ValueError('roll took too long')
+
+        # '+' of the first term is implied.
+        if parts[0][0] == '+':
+            parts[0] = parts[0][1:]
+
+        if len(terms) == 1 and terms[0][-1] is not None:
+            return '{0} : {1}'.format(canonical, parts[0])
+
+        return '{0} : {1} = {2}'.format(canonical, ' '.join(parts), total)
+
+
+def classify_error(ex):
+    """
+    Sort an exception raised around a Telegram call.
+
+    Returns:
+        'retry_after' for 429 responses, 'transient' for network trouble worth
+        retrying, otherwise 'fatal' (bad requests and bugs).
+    """
+    if isinstance(ex, telegram.error.RetryAfter):
+        return 'retry_after'
+    # BadRequest derives from NetworkError but never succeeds on retry.
+    if isinstance(ex, telegram.error.BadRequest):
+        return 'fatal'
+    if isinstance(ex, (telegram.error.NetworkError, CircuitOpen, http.client.HTTPException, OSError)):
+        return 'transient'
+    return 'fatal'
+
+
+class Backoff:
+    """
+    This object describes jittered exponential backoff.
+
+    The n-th delay is uniform in [d/2, d] with d = min(cap, base * 2^n).
+
+    Attributes:
+        attempts (int):
+            Failures since the last reset.
+    """
+
+    def __init__(self,
+                 base = 1.0,
+                 cap = 60.0):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    @staticmethod
+    def jittered(attempt,
+                 base,
+                 cap):
+        """Returns: delay in seconds before retry number attempt (from 0)."""
+        d = min(cap, base * 2 ** min(attempt, 30))
+        return d / 2 + random.uniform(0, d / 2)
+
+    def next(self):
+        """Returns: delay before the next retry."""
+        d = self.jittered(self.attempts, self.base, self.cap)
+        self.attempts += 1
+        return d
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling Telegram while CircuitBreaker is open."""
+
+    def __init__(self,
+                 wait):
+        super().__init__('circuit open for {0:.1f}s'.format(wait))
+        self.wait = wait
+
+
+class CircuitBreaker:
+    """
+    This object describes a circuit breaker around Telegram calls.
+
+    After threshold consecutive transient failures the circuit opens and calls
+    are held for reset_timeout seconds. Then calls may go again (half open):
+    a success closes the circuit, a failure opens it for another period.
+
+    Attributes:
+        failures (int):
+            Consecutive transient failures.
+        opened_at (Optional[float]):
+            time.monotonic() when the circuit last opened, None while closed.
+    """
+
+    def __init__(self,
+                 threshold = 5,
+                 reset_timeout = 30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def delay(self,
+              now):
+        """Returns: seconds until calls may go, 0 when they may go now."""
+        opened_at = self.opened_at
+        if opened_at is None:
+            return 0
+        return max(0, opened_at + self.reset_timeout - now)
+
+    def success(self):
+        if self.failures or self.opened_at is not None:
+            with self.lock:
+                self.failures = 0
+                self.opened_at = None
+
+    def failure(self,
+                now):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = now
+
+
+class SendDropped(Exception):
+    """Set on the future of a send the SendScheduler gave up on before sending."""
+
+
+class TokenBucket:
+    """
+    This object describes a token bucket for rate limiting.
+
+    Attributes:
+        rate (float):
+            Tokens refilled per second.
+        capacity (float):
+            Maximum tokens, i.e. burst size.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self,
+                 rate,
+                 capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def delay(self,
+              now,
+              n = 1):
+        """
+        Returns:
+            Seconds to wait until n tokens are available, 0 when available
+            now. More than capacity only waits for a full bucket; take then
+            leaves the rest as debt.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        need = min(n, self.capacity)
+        if self.tokens >= need:
+            return 0
+        return (need - self.tokens) / self.rate
+
+    def take(self,
+             n = 1):
+        """Consume n tokens."""
+        self.tokens -= n
+
+
+class SendScheduler:
+    """
+    This object describes the outbound queue for every Telegram send call.
+
+    Jobs are paced by a global token bucket and one bucket per chat, picked
+    from priority lanes (lower value first), round-robin among chats within a
+    lane. Each chat has at most one job in flight, so sends of a chat within
+    one lane leave in order. Across lanes of one chat, reordering is intended:
+    an admin reply overtakes auto responses still queued for that chat.
+    RetryAfter blocks the chat for retry_after seconds and requeues the job.
+    Transient errors requeue it too, after a jittered backoff, up to
+    max_attempts tries; while breaker is open nothing is sent.
+
+    Each chat holds at most max_queue jobs per lane. Droppable jobs (auto
+    responses by default) expire auto_max_age seconds after submit, and the
+    oldest of them makes room when the lane is full, so a keyword storm
+    never answers minutes late. A non-droppable job submitted to a full
+    lane is refused. Either way the future fails with SendDropped.
+
+    Attributes:
+        lanes (list):
+            One OrderedDict(chat_id -> deque of jobs) per priority.
+        global_bucket (TokenBucket):
+            Bucket shared by all chats.
+        chat_buckets (dict):
+            chat_id -> TokenBucket.
+        metrics (Optional[Metrics]):
+            Records every call as ('api', method name).
+        breaker (Optional[CircuitBreaker]):
+            Shared with the other Telegram calls of the bot.
+        dropped (int):
+            Jobs dropped as stale or over max_queue.
+    """
+
+    PRIO_ADM = 0
+    PRIO_NORMAL = 1
+    PRIO_AUTO = 2
+
+    def __init__(self,
+                 logger,
+                 global_rate = 30,
+                 group_per_min = 20,
+                 private_rate = 1,
+                 workers = 4,
+                 metrics = None,
+                 breaker = None,
+                 max_attempts = 3,
+                 max_queue = 100,
+                 auto_max_age = 30):
+        self.logger = logger
+        self.metrics = metrics
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.max_queue = max_queue
+        self.auto_max_age = auto_max_age
+        self.dropped = 0
+        self.group_rate = group_per_min / 60.0
+        self.group_burst = group_per_min
+        self.private_rate = private_rate
+
+        self.cond = threading.Condition()
+        self.lanes = [OrderedDict() for _ in range(self.PRIO_AUTO + 1)]
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = dict()
+        self.blocked_until = dict()
+        self.busy = set()
+
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.thread = threading.Thread(target = self.loop, name = 'SendScheduler', daemon = True)
+        self.thread.start()
+
+    def submit(self,
+               chat_id,
+               func,
+               kwargs,
+               priority = PRIO_NORMAL,
+               droppable = None,
+               cost = 1):
+        """
+        Queue one send call.
+
+        Args:
+            chat_id (int):
+                Target chat, used for per-chat pacing and ordering.
+            func (callable):
+                Bot method to call, e.g. bot.sendMessage.
+            kwargs (dict):
+                Keyword arguments of func.
+            priority (Optional[int]):
+                One of PRIO_ADM, PRIO_NORMAL, PRIO_AUTO.
+            droppable (Optional[bool]):
+                May expire or make room, see the class. Defaults to
+                priority == PRIO_AUTO.
+            cost (Optional[int]):
+                Messages the call sends, e.g. the photos of a media group;
+                that many tokens are taken from each bucket.
+        Returns:
+            concurrent.futures.Future of the call result.
+        """
+        if droppable is None:
+            droppable = priority == self.PRIO_AUTO
+        deadline = time.monotonic() + self.auto_max_age if droppable else None
+
+        fut = Future()
+        with self.cond:
+            jobs = self.lanes[priority].setdefault(chat_id, deque())
+            if len(jobs) >= self.max_queue:
+                oldest = next((job for job in jobs if job[5] is not None), None)
+                if oldest:
+                    jobs.remove(oldest)
+                    self.drop(chat_id, oldest, 'queue full')
+                else:
+                    self.drop(chat_id, (func, kwargs, fut, priority, 0, deadline, cost), 'queue full')
+                    return fut
+
+            jobs.append((func, kwargs, fut, priority, 0, deadline, cost))
+            self.cond.notify()
+        return fut
+
+    def drop(self,
+             chat_id,
+             job,
+             reason):
+        """Fail job with SendDropped."""
+        self.dropped += 1
+        self.logger.warning('dropping {0} to chat {1}: {2}'.format(job[0].__name__, chat_id, reason))
+        job[2].set_exception(SendDropped(reason))
+
+    def requeue(self,
+                chat_id,
+                job,
+                delay):
+        """Put job back at the head of its chat, blocking the chat for delay seconds."""
+        with self.cond:
+            self.blocked_until[chat_id] = time.monotonic() + delay
+            lane = self.lanes[job[3]]
+            lane.setdefault(chat_id, deque()).appendleft(job)
+            lane.move_to_end(chat_id, last = False)
+            self.busy.discard(chat_id)
+            self.cond.notify()
+
+    def pending(self):
+        """
+        Returns:
+            Number of queued jobs, not counting those in flight.
+        """
+        with self.cond:
+            return sum(len(jobs) for lane in self.lanes for jobs in lane.values())
+
+    def chat_bucket(self,
+                    chat_id):
+        """
+        Returns:
+            TokenBucket of chat_id, created on first use.
+        """
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # forget idle chats, their buckets are full anyway
+                now = time.monotonic()
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if v.delay(now) > 0 or v.tokens < v.capacity}
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, max(1, self.private_rate))
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def next_job(self,
+                 now):
+        """
+        Pick the next job that may be sent now. Must hold self.cond.
+
+        Returns:
+            Tuple of ((chat_id, job), 0) when a job is picked, otherwise
+            (None, seconds to wait) with None meaning wait for notify.
+        """
+        wait = self.global_bucket.delay(now)
+        if not wait and self.breaker:
+            wait = self.breaker.delay(now)
+        if wait:
+            return None, wait
+
+        wait = None
+        for lane in self.lanes:
+            for chat_id, jobs in list(lane.items()):
+                if chat_id in self.busy:
+                    continue
+
+                # Jobs are in submit order, so expired ones are at the head.
+                while jobs and jobs[0][5] is not None and jobs[0][5] < now:
+                    self.drop(chat_id, jobs.popleft(), 'stale')
+                if not jobs:
+                    del lane[chat_id]
+                    continue
+
+                cost = jobs[0][6]
+                bucket = self.chat_bucket(chat_id)
+                d = max(self.blocked_until.get(chat_id, 0) - now, bucket.delay(now, cost),
+                        self.global_bucket.delay(now, cost))
+                if d > 0:
+                    wait = d if wait is None else min(wait, d)
+                    continue
+
+                job = jobs.popleft()
+                if jobs:
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+
+                self.global_bucket.take(cost)
+                bucket.take(cost)
+                self.busy.add(chat_id)
+                return (chat_id, job), 0
+
+        return None, wait
+
+    def loop(self):
+        """Scheduler thread: hand ready jobs to the worker pool."""
+        while True:
+            with self.cond:
+                picked, wait = self.next_job(time.monotonic())
+                if not picked:
+                    self.cond.wait(wait)
+                    continue
+
+            self.executor.submit(self.run_job, *picked)
+
+    def run_job(self,
+                chat_id,
+                job):
+        """Worker: perform one send call and resolve its future."""
+        func, kwargs, fut, priority, attempts, deadline, cost = job
+        try:
+            if self.metrics:
+                with self.metrics.timer('api', func.__name__):
+                    res = func(**kwargs)
+            else:
+                res = func(**kwargs)
+        except Exception as ex:
+            kind = classify_error(ex)
+            if kind == 'retry_after':
+                self.logger.warning('RetryAfter {0}s for chat {1}'.format(ex.retry_after, chat_id))
+                self.requeue(chat_id, job, ex.retry_after)
+                return
+
+            if kind == 'transient':
+                if self.breaker:
+                    self.breaker.failure(time.monotonic())
+                # A timed out send may have arrived, do not send it twice.
+                if attempts + 1 < self.max_attempts and not isinstance(ex, telegram.error.TimedOut):
+                    delay = Backoff.jittered(attempts, 1.0, 30.0)
+                    self.logger.warning('send to chat {0} failed ({1}), retry in {2:.1f}s'.format(chat_id, ex, delay))
+                    self.requeue(chat_id, (func, kwargs, fut, priority, attempts + 1, deadline, cost), delay)
+                    return
+
+            self.logger.exception('send failed for chat {0}'.format(chat_id))
+            fut.set_exception(ex)
+        else:
+            if self.breaker:
+                self.breaker.success()
+            fut.set_result(res)
+
+        with self.cond:
+            self.busy.discard(chat_id)
+            self.blocked_until.pop(chat_id, None)
+            self.cond.notify()
+
+
+class UpdateRecorder:
+    """
+    This object describes an append-only capture of raw updates.
+
+    A file starts with MAGIC and a flags byte (FLAG_ZLIB). Each record is
+    struct '>dI' (receive time, payload length) followed by the payload: the
+    update as JSON, or with FLAG_ZLIB the next chunk of one deflate stream,
+    sync-flushed per record so every complete record is readable. A new file
+    is started once max_bytes is reached.
+
+    Attributes:
+        directory (str):
+            Where capture files are written, named updates-<time>.afxrec.
+        compress (bool):
+            Deflate records.
+        max_bytes (int):
+            Size to rotate at.
+    """
+
+    MAGIC = b'AFXREC1'
+    FLAG_ZLIB = 1
+    RECORD = struct.Struct('>dI')
+
+    def __init__(self,
+                 directory,
+                 compress = True,
+                 max_bytes = 64 << 20):
+        self.directory = directory
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = None
+        self.zobj = None
+        self.size = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def open_next(self):
+        """Close the current file and start a new one. Must hold self.lock."""
+        if self.file:
+            self.file.close()
+
+        name = os.path.join(self.directory, 'updates-{0}.afxrec'.format(datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        self.file = open(name, 'wb')
+        self.file.write(self.MAGIC + bytes([self.FLAG_ZLIB if self.compress else 0]))
+        self.zobj = zlib.compressobj() if self.compress else None
+        self.size = len(self.MAGIC) + 1
+
+    def record(self,
+               data,
+               received = None):
+        """
+        Append one update.
+
+        Args:
+            data (dict):
+                The update as Telegram sent it.
+            received (Optional[float]):
+                time.time() it arrived, now by default.
+        """
+        payload = json.dumps(data, ensure_ascii = False, separators = (',', ':')).encode('utf-8')
+        with self.lock:
+            if self.file is None or self.size >= self.max_bytes:
+                self.open_next()
+
+            if self.zobj:
+                payload = self.zobj.compress(payload) + self.zobj.flush(zlib.Z_SYNC_FLUSH)
+
+            self.file.write(self.RECORD.pack(received or time.time(), len(payload)))
+            self.file.write(payload)
+            self.size += self.RECORD.size + len(payload)
+
+    def flush(self):
+        """Push buffered records to the file."""
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    @classmethod
+    def read(cls,
+             file_name):
+        """
+        Read a capture file, stopping quietly at a truncated last record.
+
+        Returns:
+            Generator of (receive time, update dict).
+        """
+        with open(file_name, 'rb') as f:
+            header = f.read(len(cls.MAGIC) + 1)
+            if header[:len(cls.MAGIC)] != cls.MAGIC:
+                raise ValueError('{0} is not an update capture'.format(file_name))
+            zobj = zlib.decompressobj() if header[-1] & cls.FLAG_ZLIB else None
+
+            while True:
+                head = f.read(cls.RECORD.size)
+                if len(head) < cls.RECORD.size:
+                    return
+                received, length = cls.RECORD.unpack(head)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                if zobj:
+                    payload = zobj.decompress(payload)
+                yield received, json.loads(payload.decode('utf-8'))
+
+
+class WebhookServer:
+    """
+    This object describes a local HTTP receiver for webhook updates.
+
+    POSTed update JSON is deserialized into telegram.Update and queued for
+    the dispatcher. At most max_pending updates may be queued or in handling;
+    beyond that the server answers 503 so Telegram retries later.
+
+    Attributes:
+        updates (queue.Queue):
+            Received telegram.Update objects.
+        slots (threading.BoundedSemaphore):
+            Free capacity, released by done() after an update is handled.
+    """
+
+    def __init__(self,
+                 afx,
+                 listen = '127.0.0.1',
+                 port = 8443,
+                 path = '/webhook',
+                 secret = None,
+                 max_pending = 100):
+        self.afx = afx
+        self.path = path
+        self.secret = secret
+        self.updates = queue.Queue()
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle_post(self)
+
+            def log_message(self, fmt, *args):
+                server.afx.logger.debug('webhook: ' + fmt % args)
+
+        self.httpd = http.server.ThreadingHTTPServer((listen, port), Handler)
+        self.thread = None
+
+    def handle_post(self,
+                    req):
+        """Accept one POSTed update."""
+        if req.path != self.path:
+            req.send_error(404)
+            return
+
+        if self.secret and req.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            req.send_error(403)
+            return
+
+        if not self.slots.acquire(blocking = False):
+            # Handlers fell behind, let Telegram retry later.
+            req.send_response(503)
+            req.send_header('Retry-After', '1')
+            req.end_headers()
+            return
+
+        try:
+            length = int(req.headers.get('Content-Length', 0))
+            data = json.loads(req.rfile.read(length).decode('utf-8'))
+            update = telegram.Update.de_json(data, self.afx.bot)
+        except Exception:
+            self.slots.release()
+            self.afx.logger.exception('webhook: bad update')
+            req.send_error(400)
+            return
+
+        if self.afx.recorder:
+            self.afx.recorder.record(data)
+            self.afx.recorder.flush()
+
+        self.updates.put(update)
+        req.send_response(200)
+        req.end_headers()
+
+    def done(self):
+        """Mark one queued update as handled."""
+        self.slots.release()
+
+    def start(self):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target = self.httpd.serve_forever, name = 'WebhookServer', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class Metrics:
+    """
+    This object describes in-process counters, latency histograms and gauges.
+
+    Every series is keyed by (kind, name), e.g. ('api', 'sendMessage') or
+    ('handler', 'handle_response'), and counts calls, errors and latency.
+    Gauges are callables read at scrape time, so they cost nothing between scrapes.
 
     Attributes:
-        firsttime (datetime):
-        content (str):
-        responded (bool):
+        series (dict):
+            (kind, name) -> [calls, errors, latency sum, per-bucket counts].
+        gauges (OrderedDict):
+            Gauge name -> (help text, callable returning a number).
+    """
 
-        repeattimes (Optional[int]):
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = dict()
+        self.gauges = OrderedDict()
+
+    def record(self,
+               kind,
+               name,
+               seconds,
+               error = False):
+        """Count one call of (kind, name) taking seconds."""
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            s = self.series.get((kind, name))
+            if s is None:
+                s = self.series[(kind, name)] = [0, 0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+            s[0] += 1
+            if error:
+                s[1] += 1
+            s[2] += seconds
+            s[3][i] += 1
+
+    @contextmanager
+    def timer(self,
+              kind,
+              name):
+        """Record the block as one call of (kind, name); an exception counts as an error."""
+        t = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(kind, name, time.perf_counter() - t, True)
+            raise
+        self.record(kind, name, time.perf_counter() - t)
+
+    def timed(self,
+              kind,
+              name,
+              func):
+        """
+        Returns:
+            func wrapped to record every call as (kind, name).
+        """
+        record = self.record
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            t = perf_counter()
+            try:
+                res = func(*args, **kwargs)
+            except BaseException:
+                record(kind, name, perf_counter() - t, True)
+                raise
+            record(kind, name, perf_counter() - t)
+            return res
+        return wrapper
+
+    def gauge(self,
+              name,
+              help_text,
+              func):
+        """Register a gauge read by calling func at scrape time."""
+        self.gauges[name] = (help_text, func)
+
+    def render(self):
+        """
+        Returns:
+            All metrics in Prometheus text exposition format.
+        """
+        with self.lock:
+            snapshot = [(k, s[0], s[1], s[2], list(s[3])) for k, s in sorted(self.series.items())]
+
+        out = ['# HELP afx_calls_total Calls, by kind (update, handler, callback, db, api) and name.',
+               '# TYPE afx_calls_total counter']
+        for (kind, name), calls, errors, total, buckets in snapshot:
+            out.append('afx_calls_total{{kind="{0}",name="{1}"}} {2}'.format(kind, name, calls))
+
+        out += ['# HELP afx_errors_total Calls that raised.',
+                '# TYPE afx_errors_total counter']
+        for (kind, name), calls, errors, total, buckets in snapshot:
+            out.append('afx_errors_total{{kind="{0}",name="{1}"}} {2}'.format(kind, name, errors))
+
+        out += ['# HELP afx_latency_seconds Call latency.',
+                '# TYPE afx_latency_seconds histogram']
+        for (kind, name), calls, errors, total, buckets in snapshot:
+            labels = 'kind="{0}",name="{1}"'.format(kind, name)
+            acc = 0
+            for le, n in zip(self.BUCKETS, buckets):
+                acc += n
+                out.append('afx_latency_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, le, acc))
+            out.append('afx_latency_seconds_bucket{{{0},le="+Inf"}} {1}'.format(labels, calls))
+            out.append('afx_latency_seconds_sum{{{0}}} {1}'.format(labels, total))
+            out.append('afx_latency_seconds_count{{{0}}} {1}'.format(labels, calls))
+
+        for name, (help_text, func) in list(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            out += ['# HELP {0} {1}'.format(name, help_text),
+                    '# TYPE {0} gauge'.format(name),
+                    '{0} {1}'.format(name, value if value is not None else 'NaN')]
+
+        return '\n'.join(out) + '\n'
+
+
+class MeteredConnection(sqlite3.Connection):
+    """
+    This object describes a sqlite3 connection whose cursors record every
+    execute into metrics as ('db', first word of the statement).
+
+    Attributes:
+        metrics (Optional[Metrics]):
+            Where to record, nothing is recorded while None.
+    """
+
+    metrics = None
+
+    def cursor(self,
+               factory = None):
+        return super().cursor(factory or MeteredCursor)
+
+
+class MeteredCursor(sqlite3.Cursor):
+    """This object describes a cursor of MeteredConnection."""
+
+    def execute(self,
+                sql,
+                parameters = ()):
+        metrics = self.connection.metrics
+        if metrics is None:
+            return super().execute(sql, parameters)
+
+        with metrics.timer('db', sql.split(None, 1)[0].upper()):
+            return super().execute(sql, parameters)
+
+
+class MetricsServer:
+    """
+    This object describes a local HTTP endpoint serving Metrics.render() on GET.
+
+    Attributes:
+        metrics (Metrics):
+            Metrics to expose.
     """
 
     def __init__(self,
-                 firsttime,
-                 content,
-                 repeattimes=0):
-        self.firsttime = firsttime
-        self.content = content
+                 metrics,
+                 listen = '127.0.0.1',
+                 port = 9464,
+                 path = '/metrics'):
+        self.metrics = metrics
+        self.path = path
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle_get(self)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((listen, port), Handler)
+        self.thread = None
+
+    def handle_get(self,
+                   req):
+        """Answer one scrape."""
+        if req.path != self.path:
+            req.send_error(404)
+            return
 
-        self.responded = False
-        self.repeattimes = repeattimes
+        body = self.metrics.render().encode('utf-8')
+        req.send_response(200)
+        req.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        req.send_header('Content-Length', str(len(body)))
+        req.end_headers()
+        req.wfile.write(body)
+
+    def start(self):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target = self.httpd.serve_forever, name = 'MetricsServer', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ReadWriteLock:
+    """
+    This object describes a lock held by many readers or one writer.
+
+    A waiting writer keeps new readers out, so it is not starved. Not
+    reentrant: a reader must not take the lock again, nor ask for write.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.local = threading.local()
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        self.local.reading = True
+
+    def release_read(self):
+        self.local.reading = False
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def released(self):
+        """
+        Let go of the read side held by this thread, if any, until the block
+        ends, so a writer is not held up by a reader that is only waiting.
+        """
+        if not getattr(self.local, 'reading', False):
+            yield
+            return
+
+        self.release_read()
+        try:
+            yield
+        finally:
+            self.acquire_read()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class CommandRouter:
+    """
+    This object describes a dispatcher over a list of BotCallback.
+
+    Callbacks with a 'q_kw' prefix are kept in a character trie, so one walk
+    over the head of the message finds every matching prefix. Among the
+    matches, and the conditional callbacks, the first registered one wins,
+    just as scanning the list in order would.
+
+    Attributes:
+        callbacks (list):
+            BotCallback in registration order.
+        trie (dict):
+            char -> child node; key None holds the callback index ending there.
+        conds (list):
+            (index, BotCallback) without 'q_kw', in registration order.
+    """
+
+    def __init__(self,
+                 callbacks):
+        self.callbacks = list(callbacks)
+        self.trie = dict()
+        self.conds = []
+
+        for idx, bcb in enumerate(self.callbacks):
+            if 'q_kw' in bcb.strs:
+                node = self.trie
+                for ch in bcb.strs['q_kw']:
+                    node = node.setdefault(ch, dict())
+                node.setdefault(None, idx)
+            else:
+                self.conds.append((idx, bcb))
+
+    def match_prefix(self,
+                     text):
+        """
+        Returns:
+            Smallest index of callbacks whose q_kw prefixes text, or None.
+        """
+        best = None
+        node = self.trie
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            idx = node.get(None)
+            if idx is not None and (best is None or idx < best):
+                best = idx
+        return best
+
+    def execute(self,
+                update):
+        """
+        Run the first callback accepting update.
+
+        Returns:
+            True when a callback handled update, otherwise False.
+        """
+        best = self.match_prefix(update.message.text)
+
+        for idx, bcb in self.conds:
+            if best is not None and idx > best:
+                break
+            if bcb.execute(update):
+                return True
+
+        if best is not None:
+            return self.callbacks[best].run(update)
+
+        return False
+
+
+def migrate_search_index(c,
+                         logger,
+                         tables):
+    """
+    resp_db migration: FTS5 indexes for /adm search. They are external
+    content tables kept in sync by triggers, so every writer of resp_db
+    updates them. trigram is preferred for CJK text, which has no spaces
+    between words, unicode61 is the fallback. Without FTS5 nothing is
+    created and search_resp uses LIKE.
+
+    Indexes built before this migration are kept; their triggers are
+    recreated, so the update triggers only fire on indexed columns.
+
+    Args:
+        c (sqlite3.Cursor):
+            Cursor inside the migration transaction.
+        logger (logging.Logger):
+            Where to report missing FTS5 support.
+        tables (list):
+            (table, FTS5 index, indexed columns) tuples.
+    """
+    for table, fts, cols in tables:
+        if not c.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (fts, )).fetchone():
+            for tokenizer in ['trigram', 'unicode61']:
+                try:
+                    c.execute("CREATE VIRTUAL TABLE {0} USING fts5({1}, content='{2}', content_rowid='IIDX', tokenize='{3}')"
+                              .format(fts, ', '.join(cols), table, tokenizer))
+                    break
+                except sqlite3.OperationalError as e:
+                    if 'no such module' in str(e):
+                        logger.warning('FTS5 unavailable, /adm search uses LIKE: {0}'.format(e))
+                        return
+                    if 'no such tokenizer' not in str(e):
+                        raise
+                    logger.warning('FTS5 {0} tokenizer unavailable: {1}'.format(tokenizer, e))
+            else:
+                return
+            c.execute("INSERT INTO {0} ({0}) VALUES ('rebuild')".format(fts))
+
+        new = ', '.join('new.' + col for col in cols)
+        old = ', '.join('old.' + col for col in cols)
+        ins = 'INSERT INTO {0} (rowid, {1}) VALUES (new.IIDX, {2});'.format(fts, ', '.join(cols), new)
+        dels = "INSERT INTO {0} ({0}, rowid, {1}) VALUES ('delete', old.IIDX, {2});".format(fts, ', '.join(cols), old)
+
+        for kind in ['insert', 'delete', 'update']:
+            c.execute('DROP TRIGGER IF EXISTS {0}_{1}'.format(fts, kind))
+        c.execute('CREATE TRIGGER {0}_insert AFTER INSERT ON {1} BEGIN {2} END'.format(fts, table, ins))
+        c.execute('CREATE TRIGGER {0}_delete AFTER DELETE ON {1} BEGIN {2} END'.format(fts, table, dels))
+        c.execute('CREATE TRIGGER {0}_update AFTER UPDATE OF {1} ON {2} BEGIN {3} {4} END'
+                  .format(fts, ', '.join(cols), table, dels, ins))
 
 
 class AFXBot:
@@ -69,20 +2040,94 @@ class AFXBot:
     Arguments:
     conf_file_name (Optional[str]):
         Name of configuration file.
+    bot (Optional[telegram.Bot]):
+        Bot to use instead of one built from config['bot_token'], e.g. a local stand-in.
     """
 
+    # Role bits in self.acl, compiled from config lists.
+    ROLE_ADM = 1                    # adm_ids
+    ROLE_OPERATIONAL = 2            # operational_chats
+    ROLE_RESTRICTED = 4             # restricted_chats
+    ROLE_MOTD_ONLY = 8              # motd_only_chats
+    ROLE_INVASIVE_WASHSNAKE = 16    # invasive_washsnake_chats
+
+    AUTH_OPERATIONAL = ROLE_ADM | ROLE_OPERATIONAL
+    AUTH_AUGMENTED = AUTH_OPERATIONAL | ROLE_RESTRICTED | ROLE_MOTD_ONLY
+
+    # Max chats remembered as already answered for __FOR_RECOGNITION__.
+    RECOGNITION_LIST_MAX = 10000
+
+    # Strings the bot cannot run without; a strings file missing any is rejected.
+    REQUIRED_STRS = ['a_reload_kwlist_kw', 'ar_reload_kwlist_ok', 'ar_reload_kwlist_ng',
+                     'q_motd_kws', 'q_status_kw', 'qr_status_t', 'qr_status_f',
+                     'r_wash_snake_strs', 'r_invasive_wash_snake_strs',
+                     'r_motd_no', 'r_motd_ok', 'r_motd_old', 'r_motd_updated', 'r_roll_cmd_help',
+                     's_status_t_kw', 'sr_status_t_ok', 's_status_f_kw', 'sr_status_f_ok', 'sr_status_f_ng',
+                     's_imgupload_t_kw', 'sr_imgupload_t_ok', 'sr_imgupload_t_ng',
+                     's_imgupload_f_kw', 'sr_imgupload_f_ok', 'sr_imgupload_f_ng',
+                     'v_photo_bulkupload', 'vr_photo_bulkupload_no_file', 'x_fortune_salt_str']
+
+    # Config entries read only at startup; changing them needs a restart.
+    RESTART_CONFIG_KEYS = ['bot_token', 'resp_db', 'motd_db', 'update_mode', 'runner',
+                           'webhook_listen', 'webhook_port', 'webhook_path', 'webhook_secret', 'webhook_url',
+                           'metrics_listen', 'metrics_port', 'metrics_path',
+                           'send_rate_global', 'send_rate_group_per_min', 'send_rate_private', 'send_workers',
+                           'breaker_threshold', 'breaker_reset_timeout', 'async_workers']
+
+    # Lowercase username, commands may be addressed as '/cmd@afx_bot'.
+    BOT_USERNAME = 'afx_bot'
+
+    # /roll X[-Y]
+    ROLL_RANGE_RE = re.compile('([0-9]+)(-([0-9]+))?')
+
+    # (table, FTS5 index, indexed columns) for /adm search, see migrate_search_index.
+    RESP_FTS_TABLES = [('resp', 'resp_fts', ['keyword', 'cont']),
+                       ('resp_get', 'resp_get_fts', ['keyword', 'tag'])]
+
+    # Schema changes of resp_db; entry i upgrades user_version i to i + 1.
+    # An entry is a list of statements, or a function of the cursor and logger.
+    # Append only, never edit an entry that has shipped.
+    RESP_DB_MIGRATIONS = [
+        # 1: bulk upload cache, and indexes for the keyword lookups.
+        ['CREATE TABLE IF NOT EXISTS photo_cache (hash TEXT PRIMARY KEY, file_id TEXT NOT NULL, name TEXT)',
+         'CREATE INDEX IF NOT EXISTS resp_keyword ON resp (keyword, cont)',
+         'CREATE INDEX IF NOT EXISTS resp_get_keyword_tag ON resp_get (keyword, tag, cont)',
+         'CREATE INDEX IF NOT EXISTS symptom_before ON symptom (before, after)',
+         'CREATE INDEX IF NOT EXISTS symptom_get_before ON symptom_get (before, after)',
+         'ANALYZE'],
+        # 2: small key/value state, e.g. the update offset checkpoint.
+        ['CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value)'],
+        # 3: resp_version counts writes to the response tables, so other processes can tell.
+        ["INSERT OR IGNORE INTO bot_state (key, value) VALUES ('resp_version', 0)"] +
+        ["CREATE TRIGGER IF NOT EXISTS {0}_{1}_version AFTER {1} ON {0} "
+         "BEGIN UPDATE bot_state SET value = value + 1 WHERE key = 'resp_version'; END".format(t, op)
+         for t in ['resp', 'resp_get', 'symptom', 'symptom_get'] for op in ['INSERT', 'UPDATE', 'DELETE']],
+        # 4: relative pick weight of every response and picture.
+        ['ALTER TABLE resp ADD COLUMN weight REAL NOT NULL DEFAULT 1',
+         'ALTER TABLE resp_get ADD COLUMN weight REAL NOT NULL DEFAULT 1'],
+        # 5: full-text search indexes.
+        functools.partial(migrate_search_index, tables = RESP_FTS_TABLES),
+    ]
+
     def __init__(self,
                  conf_file_name = None,
                  **kwargs):
         # Base. ;)
         self.LAST_UPDATE_ID = None
         self.NOW_HANDLING_UPDATE_ID = None
+        self.saved_offset = None
         self.logger = logging.getLogger()
         self.bot = None
         self.motds = None
         self.config = None
+        self.acl = dict()
         self.strs = None
 
+        # Handlers read config/strs/acl/callbacks under read, hot reload swaps them under write.
+        self.reload_lock = ReadWriteLock()
+        self.conf_file_name = None
+        self.config_mtimes = None
+
         # Keyword and Symptom lists.
         self.kw_list = None
         self.kw_list_get = None
@@ -93,12 +2138,74 @@ class AFXBot:
         self.unified_kw_list = None
         self.unified_get_list = None
 
-        # Bot state
+        # Aho-Corasick automaton over unified_kw_list.
+        self.kw_automaton = None
+
+        # (chat_id, table, keyword) -> (last use, deque of recently picked IIDX),
+        # least recently used first, see recent_picks.
+        self.recent = OrderedDict()
+
+        # chat_id -> listing cursor of ls_kw/ls_get/search, least recently
+        # used first, see send_listing. Changes under state_lock.
+        self.ls_cursors = OrderedDict()
+
+        # Connection to config['resp_db'], opened by init_resp.
+        self.resp_db = None
+
+        # FTS5 tokenizer of the search index, None when searching falls back to LIKE.
+        self.search_tokenizer = None
+
+        # (index, count) in a shard worker process, None otherwise.
+        self.shard = kwargs.get('shard')
+
+        # Last seen PRAGMA data_version and bot_state resp_version, see sync_shared_state.
+        self.resp_data_version = None
+        self.resp_version = None
+
+        # In-memory copy of resp/resp_get.
+        self.resp_store = ResponseStore()
+
+        # Guards resp_db and everything derived from it when handlers run concurrently.
+        self.resp_lock = threading.RLock()
+
+        # Outbound queue, and per-thread default send priority.
+        self.sender = None
+
+        # Shared by every Telegram call, created once config is loaded.
+        self.tg_breaker = None
+        self.send_ctx = threading.local()
+
+        # Local receiver in webhook mode.
+        self.webhook_server = None
+
+        # Capture of received updates, when config['record_dir'] is set.
+        self.recorder = None
+
+        # Runtime metrics, and the optional endpoint serving them.
+        self.metrics = Metrics()
+        self.metrics_server = None
+
+        # Fetched updates not handled yet, and the newest update_id seen.
+        self.pending_updates = 0
+        self.newest_update_id = None
+
+        # Command tables, filled by register_callbacks.
+        self.cmd_table = dict()
+        self.adm_cmd_table = dict()
+
+        # Bot state. Handlers may run on several threads (async runner), so
+        # these, recognition_list and bulk_upload_thread change under
+        # state_lock. LAST_UPDATE_ID and NOW_HANDLING_UPDATE_ID belong to
+        # the thread receiving updates only.
+        self.state_lock = threading.Lock()
         self.is_running = True
         self.is_accepting_photos = False
 
-        # For wash snake
-        self.wash_record = dict()
+        # Background thread of the running bulk photo upload, if any.
+        self.bulk_upload_thread = None
+
+        # For wash snake, created once config is loaded.
+        self.wash_record = None
 
         # Hardcoded fortune...
         self.fortune_strs = ['大凶', '凶', '平', '小吉', '大吉']
@@ -117,7 +2224,7 @@ class AFXBot:
         arg_parser = argparse.ArgumentParser(description = 'AFX_bot, a simple Telegram bot in Python.')
         arg_parser.add_argument('-l', '--logfile', help='Logfile Name', action='store_true')
 
-        args = arg_parser.parse_args()
+        args, _ = arg_parser.parse_known_args()
 
         if args.logfile:
             logging.basicConfig( level=logging.DEBUG, format=self.log_fmt_str, filename=args.logfile)
@@ -127,16 +2234,116 @@ class AFXBot:
         self.logger = logging.getLogger('AFX_bot')
         self.logger.setLevel(logging.DEBUG)
 
+        # Category -> fraction of hot path records kept, see log_enabled.
+        self.log_sampling = dict()
+
         self.init_configuration(conf_file_name)
+        self.init_logging()
         self.init_l10n_strings()
         self.init_motd()
 
+        self.wash_record = WashSnakeTable(ttl = 60,
+                                          max_entries = self.config.get('washsnake_max_entries', 50000))
+
+        self.dice = DiceRoller(max_dice = self.config.get('roll_max_dice', 100000),
+                               list_max = self.config.get('roll_list_max', 100),
+                               time_limit = self.config.get('roll_time_limit', 1.0))
+
+        self.tg_breaker = CircuitBreaker(threshold = self.config.get('breaker_threshold', 5),
+                                         reset_timeout = self.config.get('breaker_reset_timeout', 30))
+
         # Telegram Bot Authorization Token
-        self.bot = telegram.Bot(self.config['bot_token'])
+        self.bot = kwargs.get('bot') or telegram.Bot(self.config['bot_token'])
+        # Shard workers split the global send rate.
+        shard_count = self.shard[1] if self.shard else 1
+        self.sender = SendScheduler(self.logger,
+                                    global_rate = self.config.get('send_rate_global', 30) / shard_count,
+                                    group_per_min = self.config.get('send_rate_group_per_min', 20),
+                                    private_rate = self.config.get('send_rate_private', 1),
+                                    workers = self.config.get('send_workers', 4),
+                                    metrics = self.metrics,
+                                    breaker = self.tg_breaker,
+                                    max_attempts = self.config.get('send_max_attempts', 3),
+                                    max_queue = self.config.get('send_max_queue', 100),
+                                    auto_max_age = self.config.get('send_auto_max_age', 30))
 
         self.register_callbacks()
+        self.init_metrics()
+
+        if self.config.get('record_dir') and not self.shard:
+            self.recorder = UpdateRecorder(self.config['record_dir'],
+                                           compress = self.config.get('record_compress', True),
+                                           max_bytes = self.config.get('record_max_bytes', 64 << 20))
+            atexit.register(self.recorder.close)
 
-        self.recognition_list = []
+        self.config_mtimes = self.get_config_mtimes()
+        if self.config.get('reload_interval', 5):
+            threading.Thread(target = self.watch_configuration, name = 'ConfigWatcher', daemon = True).start()
+
+        self.recognition_list = set()
+
+    def init_metrics(self):
+        """
+        Time the hot handlers, register gauges, and start the endpoint when
+        self.config['metrics_port'] is set.
+        """
+        self.handle_update = self.metrics.timed('update', 'handle_update', self.handle_update)
+        for name in ['handle_response', 'handle_washsnake', 'handle_motd']:
+            setattr(self, name, self.metrics.timed('handler', name, getattr(self, name)))
+
+        self.metrics.gauge('afx_update_backlog',
+                           'Updates received but not handled yet.',
+                           self.get_update_backlog)
+        self.metrics.gauge('afx_last_update_id',
+                           'Offset requested from getUpdates next.',
+                           lambda: self.LAST_UPDATE_ID)
+        self.metrics.gauge('afx_update_id_lag',
+                           'Newest update_id seen minus the offset acknowledged.',
+                           self.get_update_id_lag)
+        self.metrics.gauge('afx_send_queue',
+                           'Send calls waiting in SendScheduler.',
+                           self.sender.pending)
+        self.metrics.gauge('afx_send_dropped',
+                           'Send calls dropped as stale or over the per-chat queue limit.',
+                           lambda: self.sender.dropped)
+        self.metrics.gauge('afx_telegram_circuit_open',
+                           '1 while Telegram calls are held by the circuit breaker.',
+                           lambda: int(self.tg_breaker.opened_at is not None))
+        self.metrics.gauge('afx_is_running',
+                           '1 when the bot answers, 0 when disabled by an admin.',
+                           lambda: int(self.is_running))
+
+        if self.config.get('metrics_port'):
+            # Shard worker i serves on metrics_port + 1 + i.
+            port = self.config['metrics_port'] + (1 + self.shard[0] if self.shard else 0)
+            self.metrics_server = MetricsServer(self.metrics,
+                                                listen = self.config.get('metrics_listen', '127.0.0.1'),
+                                                port = port,
+                                                path = self.config.get('metrics_path', '/metrics'))
+            self.metrics_server.start()
+            self.logger.info('metrics on {0}'.format(self.metrics_server.httpd.server_address))
+
+    def get_update_backlog(self):
+        """
+        Returns:
+            Number of updates fetched or received but not handled yet.
+        """
+        backlog = self.pending_updates
+        if self.webhook_server:
+            backlog += self.webhook_server.updates.qsize()
+        for q in list(getattr(self, 'chat_queues', dict()).values()):
+            backlog += q.qsize()
+        return backlog
+
+    def get_update_id_lag(self):
+        """
+        Returns:
+            Newest update_id seen minus the offset acknowledged, 0 until the
+            first update arrives.
+        """
+        if self.newest_update_id is None or self.LAST_UPDATE_ID is None:
+            return 0
+        return self.newest_update_id + 1 - self.LAST_UPDATE_ID
 
     def init_hanbao_pet_properties(self, 
 	                               file_name = None):
@@ -175,20 +2382,11 @@ class AFXBot:
         # Load Configuration
         if not file_name:
             file_name = 'config.json'
+        self.conf_file_name = file_name
 
         try:
-            with open(file_name, 'r', encoding = 'utf8') as f:
-                self.config = json.loads(f.read())
-
-            # Check Configuration
-            configs_check = ['bot_token', 'resp_db', 'adm_ids', 'operational_chats', 'strings_json']
-            for c in configs_check:
-                self.check_config_entry(c)
-
-            list_configs_check = ['restricted_chats', 'motd_only_chats', 'invasive_washsnake_chats']
-            for c in list_configs_check:
-                self.check_config_entry_of_list(c)
-
+            self.config = self.load_config(file_name)
+            self.acl = self.build_acl(self.config)
             self.init_resp()
         except FileNotFoundError:
             logging.exception('config file not found!')
@@ -199,6 +2397,97 @@ class AFXBot:
         except:
             raise
 
+    def init_logging(self):
+        """
+        Apply logging settings of self.config:
+            log_level: level of the bot and the root logger, DEBUG by default.
+            log_json: write records as JSON lines.
+            log_async: hand records to a QueueListener thread that formats and writes them.
+            log_sampling: category -> fraction of hot path records to keep, e.g. {"update": 0.01}.
+        """
+        level = logging.getLevelName(str(self.config.get('log_level', 'DEBUG')).upper())
+        if not isinstance(level, int):
+            level = logging.DEBUG
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        self.logger.setLevel(level)
+        self.log_sampling = dict(self.config.get('log_sampling', dict()))
+
+        if any(isinstance(h, LogQueueHandler) for h in root.handlers):
+            return
+
+        handlers = list(root.handlers)
+        if self.config.get('log_json'):
+            for h in handlers:
+                h.setFormatter(JsonLogFormatter())
+
+        if self.config.get('log_async') and handlers:
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level = True)
+            for h in handlers:
+                root.removeHandler(h)
+            root.addHandler(LogQueueHandler(log_queue))
+            listener.start()
+            atexit.register(listener.stop)
+
+    def log_enabled(self,
+                    category,
+                    level = logging.DEBUG):
+        """
+        Guard for hot path logging, checked before any message is built.
+
+        Returns:
+            True when level is enabled and the record survives sampling of category.
+        """
+        if not self.logger.isEnabledFor(level):
+            return False
+        rate = self.log_sampling.get(category)
+        return rate is None or rate >= 1 or random.random() < rate
+
+    def load_config(self,
+                    file_name):
+        """
+        Read and check a configuration file.
+
+        Returns:
+            The configuration dict.
+        Raises:
+            FileNotFoundError, ValueError: when the file is missing or not sane.
+        """
+        with open(file_name, 'r', encoding = 'utf8') as f:
+            config = json.loads(f.read())
+
+        # Check Configuration
+        configs_check = ['bot_token', 'resp_db', 'adm_ids', 'operational_chats', 'strings_json']
+        for c in configs_check:
+            self.check_config_entry(c, config)
+
+        list_configs_check = ['restricted_chats', 'motd_only_chats', 'invasive_washsnake_chats']
+        for c in list_configs_check:
+            self.check_config_entry_of_list(c, config)
+
+        return config
+
+    def load_strings(self,
+                     file_name):
+        """
+        Read and check a L10N strings file.
+
+        Returns:
+            The strings dict.
+        Raises:
+            FileNotFoundError, ValueError: when the file is missing or lacks REQUIRED_STRS.
+        """
+        with open(file_name, 'r', encoding = 'utf8') as f:
+            strs = json.loads(f.read())
+
+        missing = [k for k in self.REQUIRED_STRS if k not in strs]
+        if missing:
+            raise ValueError('strings missing: ' + ', '.join(missing))
+
+        return strs
+
     def init_l10n_strings(self,
                           file_name = None):
         """
@@ -215,97 +2504,497 @@ class AFXBot:
                 raise Exception('L10N file not specified in neither config nor argument!')
 
         try:
-            with open(self.config['strings_json'], 'r', encoding = 'utf8') as f:
-                self.strs = json.loads(f.read())
-                self.wash_snake_strs_unified = self.strs['r_wash_snake_strs'] + self.strs['r_invasive_wash_snake_strs']
+            self.strs = self.load_strings(file_name)
+            self.wash_snake_strs_unified = self.strs['r_wash_snake_strs'] + self.strs['r_invasive_wash_snake_strs']
         except:
             logging.exception('L10N Strings read error!')
             raise
 
     def init_motd(self,
-                  file_name = 'motd.json'):
+                  file_name = None):
         """
         Initialize MotD.
 
         Arguments:
             file_name (Optional[str]):
-                Name of MotD file.
+                Name of MotD database, self.config['motd_db'] or 'motd.sqlite' by default.
         """
-        # Load MotD
-        try:
-            with open(file_name, 'r', encoding = 'utf8') as f:
-                self.motds = json.loads(f.read())
+        if not file_name:
+            file_name = self.config.get('motd_db', 'motd.sqlite')
 
-            # str -> datetime
-            for k in self.motds.keys():
-                self.motds[k]['date'] = datetime.strptime(self.motds[k]['date'], '%Y-%m-%d').date()
+        self.motd_store = MotdStore(self.logger, file_name, self.config.get('motd_flush_delay', 1.0))
 
-        except FileNotFoundError:
-            logging.exception('MOTD file not found!')
+        # Load MotD, importing motd.json of older versions once.
+        try:
+            self.motd_store.migrate_json('motd.json')
         except ValueError:
             logging.exception('MOTD read error!')
-        except:
-            raise
 
-        if not self.motds:
-            self.motds = dict()
+        self.motd_store.load()
+        self.motds = self.motd_store.current
+        atexit.register(self.motd_store.flush)
+
+    @classmethod
+    def build_acl(cls,
+                  config):
+        """
+        Compile the id lists in config into one id -> role bitmask table.
+
+        Args:
+            config (dict):
+                Loaded configuration.
+        Returns:
+            dict of id -> bitwise OR of ROLE_* bits.
+        """
+        acl = dict()
+        for name, role in (('adm_ids', cls.ROLE_ADM),
+                           ('operational_chats', cls.ROLE_OPERATIONAL),
+                           ('restricted_chats', cls.ROLE_RESTRICTED),
+                           ('motd_only_chats', cls.ROLE_MOTD_ONLY),
+                           ('invasive_washsnake_chats', cls.ROLE_INVASIVE_WASHSNAKE)):
+            for id in config.get(name) or []:
+                acl[int(id)] = acl.get(int(id), 0) | role
+        return acl
+
+    def get_roles(self,
+                  id):
+        """
+        Returns:
+            Role bitmask of id, 0 when unknown.
+        """
+        return self.acl.get(id, 0)
 
     def check_config_entry(self,
-                           name):
+                           name,
+                           config = None):
+        """
+        Check whether the config, self.config by default, is sane.
+        """
+        if config is None:
+            config = self.config
+
+        if not config.get(name):
+            logging.error('config[\'{0}\'] is missing!'.format(name))
+            raise ValueError('config[\'{0}\'] is missing!'.format(name))
+
+    def check_config_entry_of_list(self,
+                                   name,
+                                   config = None):
+        """
+        Check whether the list in config, self.config by default, is sane, or init a empty one.
+        """
+        if config is None:
+            config = self.config
+
+        if not config.get(name):
+            config[name] = []
+
+    def get_config_mtimes(self):
+        """
+        Returns:
+            Modification times of the config and strings files, None for a missing one.
+        """
+        mtimes = []
+        for file_name in [self.conf_file_name, self.config['strings_json']]:
+            try:
+                mtimes.append(os.stat(file_name).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def watch_configuration(self):
+        """
+        Watcher thread: reload when the config or strings file changes.
+        """
+        while True:
+            time.sleep(self.config.get('reload_interval', 5) or 5)
+            if self.get_config_mtimes() != self.config_mtimes:
+                self.reload_and_report()
+
+    def reload_configuration(self):
+        """
+        Load config and strings again, then swap them in, together with the
+        ACL and callback tables built from them, while no handler runs.
+        Handlers hold reload_lock only while running, not while waiting on
+        sends (see wait_sent), so this is not held up by the rate limiter.
+        Files are read and checked before; if they are not sane nothing changes.
+
+        Returns:
+            Changed RESTART_CONFIG_KEYS, which only take effect after a restart.
+        """
+        # Taken first, so an edit during the reload is seen next time.
+        self.config_mtimes = self.get_config_mtimes()
+
+        config = self.load_config(self.conf_file_name)
+        strs = self.load_strings(config['strings_json'])
+        acl = self.build_acl(config)
+        dice = DiceRoller(max_dice = config.get('roll_max_dice', 100000),
+                          list_max = config.get('roll_list_max', 100),
+                          time_limit = config.get('roll_time_limit', 1.0))
+        restart = [k for k in self.RESTART_CONFIG_KEYS if config.get(k) != self.config.get(k)]
+
+        with self.reload_lock.write():
+            self.config = config
+            self.strs = strs
+            self.wash_snake_strs_unified = strs['r_wash_snake_strs'] + strs['r_invasive_wash_snake_strs']
+            self.acl = acl
+            self.dice = dice
+            self.wash_record.max_entries = config.get('washsnake_max_entries', 50000)
+            self.register_callbacks()
+            self.init_logging()
+
+        return restart
+
+    def reload_and_report(self,
+                          chat_id = None,
+                          mesg_id = None):
+        """
+        Run reload_configuration, logging the outcome and replying to chat_id if given.
+        """
+        try:
+            restart = self.reload_configuration()
+        except Exception as ex:
+            self.logger.exception('config reload failed, keeping the current one')
+            text = 'reload failed: {0}'.format(ex)
+        else:
+            text = 'config reloaded.'
+            if restart:
+                text += ' restart needed for: ' + ', '.join(restart)
+            self.logger.info(text)
+
+        if chat_id is not None:
+            self.send_generic_mesg(chat_id, text, mesg_id, SendScheduler.PRIO_ADM)
+
+    def run(self):
+        """
+        Run the bot: start the loop to fetch updates and handle.
+        """
+        if self.config.get('update_mode') == 'webhook':
+            return self.run_webhook()
+
+        self.restore_offset()
+        backoff = Backoff(self.config.get('retry_base', 1.0), self.config.get('retry_cap', 60.0))
+
+        while True:
+            # LAST_UPDATE_ID only moves past handled updates, so after any
+            # failure the same offset is simply polled again.
+            try:
+                self.get_mesg()
+                backoff.reset()
+            except KeyboardInterrupt:
+                exit()
+            except Exception as ex:
+                time.sleep(self.retry_delay(ex, backoff))
+
+    def run_sharded(self):
+        """
+        Run the bot as supervisor of self.config['shard_workers'] worker
+        processes (one per core by default). This process only receives
+        updates, by polling or webhook, and routes each to worker
+        chat_id % count, so a chat is always handled by the same worker, in order.
+        Polling and the offset checkpoint stay at the oldest update not
+        acknowledged by a worker, so Telegram keeps it until then.
+        """
+        count = self.config.get('shard_workers') or os.cpu_count() or 1
+        ctx = multiprocessing.get_context('spawn')
+        acks = ctx.Queue()
+        queues = [ctx.Queue() for _ in range(count)]
+        workers = [None] * count
+
+        def start(i):
+            workers[i] = ctx.Process(target = shard_worker_main,
+                                     args = (self.conf_file_name, i, count, queues[i], acks),
+                                     name = 'AFXShard-{0}'.format(i), daemon = True)
+            workers[i].start()
+
+        for i in range(count):
+            start(i)
+
+        # update_id -> shard, for updates routed but not acknowledged yet.
+        inflight = dict()
+
+        server = None
+        if self.config.get('update_mode') == 'webhook':
+            server = self.start_webhook()
+        else:
+            self.restore_offset()
+        backoff = Backoff(self.config.get('retry_base', 1.0), self.config.get('retry_cap', 60.0))
+
+        try:
+            while True:
+                while True:
+                    try:
+                        update_id = acks.get_nowait()
+                    except queue.Empty:
+                        break
+                    inflight.pop(update_id, None)
+                    if server:
+                        server.done()
+
+                for i, p in enumerate(workers):
+                    if not p.is_alive():
+                        lost = [u for u, shard in inflight.items() if shard == i]
+                        self.logger.error('shard {0} exited ({1}), restarting; updates maybe lost: {2}'.format(i, p.exitcode, lost))
+                        for u in lost:
+                            del inflight[u]
+                            if server:
+                                server.done()
+                        start(i)
+
+                if server:
+                    try:
+                        updates = [server.updates.get(timeout = 0.5)]
+                    except queue.Empty:
+                        updates = []
+                else:
+                    # Poll from the oldest unacknowledged update, see async_main.
+                    try:
+                        updates = self.fetch_updates(min(inflight, default = self.LAST_UPDATE_ID))
+                        backoff.reset()
+                    except Exception as ex:
+                        time.sleep(self.retry_delay(ex, backoff))
+                        continue
+
+                fresh = [u for u in updates if server or self.is_new_update(u)]
+                for update in fresh:
+                    self.newest_update_id = update.update_id
+                    self.LAST_UPDATE_ID = update.update_id + 1
+                    if self.is_stale_update(update):
+                        self.logger.info('skipping stale update {0}'.format(update.update_id))
+                        if server:
+                            server.done()
+                        continue
+
+                    i = self.shard_of(update, count)
+                    inflight[update.update_id] = i
+                    queues[i].put(update.to_dict())
+
+                self.pending_updates = len(inflight)
+                if not server:
+                    offset = min(inflight, default = self.LAST_UPDATE_ID)
+                    if offset != self.saved_offset:
+                        self.save_offset(offset)
+                    if updates and not fresh:
+                        time.sleep(self.config.get('inflight_poll_interval', 0.5))
+        except KeyboardInterrupt:
+            for q in queues:
+                q.put(None)
+            exit()
+
+    @staticmethod
+    def shard_of(update,
+                 count):
+        """
+        Returns:
+            Index of the shard worker, out of count, handling update: all
+            updates of a chat go to one worker, updates without a message to 0.
+        """
+        return (update.message.chat_id if update.message else 0) % count
+
+    def run_shard(self,
+                  updates,
+                  acks):
+        """
+        Run the bot as a shard worker: handle updates routed by run_sharded.
+
+        Args:
+            updates (multiprocessing.Queue):
+                Update dicts for this shard, None to stop.
+            acks (multiprocessing.Queue):
+                update_id of every handled update goes back here.
+        """
+        while True:
+            raw = updates.get()
+            if raw is None:
+                return
+
+            update = telegram.Update.de_json(raw, self.bot)
+            self.sync_shared_state()
+            self.NOW_HANDLING_UPDATE_ID = update.update_id
+            self.handle_update_retrying(update)
+            self.LAST_UPDATE_ID = update.update_id + 1
+            acks.put(update.update_id)
+
+    def retry_delay(self,
+                    ex,
+                    backoff):
+        """
+        Log ex by its class.
+
+        Returns:
+            Seconds to wait before polling again.
+        """
+        kind = classify_error(ex)
+        if kind == 'retry_after':
+            self.logger.warning('getUpdates: RetryAfter {0}s'.format(ex.retry_after))
+            return ex.retry_after
+
+        if isinstance(ex, CircuitOpen):
+            self.logger.warning('getUpdates: {0}'.format(ex))
+            return ex.wait
+
+        delay = backoff.next()
+        if kind == 'transient':
+            self.logger.warning('getUpdates: {0!r}, retry in {1:.1f}s'.format(ex, delay))
+        else:
+            self.logger.exception('!!! EXCEPTION HAS OCCURRED !!! retry in {0:.1f}s'.format(delay))
+        return delay
+
+    def start_webhook(self):
+        """
+        Start the local webhook receiver, and register webhook_url if configured.
+
+        Returns:
+            The started WebhookServer.
+        """
+        self.webhook_server = WebhookServer(self,
+                                            listen = self.config.get('webhook_listen', '127.0.0.1'),
+                                            port = self.config.get('webhook_port', 8443),
+                                            path = self.config.get('webhook_path', '/webhook'),
+                                            secret = self.config.get('webhook_secret'),
+                                            max_pending = self.config.get('webhook_max_pending', 100))
+        self.webhook_server.start()
+
+        if self.config.get('webhook_url'):
+            self.bot.setWebhook(self.config['webhook_url'])
+
+        self.logger.info('webhook listening on {0}'.format(self.webhook_server.httpd.server_address))
+        return self.webhook_server
+
+    def run_webhook(self):
         """
-        Check whether the config is sane.
+        Run the bot on updates received by the local webhook server.
         """
-        if not self.config[name]:
-            logging.error('config[\'{0}\'] is missing!')
-            raise ValueError
+        server = self.start_webhook()
 
-    def check_config_entry_of_list(self,
-                                   name):
+        try:
+            while True:
+                update = server.updates.get()
+                self.newest_update_id = update.update_id
+                try:
+                    self.NOW_HANDLING_UPDATE_ID = update.update_id
+                    self.handle_update_retrying(update)
+                    self.LAST_UPDATE_ID = update.update_id + 1
+                finally:
+                    server.done()
+        except KeyboardInterrupt:
+            server.stop()
+            exit()
+
+    def run_async(self):
         """
-        Check whether the list in config is sane, or init a empty one.
+        Run the bot on asyncio: long polling overlaps with handling, updates of
+        different chats are handled concurrently and in order within a chat.
         """
-        if not self.config[name]:
-            self.config[name] = []
+        try:
+            asyncio.run(self.async_main())
+        except KeyboardInterrupt:
+            exit()
 
-    def run(self):
+    async def async_main(self):
         """
-        Run the bot: start the loop to fetch updates and handle.
+        Poll updates and dispatch them into per-chat queues.
         """
-        self.get_latest_update_id()
-        self.recoverStatus = False
+        loop = asyncio.get_running_loop()
+        poll_executor = ThreadPoolExecutor(max_workers = 1)
+        self.handler_executor = ThreadPoolExecutor(max_workers = self.config.get('async_workers', 8))
+
+        # chat_id -> asyncio.Queue of pending updates, alive while its worker runs.
+        self.chat_queues = dict()
+
+        if self.config.get('update_mode') == 'webhook':
+            server = self.start_webhook()
+            while True:
+                update = await loop.run_in_executor(poll_executor, server.updates.get)
+                self.dispatch_async(update)
+
+        await loop.run_in_executor(poll_executor, self.restore_offset)
+
+        # update_id of updates dispatched but not handled yet; the checkpoint stays below them.
+        self.inflight_updates = set()
+        backoff = Backoff(self.config.get('retry_base', 1.0), self.config.get('retry_cap', 60.0))
 
         while True:
-            # This will be our global variable to keep the latest update_id when requesting
-            # for updates. It starts with the latest update_id if available.
+            # Poll from the oldest update still in flight, so Telegram keeps it
+            # until handled; updates dispatched before come back and are skipped.
+            offset = min(self.inflight_updates, default = self.LAST_UPDATE_ID)
             try:
-                if self.recoverStatus:
-                    # try to reinit...
-                    self.bot = telegram.Bot(self.config['bot_token'])
-                    self.get_latest_update_id()
-                    self.recoverStatus = False
-
-                self.get_mesg()
-            except KeyboardInterrupt:
-                exit()
-            except http.client.HTTPException:
-                logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
-                self.recover()
-            except urllib.error.HTTPError:
-                logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
-                self.recover()
+                updates = await loop.run_in_executor(poll_executor, self.fetch_updates, offset)
+                backoff.reset()
             except Exception as ex:
-                logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
-                self.recover()
+                await asyncio.sleep(self.retry_delay(ex, backoff))
+                continue
+
+            fresh = [u for u in updates if self.is_new_update(u)]
+            for update in fresh:
+                if self.is_stale_update(update):
+                    self.logger.info('skipping stale update {0}'.format(update.update_id))
+                else:
+                    self.inflight_updates.add(update.update_id)
+                    self.dispatch_async(update)
+                self.newest_update_id = update.update_id
+                self.LAST_UPDATE_ID = update.update_id + 1
+
+            # Also after empty polls, to catch up with updates handled meanwhile.
+            offset = min(self.inflight_updates, default = self.LAST_UPDATE_ID)
+            if offset != self.saved_offset:
+                await loop.run_in_executor(poll_executor, self.save_offset, offset)
+
+            # Only in-flight updates came back, which getUpdates returns at
+            # once: give the handlers time instead of spinning.
+            if updates and not fresh:
+                await asyncio.sleep(self.config.get('inflight_poll_interval', 0.5))
+
+    def dispatch_async(self,
+                       update):
+        """
+        Queue update for its chat, starting a chat worker when there is none.
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+        """
+        chat_id = update.message.chat_id if update.message else None
+
+        queue = self.chat_queues.get(chat_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self.chat_queues[chat_id] = queue
+            asyncio.ensure_future(self.chat_worker(chat_id, queue))
+
+        queue.put_nowait(update)
 
-    def recover(self):
+    async def chat_worker(self,
+                          chat_id,
+                          queue):
         """
-        Recover the bot in next loop.
+        Handle updates of one chat in FIFO order, exiting once the queue is idle.
+
+        Args:
+            chat_id (int):
+                Chat served by this worker.
+            queue (asyncio.Queue):
+                Pending updates of chat_id.
         """
-        self.recoverStatus = True
-        if self.NOW_HANDLING_UPDATE_ID:
-            self.LAST_UPDATE_ID = self.NOW_HANDLING_UPDATE_ID + 1
-        else:
-            self.LAST_UPDATE_ID = self.LAST_UPDATE_ID + 1
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(), timeout = self.config.get('async_idle_timeout', 60))
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.chat_queues[chat_id]
+                    return
+                continue
+
+            try:
+                await loop.run_in_executor(self.handler_executor, self.handle_update_retrying, update)
+            except Exception:
+                self.logger.exception('!!! EXCEPTION HAS OCCURRED !!!')
+            finally:
+                self.inflight_updates.discard(update.update_id)
+                if self.webhook_server:
+                    self.webhook_server.done()
 
     def json_serial(self,
                     obj):
@@ -322,6 +3011,110 @@ class AFXBot:
             return serial
         raise TypeError ("Type not serializable")
 
+    def restore_offset(self):
+        """
+        Resume from the offset checkpointed in resp_db, or skip everything
+        pending when there is no checkpoint yet.
+        """
+        offset = self.get_state('last_update_id')
+        if offset is None:
+            self.get_latest_update_id()
+            return
+
+        self.LAST_UPDATE_ID = self.saved_offset = int(offset)
+        self.logger.info('resuming from update {0}'.format(self.LAST_UPDATE_ID))
+
+    def save_offset(self,
+                    offset = None):
+        """
+        Checkpoint offset, self.LAST_UPDATE_ID by default, into resp_db.
+        """
+        if offset is None:
+            offset = self.LAST_UPDATE_ID
+        if offset is None or offset == self.saved_offset:
+            return
+
+        self.set_state('last_update_id', offset)
+        self.saved_offset = offset
+
+    def get_state(self,
+                  key):
+        """
+        Returns:
+            Value of key in the bot_state table of resp_db, or None.
+        """
+        with self.resp_lock:
+            c = self.resp_db.cursor()
+            row = c.execute('SELECT value FROM bot_state WHERE key = ?', (key, )).fetchone()
+        return row['value'] if row else None
+
+    def set_state(self,
+                  key,
+                  value):
+        """Store value of key in the bot_state table of resp_db."""
+        with self.resp_lock:
+            c = self.resp_db.cursor()
+            c.execute('INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)', (key, value))
+            self.resp_db.commit()
+
+    def sync_shared_state(self):
+        """
+        Pick up what other processes committed to resp_db: reload responses
+        when resp_version moved, and take over the shared bot flags.
+        PRAGMA data_version makes the common case, nothing changed, one cheap query.
+        """
+        with self.resp_lock:
+            c = self.resp_db.cursor()
+            data_version = c.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self.resp_data_version:
+                return
+            self.resp_data_version = data_version
+
+            state = {row['key']: row['value'] for row in c.execute(
+                "SELECT key, value FROM bot_state WHERE key IN ('resp_version', 'is_running', 'is_accepting_photos')")}
+
+            if state.get('resp_version') != self.resp_version:
+                self.logger.info('resp_db changed by another process, reloading')
+                self.resp_version = state.get('resp_version')
+                self.init_kw_lists()
+                self.resp_store.load(self.resp_db)
+
+        with self.state_lock:
+            if 'is_running' in state:
+                self.is_running = bool(state['is_running'])
+            if 'is_accepting_photos' in state:
+                self.is_accepting_photos = bool(state['is_accepting_photos'])
+
+    @contextmanager
+    def resp_write(self):
+        """
+        Hold resp_lock around a write to the response tables that this
+        process applies to resp_store itself. The triggers move resp_version
+        on our own commits too; when no other process committed meanwhile,
+        take the new resp_version over, so sync_shared_state does not reload
+        for it later.
+        """
+        with self.resp_lock:
+            c = self.resp_db.cursor()
+            data_version = c.execute('PRAGMA data_version').fetchone()[0]
+            known = data_version == self.resp_data_version or self.get_state('resp_version') == self.resp_version
+            yield
+            if known and c.execute('PRAGMA data_version').fetchone()[0] == data_version:
+                self.resp_version = self.get_state('resp_version')
+
+    def is_stale_update(self,
+                        update):
+        """
+        Returns:
+            True when self.config['stale_update_policy'] is 'skip' and update
+            is older than self.config['stale_update_minutes'] (10 by default).
+        """
+        if self.config.get('stale_update_policy', 'replay') != 'skip' or not update.message:
+            return False
+
+        age = time.time() - update.message.date.timestamp()
+        return age > self.config.get('stale_update_minutes', 10) * 60
+
     def get_latest_update_id(self):
         """
         Get latest update id from Telegram server.
@@ -345,148 +3138,653 @@ class AFXBot:
         Read all keywords/symptoms from self.resp_db.
         """
         self.logger.debug('Initializing response...')
-        self.resp_db = sqlite3.connect(self.config['resp_db'])
-        self.resp_db.row_factory = sqlite3.Row
+        with self.resp_lock:
+            if self.resp_db:
+                self.resp_db.close()
+
+            self.resp_db = sqlite3.connect(self.config['resp_db'], check_same_thread = False,
+                                           factory = MeteredConnection)
+            self.resp_db.row_factory = sqlite3.Row
+            self.resp_db.metrics = self.metrics
+
+            self.migrate_resp_db()
+            self.init_search_index()
+
+            self.resp_data_version = self.resp_db.execute('PRAGMA data_version').fetchone()[0]
+            self.resp_version = self.get_state('resp_version')
+
+            self.init_kw_lists()
+            self.resp_store.load(self.resp_db)
+
+    def migrate_resp_db(self):
+        """
+        Set connection pragmas, then bring self.resp_db up to the latest
+        RESP_DB_MIGRATIONS entry, one transaction per version. PRAGMA
+        user_version records the applied version; it is read again inside
+        the transaction, so processes starting together migrate once.
+        """
+        # Pragmas and BEGIN below fail inside a transaction.
+        if self.resp_db.in_transaction:
+            self.resp_db.commit()
+
+        c = self.resp_db.cursor()
+        c.execute('PRAGMA journal_mode = WAL')
+        c.execute('PRAGMA synchronous = NORMAL')
+        c.execute('PRAGMA cache_size = {0:d}'.format(-int(self.config.get('resp_db_cache_kb', 8192))))
+        c.execute('PRAGMA temp_store = MEMORY')
+
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        for v in range(version + 1, len(self.RESP_DB_MIGRATIONS) + 1):
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                if c.execute('PRAGMA user_version').fetchone()[0] >= v:
+                    self.resp_db.commit()
+                    continue
+
+                self.logger.info('migrating resp_db to version {0}'.format(v))
+                migration = self.RESP_DB_MIGRATIONS[v - 1]
+                if callable(migration):
+                    migration(c, self.logger)
+                else:
+                    for stmt in migration:
+                        c.execute(stmt)
+                c.execute('PRAGMA user_version = {0:d}'.format(v))
+                self.resp_db.commit()
+            except:
+                self.resp_db.rollback()
+                raise
+
+    def init_search_index(self):
+        """
+        Find the tokenizer of the FTS5 indexes built by migrate_search_index.
+        Without them, search_tokenizer is None and search_resp uses LIKE.
+        """
+        c = self.resp_db.cursor()
+        row = c.execute("SELECT sql FROM sqlite_master WHERE name = 'resp_fts'").fetchone()
+        if row is None:
+            self.search_tokenizer = None
+        else:
+            self.search_tokenizer = 'trigram' if 'trigram' in row['sql'] else 'unicode61'
+
+    def search_resp(self,
+                    terms):
+        """
+        Search resp contents and resp_get keywords/tags.
+
+        Args:
+            terms (list of str):
+                Every term must match, as a substring with trigram or LIKE,
+                as a word with unicode61.
+
+        Returns:
+            List of IIDX lists, one per RESP_FTS_TABLES entry, best match
+            first with FTS5, by IIDX with LIKE.
+        """
+        # trigram cannot match anything shorter than 3 characters.
+        use_fts = self.search_tokenizer and \
+            (self.search_tokenizer != 'trigram' or min(len(t) for t in terms) >= 3)
+
+        c = self.resp_db.cursor()
+        hits = []
+        for table, fts, cols in self.RESP_FTS_TABLES:
+            if use_fts:
+                query = ' '.join('"' + t.replace('"', '""') + '"' for t in terms)
+                c.execute('SELECT rowid FROM {0} WHERE {0} MATCH ? ORDER BY rank'.format(fts), (query, ))
+            else:
+                match = '(' + ' OR '.join("{0} LIKE ? ESCAPE '\\'".format(col) for col in cols) + ')'
+                pattern = lambda t: '%' + re.sub(r'([\\%_])', r'\\\1', t) + '%'
+                c.execute('SELECT IIDX FROM {0} WHERE {1} ORDER BY IIDX'.format(table, ' AND '.join([match] * len(terms))),
+                          [pattern(t) for t in terms for col in cols])
+            hits.append([row[0] for row in c])
+        return hits
+
+    def load_kw_lists(self):
+        """
+        Read keyword lists and symptom tables from self.resp_db.
+
+        Returns:
+            Tuple of (kw_list, kw_list_get, symptom_tbl, symptom_get).
+        """
         c = self.resp_db.cursor()
 
-        self.kw_list = list()
+        kw_list = list()
         c.execute('SELECT keyword FROM resp GROUP BY keyword ORDER BY RANDOM() DESC;')
         for kw in c:
-            self.kw_list.append(kw['keyword'])
+            kw_list.append(kw['keyword'])
 
-        self.kw_list_get = list()
+        kw_list_get = list()
         c.execute('SELECT keyword FROM resp_get GROUP BY keyword ORDER BY RANDOM() DESC;')
         for kw in c:
-            self.kw_list_get.append(kw['keyword'])
+            kw_list_get.append(kw['keyword'])
 
-        self.symptom_tbl = dict()
+        symptom_tbl = dict()
         c.execute('SELECT before, after FROM symptom ORDER BY LENGTH(before) DESC;')
         for syms in c:
-            self.symptom_tbl[syms['before']] = syms['after']
+            symptom_tbl[syms['before']] = syms['after']
 
-        self.symptom_get = dict()
+        symptom_get = dict()
         c.execute('SELECT before, after FROM symptom_get ORDER BY LENGTH(before) DESC;')
         for syms in c:
-            self.symptom_get[syms['before']] = syms['after']
+            symptom_get[syms['before']] = syms['after']
+
+        return kw_list, kw_list_get, symptom_tbl, symptom_get
 
+    def init_kw_lists(self):
+        """
+        Rebuild keyword lists, symptom tables and the automaton from self.resp_db.
+        """
+        self.kw_list, self.kw_list_get, self.symptom_tbl, self.symptom_get = self.load_kw_lists()
 
         self.unified_kw_list = self.kw_list + list(self.symptom_tbl.keys())
         self.unified_get_list = self.kw_list_get + list(self.symptom_get.keys())
 
+        self.kw_automaton = KeywordAutomaton(self.unified_kw_list)
+
+    def apply_resp_added(self,
+                         iidx,
+                         kw,
+                         cont):
+        """
+        Apply one inserted resp row to the store and keyword lists.
+        """
+        self.resp_store.add_resp(iidx, kw, cont)
+
+        if kw not in self.kw_list:
+            self.kw_list.append(kw)
+            self.unified_kw_list.append(kw)
+            self.kw_automaton.add(kw)
+
+    def apply_resp_removed(self,
+                           iidx):
+        """
+        Apply one deleted resp row to the store and keyword lists.
+        """
+        row = self.resp_store.remove_resp(iidx)
+        if not row:
+            return
+
+        kw = row['keyword']
+        if not self.resp_store.has_resp(kw) and kw in self.kw_list:
+            self.kw_list.remove(kw)
+            self.unified_kw_list.remove(kw)
+            if kw not in self.unified_kw_list:
+                self.kw_automaton.remove(kw)
+
+    def apply_symptom_added(self,
+                            kw_before,
+                            kw_after):
+        """
+        Apply one inserted symptom row to the symptom table and keyword lists.
+        """
+        if kw_before not in self.symptom_tbl:
+            self.unified_kw_list.append(kw_before)
+        self.symptom_tbl[kw_before] = kw_after
+        self.kw_automaton.add(kw_before)
+
+    def apply_get_added(self,
+                        iidx,
+                        kw,
+                        cont,
+                        tag,
+                        gid):
+        """
+        Apply one inserted resp_get row to the store and keyword lists.
+        """
+        self.resp_store.add_get(iidx, kw, cont, tag, gid)
+
+        if kw not in self.kw_list_get:
+            self.kw_list_get.append(kw)
+            self.unified_get_list.append(kw)
+
+    def apply_get_removed(self,
+                          iidx):
+        """
+        Apply one deleted resp_get row to the store and keyword lists.
+        """
+        row = self.resp_store.remove_get(iidx)
+        if not row:
+            return
+
+        kw = row['keyword']
+        if not self.resp_store.has_get(kw) and kw in self.kw_list_get:
+            self.kw_list_get.remove(kw)
+            self.unified_get_list.remove(kw)
+
+    def check_kw_lists(self):
+        """
+        Compare incrementally maintained lists against a full rebuild from self.resp_db.
+
+        Returns:
+            List of names of mismatched structures, empty when consistent.
+        """
+        kw_list, kw_list_get, symptom_tbl, symptom_get = self.load_kw_lists()
+        unified_kw_list = kw_list + list(symptom_tbl.keys())
+        unified_get_list = kw_list_get + list(symptom_get.keys())
+
+        mismatched = []
+        if sorted(self.kw_list) != sorted(kw_list):
+            mismatched.append('kw_list')
+        if sorted(self.kw_list_get) != sorted(kw_list_get):
+            mismatched.append('kw_list_get')
+        if self.symptom_tbl != symptom_tbl:
+            mismatched.append('symptom_tbl')
+        if self.symptom_get != symptom_get:
+            mismatched.append('symptom_get')
+        if sorted(self.unified_kw_list) != sorted(unified_kw_list):
+            mismatched.append('unified_kw_list')
+        if sorted(self.unified_get_list) != sorted(unified_get_list):
+            mismatched.append('unified_get_list')
+        if self.kw_automaton.words != set(unified_kw_list):
+            mismatched.append('kw_automaton')
+
+        store = ResponseStore()
+        store.load(self.resp_db)
+        if store.resp_rows != self.resp_store.resp_rows:
+            mismatched.append('resp_store.resp')
+        if store.get_rows != self.resp_store.get_rows:
+            mismatched.append('resp_store.get')
+
+        return mismatched
+
+    @contextmanager
+    def send_priority(self,
+                      priority):
+        """
+        Set the default send priority of the current thread within the block.
+        """
+        prev = getattr(self.send_ctx, 'priority', SendScheduler.PRIO_NORMAL)
+        self.send_ctx.priority = priority
+        try:
+            yield
+        finally:
+            self.send_ctx.priority = prev
+
     def send_generic_mesg(self,
                           chat_id,
                           text,
-                          reply_to_message_id = None):
+                          reply_to_message_id = None,
+                          priority = None):
         """
         For sending simple messages only including text (in most cases.)
+
+        Returns:
+            concurrent.futures.Future of the sent telegram.Message.
+        """
+        if priority is None:
+            priority = getattr(self.send_ctx, 'priority', SendScheduler.PRIO_NORMAL)
+
+        return self.sender.submit(chat_id, self.bot.sendMessage,
+                                  {'chat_id': chat_id, 'text': text, 'reply_to_message_id': reply_to_message_id},
+                                  priority)
+
+    def send_photo(self,
+                   chat_id,
+                   photo,
+                   reply_to_message_id = None,
+                   priority = None):
+        """
+        Send a photo by file_id or file object.
+
+        Returns:
+            concurrent.futures.Future of the sent telegram.Message.
+        """
+        if priority is None:
+            priority = getattr(self.send_ctx, 'priority', SendScheduler.PRIO_NORMAL)
+
+        return self.sender.submit(chat_id, self.bot.sendPhoto,
+                                  {'chat_id': chat_id, 'photo': photo, 'reply_to_message_id': reply_to_message_id},
+                                  priority)
+
+    def wait_sent(self,
+                  fut):
+        """
+        Wait for a queued send. A handler lets go of reload_lock meanwhile,
+        so a reload is not held up by the rate limiter; config and strings
+        read after this call may come from a newer reload.
+
+        Returns:
+            The sent telegram.Message.
+        """
+        with self.reload_lock.released():
+            return fut.result()
+
+    @staticmethod
+    def hash_file(file_name):
+        """
+        Returns:
+            Hex SHA-256 of the content of file_name.
+        """
+        h = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def upload_photo_batch(self,
+                           chat_id,
+                           files):
+        """
+        Upload files to chat_id, as one media group when the bot supports it.
+
+        Returns:
+            List of file_id, in the order of files.
+        """
+        with ExitStack() as stack:
+            handles = [stack.enter_context(open(f, 'rb')) for f in files]
+
+            if len(handles) > 1:
+                res = self.bot.sendMediaGroup(chat_id = chat_id,
+                                              media = [telegram.InputMediaPhoto(h) for h in handles])
+                return [m.photo[-1].file_id for m in res]
+
+            return [self.bot.sendPhoto(chat_id = chat_id, photo = h).photo[-1].file_id for h in handles]
+
+    def bulk_upload_photos(self,
+                           chat_id,
+                           mesg_id,
+                           files):
+        """
+        Upload files not uploaded before, then report every file_id in one summary.
+
+        Files are hashed in parallel and looked up in the photo_cache table by
+        content, so renamed or repeated files are not uploaded again. The rest
+        go through self.sender in batches of up to 10 (sendMediaGroup), paced
+        with everything else sent to chat_id.
+
+        Args:
+            chat_id (int):
+                Chat to upload to and report in.
+            mesg_id (int):
+                Message to reply the summary to.
+            files (list):
+                Paths of the photos.
+        """
+        names = [str(f) for f in files]
+        with ThreadPoolExecutor(max_workers = self.config.get('upload_workers', 4)) as ex:
+            hashes = list(ex.map(self.hash_file, names))
+
+        file_ids = dict()
+        with self.resp_lock:
+            c = self.resp_db.cursor()
+            for h in set(hashes):
+                row = c.execute('SELECT file_id FROM photo_cache WHERE hash = ?', (h,)).fetchone()
+                if row:
+                    file_ids[h] = row['file_id']
+        cached = len(file_ids)
+
+        todo = OrderedDict()
+        for name, h in zip(names, hashes):
+            if h not in file_ids:
+                todo.setdefault(h, name)
+        todo = list(todo.items())
+
+        batch_size = 10 if hasattr(self.bot, 'sendMediaGroup') and hasattr(telegram, 'InputMediaPhoto') else 1
+        self.logger.info('bulk upload: {0} files, {1} cached, {2} to upload'.format(len(names), cached, len(todo)))
+
+        # A couple of batches queued at a time, so the upload neither expires
+        # nor fills the chat's queue while it waits for the rate limit.
+        batches = deque(todo[i:i + batch_size] for i in range(0, len(todo), batch_size))
+        jobs = deque()
+
+        failed = 0
+        done = 0
+        while batches or jobs:
+            while batches and len(jobs) < 2:
+                batch = batches.popleft()
+                jobs.append((batch, self.sender.submit(chat_id, self.upload_photo_batch,
+                                                       {'chat_id': chat_id, 'files': [name for h, name in batch]},
+                                                       SendScheduler.PRIO_AUTO, droppable = False, cost = len(batch))))
+
+            batch, fut = jobs.popleft()
+            try:
+                for (h, name), file_id in zip(batch, fut.result()):
+                    file_ids[h] = file_id
+                    with self.resp_lock:
+                        c = self.resp_db.cursor()
+                        c.execute('INSERT OR REPLACE INTO photo_cache (hash, file_id, name) VALUES (?, ?, ?)',
+                                  (h, file_id, Path(name).name))
+                        self.resp_db.commit()
+            except Exception:
+                self.logger.exception('bulk upload failed: {0}'.format([name for h, name in batch]))
+                failed += len(batch)
+
+            done += len(batch)
+            self.logger.info('bulk upload: {0}/{1}'.format(done, len(todo)))
+
+        lines = ['Bulk upload: {0} files, {1} uploaded, {2} cached, {3} failed.'.format(
+                 len(names), len(todo) - failed, cached, failed)]
+        for name, h in zip(names, hashes):
+            lines.append('{0}: {1}'.format(Path(name).name, file_ids.get(h, '(failed)')))
+
+        for text in self.split_text('\n'.join(lines)):
+            self.send_generic_mesg(chat_id, text, mesg_id)
+
+    def fetch_updates(self,
+                      offset = None):
+        """
+        Call getUpdates from offset, self.LAST_UPDATE_ID by default, through
+        self.tg_breaker. Telegram forgets every update before the offset polled.
+
+        Returns:
+            List of telegram.Update.
+        Raises:
+            CircuitOpen: while the breaker holds Telegram calls.
+        """
+        now = time.monotonic()
+        wait = self.tg_breaker.delay(now)
+        if wait:
+            raise CircuitOpen(wait)
+
+        try:
+            with self.metrics.timer('api', 'getUpdates'):
+                updates = self.bot.getUpdates(offset=self.LAST_UPDATE_ID if offset is None else offset, timeout=10)
+        except Exception as ex:
+            if classify_error(ex) == 'transient':
+                self.tg_breaker.failure(now)
+            raise
+
+        self.tg_breaker.success()
+
+        if self.recorder and updates:
+            for update in updates:
+                self.recorder.record(update.to_dict())
+            self.recorder.flush()
+
+        return updates
+
+    def is_new_update(self,
+                      update):
+        """
+        Returns:
+            False for an update already taken, which polling from an
+            in-flight offset returns again.
         """
-        self.bot.sendMessage(chat_id = chat_id, text = text, reply_to_message_id = reply_to_message_id)
+        return self.LAST_UPDATE_ID is None or update.update_id >= self.LAST_UPDATE_ID
+
+    def handle_update_retrying(self,
+                               update):
+        """
+        Handle update, retrying it alone on transient errors up to
+        self.config['update_max_attempts'] times. Other errors drop only this update.
+        Failed sends are retried by SendScheduler; errors seen here are raised
+        while handling, e.g. by waiting on a send.
+        """
+        max_attempts = self.config.get('update_max_attempts', 3)
+        backoff = None
+
+        for attempt in range(max_attempts):
+            try:
+                with self.reload_lock.read():
+                    self.handle_update(update)
+                return
+            except Exception as ex:
+                kind = classify_error(ex)
+                if kind == 'fatal' or attempt + 1 == max_attempts:
+                    self.logger.exception('dropping update {0} ({1})'.format(update.update_id, kind))
+                    return
+
+                if kind == 'retry_after':
+                    delay = ex.retry_after
+                else:
+                    backoff = backoff or Backoff(self.config.get('retry_base', 1.0), self.config.get('retry_cap', 60.0))
+                    delay = backoff.next()
+                self.logger.warning('update {0}: {1!r}, retry in {2:.1f}s'.format(update.update_id, ex, delay))
+                time.sleep(delay)
 
     def get_mesg(self):
         """
         Fetch updates from server for further processes.
+
+        The offset is checkpointed once per batch, and when handling stops
+        on an exception or shutdown, so delivery is at-least-once: a hard
+        crash in the middle of a batch handles its earlier updates again
+        after restart.
         """
         # Request updates after the last updated_id
-        for update in self.bot.getUpdates(offset=self.LAST_UPDATE_ID, timeout=10):
-            self.logger.info('Update: ' + str(update));
-            # chat_id is required to reply any message
-            chat_id = update.message.chat_id
-            message = update.message.text
-            mesg_id = update.message.message_id
-            user_id = update.message.from_user.id
-            self.NOW_HANDLING_UPDATE_ID = update.update_id
+        updates = self.fetch_updates()
 
-            self.logger.debug('now handling update: {0}'.format(self.NOW_HANDLING_UPDATE_ID))
-            
-            try:
-                if message:
-                    # YOU SHALL NOT PASS!
-                    # Only authorized group chats and users (admins) can access this bot.
-                    if not self.do_augmented_auth(update.message.chat.id):
-                        if '__FOR_RECOGNITION__' in message and not update.message.chat.id in self.recognition_list:
-                            self.send_generic_mesg(chat_id, 'Please contact moderator to add following id into ACL.')
-                            self.send_generic_mesg(chat_id, str(update.message.chat.id))
-                            self.recognition_list.append(update.message.chat.id)
-                        else:
-                            self.logger.info('Access denied from: ' + str(update.message.chat.id))
+        if updates:
+            self.newest_update_id = updates[-1].update_id
+        self.pending_updates = len(updates)
 
-                    elif self.handle_washsnake(update):
-                        nothing_todo = 1
+        try:
+            for update in updates:
+                self.NOW_HANDLING_UPDATE_ID = update.update_id
+                if self.is_stale_update(update):
+                    self.logger.info('skipping stale update {0}'.format(update.update_id))
+                else:
+                    self.handle_update_retrying(update)
+                self.pending_updates -= 1
 
-                    # Status querying.
-                    elif self.strs['q_status_kw'] in message:
-                        if self.is_running:
-                            self.send_generic_mesg(chat_id, self.strs['qr_status_t'], mesg_id)
-                        else:
-                            self.send_generic_mesg(chat_id, self.strs['qr_status_f'], mesg_id)
-
-                    # Only admins can re-enable bot.
-                    elif not self.is_running and message.startswith(self.strs['s_status_t_kw']) and self.do_adm_auth(user_id):
-                        self.send_generic_mesg(chat_id, self.strs['sr_status_t_ok'], mesg_id)
-                        self.init_resp()
-                        self.is_running = True
-
-                    # MOTDs are necessary.
-                    elif message.lower().startswith('/motd') or self.is_handle_motd(message):
-                        self.handle_motd(update)
-
-                    # Only MOTD for some special groups, otherwise...
-                    elif self.is_running and self.do_operational_auth(update.message.chat.id):
-                        # Batch update *.jpg in /images/
-                        if message.startswith(self.strs['v_photo_bulkupload']) and self.do_adm_auth(user_id):
-                            p = Path('images')
-                            fl = list(p.glob('*.jpg'))
-                            if len(fl) == 0:
-                                self.send_generic_mesg(chat_id, self.strs['vr_photo_bulkupload_no_file'], mesg_id)
-                            else:
-                                for image_name in fl:
-                                    # for uploading new photos
-                                    with open(str(image_name), 'rb') as nn:
-                                        photo_res = self.bot.sendPhoto(chat_id = chat_id, photo = nn)
-
-                                    photo_mesg = photo_res.photo[-1].file_id
-                                    self.send_generic_mesg(chat_id, photo_mesg, photo_res.message_id)
-
-
-                        # Reload keyword table
-                        # Disable bot
-                        # Enter/Exit photo upload mode
-                        # Handle ADM cmd/Common cmd/Fortune tell
-                        elif self.execute_callbacks(self.bot_callbacks, update):
-                            nothing_todo = 1
-
-                        # other...
-                        else:
-                            self.handle_response(update)
-                    elif self.is_running and update.message.chat.id in self.config['restricted_chats']:
-                        if self.execute_callbacks(self.bot_callbacks_restricted, update):
-                            nothing_todo = 1
-                    elif self.is_running:
-                        self.logger.debug('Not handling, in motd_only chats?')
+                # Updates global offset to get the new updates
+                self.LAST_UPDATE_ID = self.NOW_HANDLING_UPDATE_ID + 1
+        finally:
+            # Resume here after a restart.
+            self.save_offset()
+
+    def handle_update(self,
+                      update):
+        """
+        Handles one update fetched from server.
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+        """
+        if self.log_enabled('update', logging.INFO):
+            self.logger.info('Update: %s', update, extra = {'category': 'update'})
+        # chat_id is required to reply any message
+        chat_id = update.message.chat_id
+        message = update.message.text
+        mesg_id = update.message.message_id
+        user_id = update.message.from_user.id
+
+        self.logger.debug('now handling update: %s', update.update_id)
+
+        # Full policy of this update in two lookups.
+        chat_roles = self.get_roles(chat_id)
+        is_adm = self.get_roles(user_id) & self.ROLE_ADM
+
+        try:
+            if message:
+                # YOU SHALL NOT PASS!
+                # Only authorized group chats and users (admins) can access this bot.
+                if not chat_roles & self.AUTH_AUGMENTED:
+                    with self.state_lock:
+                        recognize = '__FOR_RECOGNITION__' in message and not update.message.chat.id in self.recognition_list
+                        if recognize:
+                            if len(self.recognition_list) >= self.RECOGNITION_LIST_MAX:
+                                self.recognition_list.clear()
+                            self.recognition_list.add(update.message.chat.id)
+
+                    if recognize:
+                        self.send_generic_mesg(chat_id, 'Please contact moderator to add following id into ACL.')
+                        self.send_generic_mesg(chat_id, str(update.message.chat.id))
                     else:
-                        self.logger.debug('Not running...')
+                        self.logger.info('Access denied from: %s', update.message.chat.id)
 
-                # upload photo, adm only
-                elif update.message.photo and self.is_accepting_photos and self.do_adm_auth(user_id):
-                    try:
-                        self.logger.debug('PhotoContent: ' + update.message.photo[-1].file_id);
-                        photo_mesg = update.message.photo[-1].file_id
-                        photo_res = self.bot.sendPhoto(chat_id = chat_id, photo = photo_mesg)
-                        photo_mesg = photo_res.photo[-1].file_id
-                        self.send_generic_mesg(chat_id, photo_mesg, photo_res.message_id)
-                    except:
+                elif self.handle_washsnake(update):
+                    nothing_todo = 1
+
+                # Status querying.
+                elif self.strs['q_status_kw'] in message:
+                    if self.is_running:
+                        self.send_generic_mesg(chat_id, self.strs['qr_status_t'], mesg_id)
+                    else:
+                        self.send_generic_mesg(chat_id, self.strs['qr_status_f'], mesg_id)
+
+                # Only admins can re-enable bot.
+                elif not self.is_running and message.startswith(self.strs['s_status_t_kw']) and is_adm:
+                    self.send_generic_mesg(chat_id, self.strs['sr_status_t_ok'], mesg_id)
+                    self.init_resp()
+                    self.set_is_running(True)
+
+                # MOTDs are necessary.
+                elif message.lower().startswith('/motd') or self.is_handle_motd(message):
+                    self.handle_motd(update)
+
+                # Only MOTD for some special groups, otherwise...
+                elif self.is_running and chat_roles & self.AUTH_OPERATIONAL:
+                    # Batch update *.jpg in /images/
+                    if message.startswith(self.strs['v_photo_bulkupload']) and is_adm:
+                        p = Path('images')
+                        fl = sorted(p.glob('*.jpg'))
+                        if len(fl) == 0:
+                            self.send_generic_mesg(chat_id, self.strs['vr_photo_bulkupload_no_file'], mesg_id)
+                        else:
+                            with self.state_lock:
+                                running = self.bulk_upload_thread and self.bulk_upload_thread.is_alive()
+                                if not running:
+                                    # Runs in background, the summary is sent when done.
+                                    self.bulk_upload_thread = threading.Thread(target = self.bulk_upload_photos,
+                                                                               args = (chat_id, mesg_id, fl),
+                                                                               name = 'BulkUpload', daemon = True)
+                                    self.bulk_upload_thread.start()
+                            if running:
+                                self.send_generic_mesg(chat_id, 'Bulk upload is still running.', mesg_id)
+
+                    # Reload keyword table
+                    # Disable bot
+                    # Enter/Exit photo upload mode
+                    # Handle ADM cmd/Common cmd/Fortune tell
+                    elif self.bot_router.execute(update):
                         nothing_todo = 1
 
-                #else:
-                #    self.logger.debug('NotHandleContent: ' + str(update.message));
-            except:
-                if chat_id != None and mesg_id != None:
-                    self.send_generic_mesg(chat_id, self.append_more_smiles('好像哪裡怪怪der '), mesg_id)
-                    
-                self.logger.exception('')
+                    # other...
+                    else:
+                        self.handle_response(update)
+                elif self.is_running and chat_roles & self.ROLE_RESTRICTED:
+                    if self.bot_router_restricted.execute(update):
+                        nothing_todo = 1
+                elif self.is_running:
+                    self.logger.debug('Not handling, in motd_only chats?')
+                else:
+                    self.logger.debug('Not running...')
 
-            # Updates global offset to get the new updates
-            self.LAST_UPDATE_ID = self.NOW_HANDLING_UPDATE_ID + 1
+            # upload photo, adm only
+            elif update.message.photo and self.is_accepting_photos and is_adm:
+                try:
+                    self.logger.debug('PhotoContent: ' + update.message.photo[-1].file_id);
+                    photo_mesg = update.message.photo[-1].file_id
+                    photo_res = self.wait_sent(self.send_photo(chat_id, photo_mesg))
+                    photo_mesg = photo_res.photo[-1].file_id
+                    self.send_generic_mesg(chat_id, photo_mesg, photo_res.message_id)
+                except Exception as ex:
+                    if classify_error(ex) != 'fatal':
+                        raise
+
+            #else:
+            #    self.logger.debug('NotHandleContent: ' + str(update.message));
+        except Exception as ex:
+            # Transient errors go up to handle_update_retrying, which runs
+            # this update again; only the rest is worth telling the chat.
+            if classify_error(ex) != 'fatal':
+                raise
+
+            if chat_id != None and mesg_id != None:
+                self.send_generic_mesg(chat_id, self.append_more_smiles('好像哪裡怪怪der '), mesg_id)
+                
+            self.logger.exception('')
 
     def is_handle_motd(self,
                        mesg):
@@ -517,7 +3815,7 @@ class AFXBot:
         Returns:
             Presence of id in self.config['adm_ids'].
         """
-        return id in self.config['adm_ids']
+        return bool(self.acl.get(id, 0) & self.ROLE_ADM)
 
     def do_operational_auth(self,
                             id):
@@ -526,8 +3824,7 @@ class AFXBot:
             Presence of id in self.config['operational_chats'],
                               self.config['adm_ids']
         """
-        return id in self.config['operational_chats'] \
-               or id in self.config['adm_ids']
+        return bool(self.acl.get(id, 0) & self.AUTH_OPERATIONAL)
 
     def do_augmented_auth(self,
                           id):
@@ -538,23 +3835,96 @@ class AFXBot:
                               self.config['restricted_chats'],
                               or self.config['motd_only_chats'].
         """
-        return id in self.config['operational_chats'] \
-               or id in self.config['adm_ids'] \
-               or id in self.config['restricted_chats'] \
-               or id in self.config['motd_only_chats']
+        return bool(self.acl.get(id, 0) & self.AUTH_AUGMENTED)
+
+    def append_more_smiles(self,
+                           str,
+                           rl = 1,
+                           ru = 3):
+        """
+        Returns:
+            str with smiles in amount of random(rl, ru) appended on the tail.
+        """
+        return str + '\U0001F603' * random.randint(rl, ru)
+
+    @staticmethod
+    def chat_gid(chat_id):
+        """
+        Returns:
+            resp_get partition of chat_id, -1 (global) for private chats.
+        """
+        return chat_id if chat_id < 0 else -1
+
+    @staticmethod
+    def split_cmd(mesg):
+        """
+        Returns:
+            Non-empty whitespace separated tokens of mesg.
+        """
+        return mesg.split()
+
+    @staticmethod
+    def split_text(text,
+                   limit = 4096):
+        """
+        Split text at line breaks into chunks Telegram accepts as one message.
+
+        Returns:
+            List of chunks no longer than limit characters.
+        """
+        chunks = []
+        cur = ''
+        for line in text.split('\n'):
+            while len(line) > limit:
+                if cur:
+                    chunks.append(cur)
+                    cur = ''
+                chunks.append(line[:limit])
+                line = line[limit:]
+
+            if cur and len(cur) + 1 + len(line) > limit:
+                chunks.append(cur)
+                cur = line
+            else:
+                cur = cur + '\n' + line if cur else line
+
+        if cur:
+            chunks.append(cur)
+        return chunks
+
+    def register_command(self,
+                         name,
+                         handler,
+                         auth = 0):
+        """
+        Register a common command for handle_cmd.
+
+        Args:
+            name (str):
+                Lowercase command, e.g. '/get'.
+            handler (func(update, cmd_toks)):
+                Returns True when the command is handled.
+            auth (Optional[int]):
+                ROLE_* bits the chat needs any of, 0 for everyone.
+        """
+        self.cmd_table[name] = (handler, auth)
 
-    def append_more_smiles(self,
-                           str,
-                           rl = 1,
-                           ru = 3):
+    def register_adm_command(self,
+                             entity,
+                             handler):
         """
-        Returns:
-            str with smiles in amount of random(rl, ru) appended on the tail.
+        Register an administrative command for handle_adm_cmd.
+
+        Args:
+            entity (str):
+                Lowercase entity after /adm, e.g. 'mk_kw'.
+            handler (func(update, cmd_toks)):
+                The Handler that will be called, admin check is done by the caller.
         """
-        return str + '\U0001F603' * random.randint(rl, ru)
+        self.adm_cmd_table[entity] = handler
 
     def handle_adm_cmd(self,
-                                         update):
+                       update):
         """
         Handles all administrative commands.
 
@@ -563,225 +3933,533 @@ class AFXBot:
                 Update object to handle.
         """
         chat_id = update.message.chat_id
-        mesg = update.message.text.strip()
         mesg_id = update.message.message_id
 
-        cmd_toks = [x.strip() for x in mesg.split(' ')]
-        while '' in cmd_toks:
-            cmd_toks.remove('')
+        cmd_toks = self.split_cmd(update.message.text)
+        cmd_entity = cmd_toks[1].lower() if len(cmd_toks) > 1 else ''
+        self.logger.debug('cmd_entity: %s', cmd_entity)
 
-        cmd_entity = cmd_toks[1].lower()
-
-        c = self.resp_db.cursor()
-        self.logger.debug('cmd_entity: ' + cmd_entity)
+        handler = self.adm_cmd_table.get(cmd_entity)
+        if handler:
+            handler(update, cmd_toks)
+        else:
+            self.send_generic_mesg(chat_id, 'adm what? owo', mesg_id)
 
+    def adm_not_implemented(self,
+                            update,
+                            cmd_toks):
+        """Placeholder of reserved administrative commands."""
+        pass
+
+    # 憨包來吃圖
+    def adm_begin_get(self,
+                      update,
+                      cmd_toks):
+        self.set_is_accepting_photos(True)
+
+    # 憨包吃飽沒
+    def adm_end_get(self,
+                    update,
+                    cmd_toks):
+        self.set_is_accepting_photos(False)
+
+    def adm_mk_get(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-        # 憨包來吃圖
-        if cmd_entity == 'begin_get':
-            self.set_is_accepting_photos(True)
+        if len(cmd_toks) < 4:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+            return
 
-        # 憨包吃飽沒
-        elif cmd_entity == 'end_get':
-            self.set_is_accepting_photos(False)
+        # for multi-group.
+        gid = self.chat_gid(chat_id)
 
-        elif cmd_entity == 'mk_get':
-            # for multi-group.
-            gid = chat_id
-            if gid > 0:
-                gid = -1
-                
-            pic_id = cmd_toks[2]
-            kw = cmd_toks[3].lower()
-            if len(cmd_toks) > 4:
-                tag = cmd_toks[4].lower()
+        pic_id = cmd_toks[2]
+        kw = cmd_toks[3].lower()
+        if len(cmd_toks) > 4:
+            tag = cmd_toks[4].lower()
+        else:
+            tag = None
+        try:
+            self.logger.debug('Photo ID = ' + cmd_toks[2])
+            photo_res = self.wait_sent(self.send_photo(chat_id, cmd_toks[2], mesg_id))
+            if kw in self.symptom_get.keys():
+                self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, self.symptom_get[kw], pic_id), photo_res.message_id)
+                kw = self.symptom_get[kw]
             else:
-                tag = None
-            try:
-                self.logger.debug('Photo ID = ' + cmd_toks[2])
-                photo_res = self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = cmd_toks[2]);
-                if kw in self.symptom_get.keys():
-                    self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, self.symptom_get[kw], pic_id), photo_res.message_id)
-                    kw = self.symptom_get[kw]
-                else:
-                    self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, pic_id), photo_res.message_id)
+                self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, pic_id), photo_res.message_id)
 
+            with self.resp_write():
+                c = self.resp_db.cursor()
                 c.execute('''INSERT INTO resp_get (keyword, cont, tag, gid) VALUES (?, ?, ?, ?) ''', ( kw, pic_id, tag, gid))
                 self.resp_db.commit()
-                self.init_resp()
-            except TelegramError:
-                self.send_generic_mesg(chat_id, 'ERROR ON : {0} => {1}'.format(kw, pic_id), photo_res.message_id)
+                self.apply_get_added(c.lastrowid, kw, pic_id, tag, gid)
+        except telegram.error.TelegramError:
+            self.send_generic_mesg(chat_id, 'ERROR ON : {0} => {1}'.format(kw, pic_id), mesg_id)
 
-        elif cmd_entity == 'getpic_id':
-            pic_id = cmd_toks[2]
+    def adm_getpic_id(self,
+                      update,
+                      cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-            try:
-                photo_res = self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = pic_id);
-            except TelegramError:
-                self.send_generic_mesg(chat_id, 'ERROR ON : {0}'.format(pic_id), photo_res.message_id)
-
-        elif cmd_entity == 'ed_get':
-            not_implemented = 1
-
-        # make get symptom -> keyword
-        elif cmd_entity == 'mk_get_sym':
-            if len(cmd_toks) > 3:
-                kw_before = cmd_toks[2].lower()
-                kw_after = cmd_toks[3].lower()
+        if len(cmd_toks) < 3:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+            return
+
+        pic_id = cmd_toks[2]
+
+        try:
+            self.wait_sent(self.send_photo(chat_id, pic_id, mesg_id))
+        except telegram.error.TelegramError:
+            self.send_generic_mesg(chat_id, 'ERROR ON : {0}'.format(pic_id), mesg_id)
+
+    # list /get kw
+    def adm_ls_get(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) > 2:
+            kw = cmd_toks[2].lower()
+
+            if kw in self.symptom_get.keys():
+                header = '({0} -> {1}) => '.format(kw, self.symptom_get[kw])
+                kw = self.symptom_get[kw]
             else:
-                not_implemented = 1
+                header = '{0} => '.format(kw)
 
-        # list /get kw
-        elif cmd_entity == 'ls_get':
-            if len(cmd_toks) > 2:
-                outmesg = ''
-                kw = cmd_toks[2].lower()
+            # The chat's own partition first, then the global pool, or the one given.
+            try:
+                gid = int(cmd_toks[3]) if len(cmd_toks) > 3 else self.chat_gid(chat_id)
+            except ValueError:
+                self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
+                return
+            parts = [gid, -1] if gid != -1 else [-1]
+
+            # Keys are (position in parts, IIDX).
+            def fetch(after, limit):
+                start_part, start_iidx = after or (0, 0)
+                entries = []
+                with self.resp_lock:
+                    for pos in range(start_part, len(parts)):
+                        rows = self.resp_store.list_get(kw, parts[pos], start_iidx if pos == start_part else 0,
+                                                        limit - len(entries))
+                        entries += [((pos, conts['IIDX']), '/getid_{0} : {1}...{2} ({3}){4}{5}'.format(
+                                        conts['IIDX'], conts['cont'][:8], conts['cont'][-8:], conts['tag'] or 'N/A',
+                                        ' @' + str(conts['gid']) if conts['gid'] != -1 else '',
+                                        ' (w={0:g})'.format(conts['weight']) if conts['weight'] != 1 else ''))
+                                    for conts in rows]
+                        if len(entries) >= limit:
+                            break
+                return entries
 
-                if kw in self.symptom_get.keys():
-                    outmesg += '({0} -> {1}) => \n'.format(kw, self.symptom_get[kw])
-                    kw = self.symptom_get[kw]
-                else:
-                    outmesg += '{0} => \n'.format(kw)
+        else:
+            header = 'Supported /get keywords:'
 
-                c.execute('''SELECT IIDX, cont, tag FROM resp_get WHERE keyword = ? ORDER BY IIDX ASC;''', (kw, ))
-                for conts in c:
-                    if not conts['tag']:
-                        outmesg += '/getid_' + str(conts['IIDX']) + ' : ' + conts['cont'][:8] + '...' + conts['cont'][-8:] + ' (N/A)\n'
-                    else:
-                        outmesg += '/getid_' + str(conts['IIDX']) + ' : ' + conts['cont'][:8] + '...' + conts['cont'][-8:] + '(' + conts['tag'] + ')\n'
+            def fetch(after, limit):
+                s_tbl = self.symptom_get
+                return [(kw, kw + ' -> ' + s_tbl[kw] if kw in s_tbl else kw)
+                        for kw in ResponseStore.page(self.unified_get_list, after, limit)]
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        self.send_listing(chat_id, mesg_id, {'header': header, 'fetch': fetch, 'pages': [None]})
 
-            else: 
-                outmesg = 'Supported /get keywords:\n'
-                s_keys = self.symptom_get.keys()
-                for kw in self.unified_get_list:
+    # move /get pictures between gid partitions
+    # ^/adm\s+mv_get\s+(-?\d+)\s+(-?\d+)(\s+[^\s]+)?.*$
+    def adm_mv_get(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-                    if kw in s_keys:
-                        outmesg = outmesg + kw + ' -> ' + self.symptom_get[kw] + '\n'
-                    else:
-                        outmesg = outmesg + kw + '\n'
+        if len(cmd_toks) < 4:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+            return
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        try:
+            from_gid = int(cmd_toks[2])
+            to_gid = int(cmd_toks[3])
+        except ValueError:
+            self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
+            return
 
-        # make keyword -> content
-        # ^/adm\s+mk_kw\s+([^\s]+)\s+(.+)$
-        elif cmd_entity == 'mk_kw':
-            if len(cmd_toks) > 3:
-                kw = cmd_toks[2].lower()
-                content = mesg[(mesg.find(cmd_toks[2]) + len(cmd_toks[2]) + 1):].strip()
+        kw = cmd_toks[4].lower() if len(cmd_toks) > 4 else None
+        if kw in self.symptom_get.keys():
+            kw = self.symptom_get[kw]
 
-                if kw in self.symptom_tbl.keys():
-                    self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, self.symptom_tbl[kw], content), mesg_id)
-                    kw = self.symptom_tbl[kw]
-                else:
-                    self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, content), mesg_id)
+        with self.resp_write():
+            to_mv = self.resp_store.get_partition(from_gid, kw)
+            c = self.resp_db.cursor()
+            c.executemany('''UPDATE resp_get SET gid = ? WHERE IIDX = ? ''', [(to_gid, iidx) for iidx in to_mv])
+            self.resp_db.commit()
+            for iidx in to_mv:
+                self.resp_store.move_get(iidx, to_gid)
+
+        self.send_generic_mesg(chat_id, '{0} moved: {1} => {2}'.format(len(to_mv), from_gid, to_gid), mesg_id)
+
+    # set pick weight of one resp or resp_get row
+    # ^/adm\s+(weight_kw|weight_get)\s+(\d+)\s+([\d.]+).*$
+    def adm_weight(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) < 4:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+            return
+
+        try:
+            iidx = int(cmd_toks[2])
+            weight = float(cmd_toks[3])
+            if not 0 <= weight < float('inf'):
+                raise ValueError(weight)
+        except ValueError:
+            self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
+            return
+
+        if cmd_toks[1].lower() == 'weight_kw':
+            table, set_weight = 'resp', self.resp_store.set_resp_weight
+        else:
+            table, set_weight = 'resp_get', self.resp_store.set_get_weight
+
+        with self.resp_write():
+            c = self.resp_db.cursor()
+            c.execute('UPDATE {0} SET weight = ? WHERE IIDX = ?'.format(table), (weight, iidx))
+            self.resp_db.commit()
+            row = set_weight(iidx, weight)
+
+        if row:
+            self.send_generic_mesg(chat_id, '{0} => w={1:g}'.format(iidx, weight), mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, '{0} not found.'.format(iidx), mesg_id)
+
+    # make keyword -> content
+    # ^/adm\s+mk_kw\s+([^\s]+)\s+(.+)$
+    def adm_mk_kw(self,
+                  update,
+                  cmd_toks):
+        chat_id = update.message.chat_id
+        mesg = update.message.text.strip()
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) > 3:
+            kw = cmd_toks[2].lower()
+            content = mesg[(mesg.find(cmd_toks[2]) + len(cmd_toks[2]) + 1):].strip()
 
+            if kw in self.symptom_tbl.keys():
+                self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, self.symptom_tbl[kw], content), mesg_id)
+                kw = self.symptom_tbl[kw]
+            else:
+                self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, content), mesg_id)
+
+            with self.resp_write():
+                c = self.resp_db.cursor()
                 c.execute('''INSERT INTO resp (keyword, cont) VALUES (?, ?) ''', ( kw, content, ))
                 self.resp_db.commit()
-                self.init_resp()
+                self.apply_resp_added(c.lastrowid, kw, content)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+
+    # make symptom -> keyword
+    # ^/adm\s+mk_sym\s+([^\s]+)\s+([^\s]+).*$
+    def adm_mk_sym(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) > 3:
+            kw_before = cmd_toks[2].lower()
+            kw_after = cmd_toks[3].lower()
+
+            if kw_before in self.symptom_tbl.keys():
+                self.send_generic_mesg(chat_id, 'Already exists: ({0} -> …) => …'.format(kw_before), mesg_id)
+            elif kw_before in self.kw_list:
+                self.send_generic_mesg(chat_id, 'Already exists: {0} => …'.format(kw_before), mesg_id)
             else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
-
-        # make symptom -> keyword
-        # ^/adm\s+mk_sym\s+([^\s]+)\s+([^\s]+).*$
-        elif cmd_entity == 'mk_sym':
-            if len(cmd_toks) > 3:
-                kw_before = cmd_toks[2].lower()
-                kw_after = cmd_toks[3].lower()
-
-                if kw_before in self.symptom_tbl.keys():
-                    self.send_generic_mesg(chat_id, 'Already exists: ({0} -> …) => …'.format(kw_before), mesg_id)
-                elif kw_before in self.kw_list:
-                    self.send_generic_mesg(chat_id, 'Already exists: {0} => …'.format(kw_before), mesg_id)
-                else:
-                    self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw_before, kw_after), mesg_id)
+                self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw_before, kw_after), mesg_id)
+                with self.resp_write():
+                    c = self.resp_db.cursor()
                     c.execute('''INSERT INTO symptom (before, after) VALUES (?, ?) ''', ( kw_before, kw_after, ))
                     self.resp_db.commit()
-                    self.init_resp()
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+                    self.apply_symptom_added(kw_before, kw_after)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
-         # make symptom -> keyword
-        # ^/adm\s+mk_sym\s+([^\s]+)\s+([^\s]+).*$
-        elif cmd_entity == 'mk_get_sym':
-            if len(cmd_toks) > 3:
-                kw_before = cmd_toks[2].lower()
-                kw_after = cmd_toks[3].lower()
+    # make get symptom -> keyword
+    def adm_mk_get_sym(self,
+                       update,
+                       cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-                self.send_generic_mesg(chat_id, 'Not implemented.\n({0} -> {1}) => …'.format(kw_before, kw_after), mesg_id)
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+        if len(cmd_toks) > 3:
+            kw_before = cmd_toks[2].lower()
+            kw_after = cmd_toks[3].lower()
 
-        # todo: assign index for each kw -> cont pair.
-        elif cmd_entity == 'rm_kw':
-            if len(cmd_toks) > 2:
-                try:
-                    to_rm = int(cmd_toks[2].lower())
+            self.send_generic_mesg(chat_id, 'Not implemented.\n({0} -> {1}) => …'.format(kw_before, kw_after), mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+
+    # todo: assign index for each kw -> cont pair.
+    def adm_rm_kw(self,
+                  update,
+                  cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) > 2:
+            try:
+                to_rm = int(cmd_toks[2].lower())
 
+                with self.resp_write():
+                    c = self.resp_db.cursor()
                     c.execute('''DELETE FROM resp WHERE IIDX = ? ''', ( to_rm, ))
                     self.resp_db.commit()
-                    self.init_resp()
+                    self.apply_resp_removed(to_rm)
 
-                    self.send_generic_mesg(chat_id, str(to_rm) + ' deleted.', mesg_id)
+                self.send_generic_mesg(chat_id, str(to_rm) + ' deleted.', mesg_id)
 
-                except ValueError:
-                    self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
+            except ValueError:
+                self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
 
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
-                
-        elif cmd_entity == 'rm_get':
-            if len(cmd_toks) > 2:
-                try:
-                    to_rm = int(cmd_toks[2].lower())
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
+    def adm_rm_get(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) > 2:
+            try:
+                to_rm = int(cmd_toks[2].lower())
+
+                with self.resp_write():
+                    c = self.resp_db.cursor()
                     c.execute('''DELETE FROM resp_get WHERE IIDX = ? ''', ( to_rm, ))
                     self.resp_db.commit()
-                    self.init_resp()
+                    self.apply_get_removed(to_rm)
 
-                    self.send_generic_mesg(chat_id, str(to_rm) + ' deleted.', mesg_id)
+                self.send_generic_mesg(chat_id, str(to_rm) + ' deleted.', mesg_id)
 
-                except ValueError:
-                    self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
+            except ValueError:
+                self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
 
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
-        elif cmd_entity == 'rm_get_sym':
-            not_implemented = 1
+    # compare incremental keyword lists with a full rebuild
+    def adm_chk_kw(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        with self.resp_lock:
+            mismatched = self.check_kw_lists()
+        if mismatched:
+            self.logger.error('keyword lists inconsistent: ' + ', '.join(mismatched))
+            self.init_resp()
+            self.send_generic_mesg(chat_id, 'inconsistent: {0}, reloaded.'.format(', '.join(mismatched)), mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, 'consistent.', mesg_id)
 
-        # list keyword
-        elif cmd_entity == 'ls_kw':
-            s_keys = self.symptom_tbl.keys()
-            if len(cmd_toks) > 2:
-                outmesg = ''
+    def adm_reload_cfg(self,
+                       update,
+                       cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-                kw = cmd_toks[2].lower()
-                if kw in self.symptom_get.keys():
-                    outmesg += '({0} -> {1}) => \n'.format(kw, self.symptom_tbl[kw])
-                    kw = self.symptom_tbl[kw]
-                else:
-                    outmesg += '{0} => \n'.format(kw)
+        # This handler holds the read side of reload_lock, so swap from another thread.
+        threading.Thread(target = self.reload_and_report, args = (chat_id, mesg_id),
+                         name = 'ConfigReload', daemon = True).start()
 
-                c.execute('''SELECT IIDX, cont FROM resp WHERE keyword = ? ORDER BY IIDX ASC;''', (kw, ))
-                for conts in c:
-                    outmesg += str(conts['IIDX']) + '. ' + conts['cont'] + '\n'
+    # list keyword
+    def adm_ls_kw(self,
+                  update,
+                  cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        if len(cmd_toks) > 2:
+            kw = cmd_toks[2].lower()
 
+            if kw in self.symptom_tbl.keys():
+                header = '({0} -> {1}) => '.format(kw, self.symptom_tbl[kw])
+                kw = self.symptom_tbl[kw]
             else:
-                outmesg = 'Supported keywords:\n'
-                for kw in self.unified_kw_list:
+                header = '{0} => '.format(kw)
+
+            def fetch(after, limit):
+                with self.resp_lock:
+                    rows = self.resp_store.list_resp(kw, after or 0, limit)
+                return [(conts['IIDX'], '{0}. {1}{2}'.format(conts['IIDX'], conts['cont'],
+                                                             ' (w={0:g})'.format(conts['weight']) if conts['weight'] != 1 else ''))
+                        for conts in rows]
+
+        else:
+            header = 'Supported keywords:'
+
+            def fetch(after, limit):
+                s_tbl = self.symptom_tbl
+                return [(kw, kw + ' -> ' + s_tbl[kw] if kw in s_tbl else kw)
+                        for kw in ResponseStore.page(self.unified_kw_list, after, limit)]
+
+        self.send_listing(chat_id, mesg_id, {'header': header, 'fetch': fetch, 'pages': [None]})
+
+    # full-text search over resp contents and /get keywords/tags
+    def adm_search(self,
+                   update,
+                   cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) < 3:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+            return
 
-                    if kw in s_keys:
-                        outmesg = outmesg + kw + ' -> ' + self.symptom_tbl[kw] + '\n'
+        terms = [t.lower() for t in cmd_toks[2:]]
+        with self.resp_lock:
+            resp_hits, get_hits = self.search_resp(terms)
+
+        # Ranked once, pages only render their slice.
+        hits = [('resp', i) for i in resp_hits] + [('get', i) for i in get_hits]
+
+        def fetch(after, limit):
+            start = 0 if after is None else after + 1
+            entries = []
+            with self.resp_lock:
+                for pos in range(start, min(start + limit, len(hits))):
+                    kind, iidx = hits[pos]
+                    if kind == 'resp':
+                        conts = self.resp_store.resp_rows.get(iidx)
+                        line = '{0}. [{1}] {2}'.format(iidx, conts['keyword'], conts['cont'][:80]) if conts else '{0}. (removed)'.format(iidx)
                     else:
-                        outmesg = outmesg + kw + '\n'
+                        conts = self.resp_store.get_rows.get(iidx)
+                        line = '/getid_{0} : [{1}] ({2})'.format(iidx, conts['keyword'], conts['tag'] or 'N/A') if conts else '/getid_{0} (removed)'.format(iidx)
+                    entries.append((pos, line))
+            return entries
+
+        header = '{0}: {1} kw, {2} get'.format(' '.join(terms), len(resp_hits), len(get_hits))
+        self.send_listing(chat_id, mesg_id, {'header': header, 'fetch': fetch, 'pages': [None]})
+
+    # next page of the last ls_kw/ls_get/search
+    def adm_next(self,
+                 update,
+                 cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        cursor = self.get_ls_cursor(chat_id)
+        if not cursor or cursor['last'] is None:
+            self.send_generic_mesg(chat_id, 'no more.', mesg_id)
+            return
 
-        else:
-            self.send_generic_mesg(chat_id, 'adm what? owo', mesg_id)
+        cursor['pages'].append(cursor['last'])
+        self.send_listing(chat_id, mesg_id, cursor)
+
+    # previous page of the last ls_kw/ls_get/search
+    def adm_prev(self,
+                 update,
+                 cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        cursor = self.get_ls_cursor(chat_id)
+        if not cursor or len(cursor['pages']) < 2:
+            self.send_generic_mesg(chat_id, 'no previous page.', mesg_id)
+            return
+
+        cursor['pages'].pop()
+        self.send_listing(chat_id, mesg_id, cursor)
+
+    def get_ls_cursor(self,
+                      chat_id):
+        """
+        Returns:
+            Listing cursor of chat_id, None when there is none or it is older
+            than self.config['ls_cursor_ttl'] seconds (1 hour by default).
+        """
+        with self.state_lock:
+            cursor = self.ls_cursors.get(chat_id)
+            if cursor is None:
+                return None
+
+            if time.monotonic() - cursor['time'] >= self.config.get('ls_cursor_ttl', 3600):
+                del self.ls_cursors[chat_id]
+                return None
+
+            return cursor
+
+    def put_ls_cursor(self,
+                      chat_id,
+                      cursor):
+        """
+        Keep cursor as the most recently used, then drop expired cursors and
+        the least recently used ones beyond self.config['ls_cursor_max'] (100 by default).
+        """
+        now = time.monotonic()
+        ttl = self.config.get('ls_cursor_ttl', 3600)
+        cursor['time'] = now
+
+        with self.state_lock:
+            self.ls_cursors[chat_id] = cursor
+            self.ls_cursors.move_to_end(chat_id)
+
+            while self.ls_cursors:
+                first = next(iter(self.ls_cursors.values()))
+                if now - first['time'] < ttl:
+                    break
+                self.ls_cursors.popitem(last = False)
+
+            while len(self.ls_cursors) > self.config.get('ls_cursor_max', 100):
+                self.ls_cursors.popitem(last = False)
+
+    def send_listing(self,
+                     chat_id,
+                     mesg_id,
+                     cursor):
+        """
+        Send one page of a listing and keep its cursor for /adm next and prev.
+
+        Pages are keyset based: a page is the ls_page_size entries after the
+        last key of the previous page, so paging never rebuilds the whole
+        listing and rows added meanwhile do not shift it.
+
+        Args:
+            chat_id (int):
+                Chat to send to.
+            mesg_id (int):
+                Message to reply to.
+            cursor (dict):
+                'header' (str), 'fetch' (func(after, limit) -> [(key, line)])
+                and 'pages' (list of the after key of every page so far).
+                'last' is set to the key to resume from, None on the last page,
+                and 'time' to when it was last used.
+        """
+        page_size = self.config.get('ls_page_size', 100)
+        entries = cursor['fetch'](cursor['pages'][-1], page_size + 1)
+
+        more = len(entries) > page_size
+        entries = entries[:page_size]
+        cursor['last'] = entries[-1][0] if more else None
+        self.put_ls_cursor(chat_id, cursor)
+
+        footer = 'page {0}'.format(len(cursor['pages']))
+        if more:
+            footer += ', /adm next'
+        if len(cursor['pages']) > 1:
+            footer += ', /adm prev'
+
+        outmesg = '\n'.join([cursor['header']] + [line for key, line in entries] + [footer])
+        for chunk in self.split_text(outmesg):
+            self.send_generic_mesg(chat_id, chunk, mesg_id)
 
     def handle_cmd(self,
                    update):
@@ -794,80 +4472,115 @@ class AFXBot:
         Returns:
             True when the command is handled, otherwise False.
         """
-        chat_id = update.message.chat_id
-        restricted = not self.do_operational_auth(chat_id)
-        mesg = update.message.text
-        mesg_id = update.message.message_id
-        mesg_low = mesg.lower().replace('@afx_bot', '')
+        cmd_toks = self.split_cmd(update.message.text)
+        if not cmd_toks:
+            return False
 
-        cmd_toks = [x.strip() for x in mesg.split(' ')]
-        while '' in cmd_toks:
-            cmd_toks.remove('')
+        # '/roll@AFX_bot'; a command addressed to another bot is not ours.
+        name, at, bot_name = cmd_toks[0].lower().partition('@')
+        if at and bot_name != self.BOT_USERNAME:
+            return False
 
-        if mesg_low.startswith('/get ') and not restricted:
-            keyword = cmd_toks[1].lower()
+        # '/getid_123'
+        if name.startswith('/getid_'):
+            name = '/getid'
 
-            if len(cmd_toks) > 2:
-                tag = cmd_toks[2].lower()
-                self.logger.debug('keyword: ' + keyword)
-                self.logger.debug('tag: ' + tag)
-            else:
-                tag = None
-                self.logger.debug('keyword: ' + keyword)
+        entry = self.cmd_table.get(name)
+        if not entry:
+            return False
 
-            if keyword in self.symptom_get.keys():
-                keyword = self.symptom_get[keyword]
+        handler, auth = entry
+        if auth and not self.get_roles(update.message.chat_id) & auth:
+            return False
 
-            if keyword in self.kw_list_get:
-                c = self.resp_db.cursor()
-                x = None
+        return handler(update, cmd_toks)
 
-                if tag :
-                    c.execute('''SELECT cont FROM resp_get WHERE keyword = ? AND tag = ? ORDER BY RANDOM() LIMIT 1;''', ( keyword, tag, ))
-                    x = c.fetchone()
+    def cmd_get(self,
+                update,
+                cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-                if not x:
-                    c.execute('''SELECT cont FROM resp_get WHERE keyword = ? ORDER BY RANDOM() LIMIT 1;''', ( keyword, ))
-                    x = c.fetchone()
+        if len(cmd_toks) < 2:
+            return False
 
-                if x:
-                    self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = str(x['cont']));
-                else:
-                    self.send_generic_mesg(chat_id, 'Something goes wrong! D:', mesg_id)
-            else:
-                self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
+        keyword = cmd_toks[1].lower()
 
-            return True
+        if len(cmd_toks) > 2:
+            tag = cmd_toks[2].lower()
+            self.logger.debug('keyword: ' + keyword)
+            self.logger.debug('tag: ' + tag)
+        else:
+            tag = None
+            self.logger.debug('keyword: ' + keyword)
 
-        # Get picture directly by given resp ID.
-        elif mesg_low.startswith('/getid') and not restricted:
-            if len(cmd_toks) > 1:
-                res_get_id = cmd_toks[1]
-            else:
-                res_get_id = mesg_low[7:]
+        if keyword in self.symptom_get.keys():
+            keyword = self.symptom_get[keyword]
 
-            c = self.resp_db.cursor()
-            c.execute('''SELECT cont FROM resp_get WHERE IIDX = ? LIMIT 1;''', (res_get_id,))
-            x = c.fetchone()
+        with self.resp_lock:
+            has = self.resp_store.has_get(keyword, self.chat_gid(chat_id))
+            if has:
+                x = self.resp_store.pick_get(keyword, tag, self.chat_gid(chat_id),
+                                             self.recent_picks(chat_id, 'resp_get', keyword))
 
+        if has:
             if x:
-                self.bot.sendPhoto(chat_id=chat_id, reply_to_message_id=mesg_id, photo=str(x['cont']));
+                self.send_photo(chat_id, str(x['cont']), mesg_id)
             else:
-                self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
+                self.send_generic_mesg(chat_id, 'Something goes wrong! D:', mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
 
-            return True
+        return True
 
-        elif mesg == '/roll@AFX_bot':
-            self.send_generic_mesg(chat_id, self.strs['r_roll_cmd_help'], mesg_id)
+    # Get picture directly by given resp ID.
+    def cmd_getid(self,
+                  update,
+                  cmd_toks):
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if len(cmd_toks) > 1:
+            res_get_id = cmd_toks[1]
+        else:
+            res_get_id = cmd_toks[0].partition('@')[0].partition('_')[2]
+
+        try:
+            iidx = int(res_get_id)
+        except ValueError:
+            iidx = None
+
+        with self.resp_lock:
+            x = self.resp_store.get_rows.get(iidx)
+
+        # Pictures of other groups only for admins.
+        if x and not self.get_roles(update.message.from_user.id) & self.ROLE_ADM \
+                and x['gid'] not in (self.chat_gid(chat_id), -1):
+            x = None
+
+        if x:
+            self.send_photo(chat_id, str(x['cont']), mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
+
+        return True
+
+    def cmd_roll(self,
+                 update,
+                 cmd_toks):
+        if update.message.text == '/roll@AFX_bot':
+            self.send_generic_mesg(update.message.chat_id, self.strs['r_roll_cmd_help'], update.message.message_id)
             return True
 
-        elif mesg_low.startswith('/roll ') or mesg_low == '/roll':
-            return self.handle_roll(update)
+        return self.handle_roll(update)
 
-        elif mesg == '/crash':
-            raise Exception('Crash!')
-            
-        return False
+    def cmd_crash(self,
+                  update,
+                  cmd_toks):
+        if update.message.text != '/crash':
+            return False
+
+        raise Exception('Crash!')
 
     def handle_response(self,
                       update):
@@ -888,39 +4601,101 @@ class AFXBot:
 
         # hardcoded...
         if    'ass' in mesg_low and not 'pass' in mesg_low:
-            self.send_generic_mesg(chat_id, 'Ood', mesg_id)
+            self.send_generic_mesg(chat_id, 'Ood', mesg_id, SendScheduler.PRIO_AUTO)
             return True
 
         if    user_id == 99786298 and chat_id == -1001069764018:
-            self.send_generic_mesg(chat_id, '喔喔', mesg_id)
+            self.send_generic_mesg(chat_id, '喔喔', mesg_id, SendScheduler.PRIO_AUTO)
             return True
 
         if ('蕉姐' in mesg_low or '蕉姊' in mesg_low or '香蕉' in mesg_low) and ('幾' in mesg_low or '多少' in mesg_low) :
-            self.send_generic_mesg(chat_id, '3064', mesg_id)
+            self.send_generic_mesg(chat_id, '3064', mesg_id, SendScheduler.PRIO_AUTO)
             return True
 
 
-        random.shuffle(self.unified_kw_list)
-        s_keys = self.symptom_tbl.keys()
+        with self.resp_lock:
+            kw = self.pick_keyword(self.kw_automaton.find_all(mesg_low))
 
-        # convert kw
-        for kw in self.unified_kw_list:
-            if kw in mesg_low:
-                if kw in s_keys:
-                    unified_kw = self.symptom_tbl[kw]
-                    self.logger.debug('keyword: ' + kw + ' -> ' + unified_kw)
-                else:
-                    unified_kw = kw
-                    self.logger.debug('keyword: ' + kw )
+            # convert kw
+            if kw:
+                unified_kw = self.symptom_tbl.get(kw, kw)
+                if self.log_enabled('response'):
+                    self.logger.debug('keyword: %s -> %s', kw, unified_kw, extra = {'category': 'response'})
 
-                c = self.resp_db.cursor()
-                c.execute('''SELECT cont FROM resp WHERE keyword = ? ORDER BY RANDOM() LIMIT 1;''', ( unified_kw, ))
-                x = c.fetchone()
-                self.send_generic_mesg(chat_id, str(x['cont']), mesg_id)
+                x = self.resp_store.pick_resp(unified_kw, self.recent_picks(chat_id, 'resp', unified_kw))
+
+        if kw:
+            if x:
+                self.send_generic_mesg(chat_id, str(x['cont']), mesg_id, SendScheduler.PRIO_AUTO)
                 return True
 
         return False
 
+    def recent_picks(self,
+                     chat_id,
+                     table,
+                     keyword):
+        """
+        Called under resp_lock. Windows unused for config['no_repeat_ttl']
+        seconds (1 hour by default) are forgotten, and at most
+        config['no_repeat_max_entries'] (10000 by default) are kept, the
+        least recently used going first.
+
+        Returns:
+            deque of the last config['no_repeat_window'] (default 3) IIDX
+            picked from table for keyword in chat_id, or None when the
+            window is 0.
+        """
+        window = self.config.get('no_repeat_window', 3)
+        if window <= 0:
+            return None
+
+        now = time.monotonic()
+        ttl = self.config.get('no_repeat_ttl', 3600)
+        key = (chat_id, table, keyword)
+
+        entry = self.recent.pop(key, None)
+        recent = entry[1] if entry and now - entry[0] < ttl else None
+        if recent is None or recent.maxlen != window:
+            recent = deque(recent or (), maxlen = window)
+        self.recent[key] = (now, recent)
+
+        # Sweep expired windows from the least recently used end.
+        while self.recent:
+            first = next(iter(self.recent.values()))
+            if now - first[0] < ttl:
+                break
+            self.recent.popitem(last = False)
+
+        while len(self.recent) > self.config.get('no_repeat_max_entries', 10000):
+            self.recent.popitem(last = False)
+        return recent
+
+    def pick_keyword(self,
+                     matched):
+        """
+        Pick one keyword among all matched ones.
+
+        The policy comes from self.config['kw_match_policy']:
+            'random' (default): uniformly random among matches.
+            'longest': longest match wins, ties are broken randomly.
+
+        Args:
+            matched (set):
+                Keywords found in message.
+        Returns:
+            The picked keyword, or None when nothing matched.
+        """
+        if not matched:
+            return None
+
+        candidates = list(matched)
+        if self.config.get('kw_match_policy') == 'longest':
+            longest = max(len(kw) for kw in candidates)
+            candidates = [kw for kw in candidates if len(kw) == longest]
+
+        return random.choice(candidates)
+
     def handle_roll(self,
                                     update):
         """
@@ -931,7 +4706,7 @@ class AFXBot:
                 Update object to handle.
         """
         chat_id = update.message.chat_id
-        mesg_low = update.message.text.lower()
+        mesg_low = update.message.text.lower().replace('@afx_bot', '')
         mesg_id = update.message.message_id
 
         if mesg_low == '/roll':
@@ -939,59 +4714,24 @@ class AFXBot:
         else:
             d_cmd = mesg_low[6:].strip()
 
-        # XdYsZ
-        res = re.match('([0-9]+)d([0-9]+)s([0-9]+)', d_cmd)
-        if res:
-            dn = int(res.group(1))
-            dt = int(res.group(2))
-            ds = int(res.group(3))
-            dstr = '('
-            succ = 0
-
-            if dn > 100: dn = 100
-
-            for i in range(dn):
-                val = random.randint(1, dt)
-                if val >= ds: succ += 1
-                dstr += str(val) + ', '
-
-            dstr = '{0}d{1}s{2} : {3}) >= {2}, 成功 {4} 次'.format(dn, dt, ds, dstr[:-2], succ);
-            self.send_generic_mesg(chat_id, dstr, mesg_id)
-            return True
-
-        # XdY[+-Z]
-        res = re.match('([0-9]+)d([0-9]+)([+-][0-9]+)?', d_cmd)
-        if res:
-            dn = int(res.group(1))
-            dt = int(res.group(2))
-            if res.group(3):
-                dm = int(res.group(3))
-            else:
-                dm =    0;
-
-            dstr = '('
-            sum = 0
-
-            if dn > 100: dn = 100
+        try:
+            is_dice = any(len(t) > 2 for t in self.dice.parse(d_cmd)[1])
+        except ValueError:
+            is_dice = False
 
-            for i in range(dn):
-                val = random.randint(1, dt)
-                sum += val
-                dstr += str(val) + ', '
+        # Dice expression, e.g. 2d6+3, 4d6kh3, 6d10!s8
+        if is_dice:
+            try:
+                dstr = self.dice.roll(d_cmd)
+            except ValueError as ex:
+                self.send_generic_mesg(chat_id, 'roll: {0}'.format(ex), mesg_id)
+                return True
 
-            if dm == 0:
-                dstr = '{0}d{1} : {2}) = {3}'.format(dn, dt, dstr[:-2], sum);
-            else:
-                if dm > 0:
-                    dm_str = '+' + str(dm)
-                else:
-                    dm_str = str(dm)
-                dstr = '{0}d{1}{2} : {3}) {2} = {4} {2} = {5}'.format(dn, dt, dm_str, dstr[:-2], sum, sum+dm);
             self.send_generic_mesg(chat_id, dstr, mesg_id)
             return True
 
         # X[-Y]
-        res = re.match('([0-9]+)(-([0-9]+))?', d_cmd)
+        res = self.ROLL_RANGE_RE.fullmatch(d_cmd)
         if res:
             if res.group(3):
                 dl = int(res.group(1))
@@ -1055,6 +4795,9 @@ class AFXBot:
         """
         Handles MotD query and update requests.
 
+        `/motd history YYYY-MM-DD` looks up an earlier MotD; any other
+        text after `/motd` becomes the new MotD.
+
         Args:
             update (telegram.update):
                 Update object to handle.
@@ -1069,30 +4812,32 @@ class AFXBot:
         mesg = update.message.text.replace('@afx_bot', '')
         mesg_low = mesg.lower()
 
-        schat_id = str(chat_id)
-        motd_update_match_res = re.match('^/motd[\s\n]+(.+)', mesg, re.IGNORECASE | re.DOTALL)
+        motd_history_match_res = re.match(r'^/motd\s+history\s+(\S+)\s*$', mesg, re.IGNORECASE)
+        motd_update_match_res = re.match(r'^/motd\s+(.+)', mesg, re.IGNORECASE | re.DOTALL)
 
         if mesg_low == '/motd':    # print motd
             self.send_motd(chat_id, mesg_id)
+        elif motd_history_match_res:
+            try:
+                day = datetime.strptime(motd_history_match_res.group(1), '%Y-%m-%d').date()
+            except ValueError:
+                self.send_generic_mesg(chat_id, self.strs['r_motd_no'], mesg_id)
+                return
+
+            msg = self.motd_store.history(chat_id, day)
+            if msg is None:
+                self.send_generic_mesg(chat_id, self.strs['r_motd_no'], mesg_id)
+            else:
+                self.send_generic_mesg(chat_id, self.strs['r_motd_ok'].format(date = motd_history_match_res.group(1), motd = msg), mesg_id)
         elif motd_update_match_res:
             motd_cmd = motd_update_match_res.group(1).strip()
+            today = date.today()
 
-            if not schat_id in self.motds.keys():
-                self.motds[schat_id] = dict()
+            # Written to motd_db in background.
+            self.motd_store.set(chat_id, motd_cmd, today)
 
-            self.motds[schat_id]['msg'] = motd_cmd
-            self.motds[schat_id]['date'] = date.today()
-
-            today_str = datetime.strftime(self.motds[schat_id]['date'], '%Y-%m-%d')
-            self.logger.info('MOTD: \n'+self.motds[schat_id]['msg'])
-
-            try:
-                self.logger.info('writing MOTD contents')
-                with open('motd.json', 'w') as f:
-                    json.dump(self.motds, f, default=self.json_serial)
-                    f.close()
-            except Exception as ex:
-                logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
+            today_str = datetime.strftime(today, '%Y-%m-%d')
+            self.logger.info('MOTD: \n'+motd_cmd)
 
             self.send_generic_mesg(chat_id, self.strs['r_motd_updated'].format(date = today_str), mesg_id)
         else:
@@ -1138,82 +4883,93 @@ class AFXBot:
         Returns:
             True when anti-flood response is sent, otherwise False.
         """
-        # Must convert id's into string for dict storage.
         chat_id = update.message.chat_id
         message = update.message.text
-        date = update.message.date
+        now = update.message.date.timestamp()
         mesg_id = update.message.message_id
         user_id = update.message.from_user.id
 
-        schat_id = str(chat_id)
-        suser_id = str(user_id)
-        washsnake_content = message.lower().strip()
-        if not str(chat_id) in self.wash_record.keys():
-            self.wash_record[schat_id] = dict()
+        key = (chat_id, user_id)
+        washsnake_content = hash(message.lower().strip())
 
         # random angry...
-        if random.randint(1, 1000) >= 995 and chat_id in self.config['invasive_washsnake_chats']:
-            self.logger.debug('random angry triggered for {0} - {1}'.format(chat_id, mesg_id))
-            self.send_generic_mesg(chat_id, random.choice(self.strs['r_invasive_random_angry_strs']), mesg_id)
-        elif not suser_id in self.wash_record[schat_id].keys():
-            self.logger.debug('new washsnake content for ' + suser_id)
-            self.wash_record[schat_id][suser_id] = WashSnake(date, washsnake_content)
+        invasive = self.get_roles(chat_id) & self.ROLE_INVASIVE_WASHSNAKE
+        if random.randint(1, 1000) >= 995 and invasive:
+            self.logger.debug('random angry triggered for %s - %s', chat_id, mesg_id)
+            self.send_generic_mesg(chat_id, random.choice(self.strs['r_invasive_random_angry_strs']), mesg_id, SendScheduler.PRIO_AUTO)
+            return False
+
+        # Entries older than the window are already dropped by the table.
+        hit = self.wash_record.hit(key, washsnake_content, now)
+        if not hit:
+            if self.log_enabled('washsnake'):
+                self.logger.debug('new washsnake content for %s', user_id, extra = {'category': 'washsnake'})
         else:
-            # check
-            washsnake_entry = self.wash_record[schat_id][suser_id];
-            if washsnake_entry.content == washsnake_content:
-                # same content, check time
-                time_delta = date - washsnake_entry.firsttime
-                self.logger.debug('washsnake_entry.firsttime = ' + str(washsnake_entry.firsttime))
-                self.logger.debug('date = ' + str(date))
-                self.logger.debug('time_delta = ' + str(time_delta))
-
-                if time_delta < timedelta(seconds=60):
-                    self.logger.debug('wash ++ for ' + str(update.message))
-                    self.wash_record[schat_id][suser_id].repeattimes += 1;
-                    if washsnake_entry.repeattimes >= 2:
-                        if not washsnake_entry.responded:
-                            # WASH SNAKE!!
-                            if chat_id in self.config['invasive_washsnake_chats'] or self.do_adm_auth(user_id):
-                                self.send_generic_mesg(chat_id, random.choice(self.wash_snake_strs_unified), mesg_id)
-                            else:
-                                self.send_generic_mesg(chat_id, random.choice(self.strs['r_wash_snake_strs']), mesg_id)
-                            self.wash_record[schat_id][suser_id].responded = True
-
-                        return True
-                else:
-                    # reset wash snake counter...
-                    self.wash_record[schat_id][suser_id].responded = False
-                    self.wash_record[schat_id][suser_id].firsttime = update.message.date
-                    self.wash_record[schat_id][suser_id].repeattimes = 0
-            else:
-                self.logger.debug('update wash for ' + suser_id)
-                self.wash_record[schat_id][suser_id] = WashSnake(update.message.date, washsnake_content)
+            if self.log_enabled('washsnake'):
+                self.logger.debug('wash ++ for %s in %s', user_id, chat_id, extra = {'category': 'washsnake'})
+            repeattimes, respond = hit
+            if repeattimes >= 2:
+                if respond:
+                    # WASH SNAKE!!
+                    if invasive or self.do_adm_auth(user_id):
+                        self.send_generic_mesg(chat_id, random.choice(self.wash_snake_strs_unified), mesg_id, SendScheduler.PRIO_AUTO)
+                    else:
+                        self.send_generic_mesg(chat_id, random.choice(self.strs['r_wash_snake_strs']), mesg_id, SendScheduler.PRIO_AUTO)
+
+                return True
 
         return False
 
     def set_is_running(self,
-                                         flag):
-        """Assign flag to is_running."""
-        self.is_running = flag
+                       flag):
+        """Assign flag to is_running, shared with the other shards."""
+        with self.state_lock:
+            self.is_running = flag
+        if self.shard:
+            self.set_state('is_running', int(flag))
 
     def set_is_accepting_photos(self,
-                                      flag):
-        """Assign flag to is_accepting_photos."""
-        self.is_accepting_photos = flag
-
-    @staticmethod
-    def execute_callbacks(bcblist,
-                          update):
-        """Run registered callbacks."""
-        for bcb in bcblist:
-            if bcb.execute(update):
-                return True
-        return False
+                                flag):
+        """Assign flag to is_accepting_photos, shared with the other shards."""
+        with self.state_lock:
+            self.is_accepting_photos = flag
+        if self.shard:
+            self.set_state('is_accepting_photos', int(flag))
 
     def register_callbacks(self):
         """Register callbacks."""
 
+        # Common commands, with the chat roles they need.
+        self.cmd_table = dict()
+        self.register_command('/get', self.cmd_get, self.AUTH_OPERATIONAL)
+        self.register_command('/getid', self.cmd_getid, self.AUTH_OPERATIONAL)
+        self.register_command('/roll', self.cmd_roll)
+        self.register_command('/crash', self.cmd_crash)
+
+        # /adm <entity>, admins only.
+        self.adm_cmd_table = dict()
+        self.register_adm_command('begin_get', self.adm_begin_get)
+        self.register_adm_command('end_get', self.adm_end_get)
+        self.register_adm_command('mk_get', self.adm_mk_get)
+        self.register_adm_command('getpic_id', self.adm_getpic_id)
+        self.register_adm_command('ed_get', self.adm_not_implemented)
+        self.register_adm_command('mk_get_sym', self.adm_mk_get_sym)
+        self.register_adm_command('ls_get', self.adm_ls_get)
+        self.register_adm_command('mv_get', self.adm_mv_get)
+        self.register_adm_command('weight_get', self.adm_weight)
+        self.register_adm_command('mk_kw', self.adm_mk_kw)
+        self.register_adm_command('mk_sym', self.adm_mk_sym)
+        self.register_adm_command('rm_kw', self.adm_rm_kw)
+        self.register_adm_command('weight_kw', self.adm_weight)
+        self.register_adm_command('rm_get', self.adm_rm_get)
+        self.register_adm_command('rm_get_sym', self.adm_not_implemented)
+        self.register_adm_command('chk_kw', self.adm_chk_kw)
+        self.register_adm_command('ls_kw', self.adm_ls_kw)
+        self.register_adm_command('search', self.adm_search)
+        self.register_adm_command('next', self.adm_next)
+        self.register_adm_command('prev', self.adm_prev)
+        self.register_adm_command('reload_cfg', self.adm_reload_cfg)
+
         # For restricted chats, only restricted commands and fortune teller works.
         self.bot_callbacks_restricted = [
             self.BotCallback('call_cmd_handler_bcb',
@@ -1284,6 +5040,8 @@ class AFXBot:
                              lambda update: self.match_fortune_type(update.message.text))
         ]
 
+        self.bot_router_restricted = CommandRouter(self.bot_callbacks_restricted)
+        self.bot_router = CommandRouter(self.bot_callbacks)
 
     class BotCallback:
         """
@@ -1324,38 +5082,61 @@ class AFXBot:
             self.cond_callback = cond_callback
 
 
+        def matches(self,
+                    update):
+            """Returns: True when this callback accepts update."""
+            if 'q_kw' in self.strs.keys():
+                return update.message.text.startswith(self.strs['q_kw'])
+            return bool(self.cond_callback(update))
+
         def execute(self, update):
             """Execute defined callback function."""
-            mesg = update.message.text
+            if self.matches(update):
+                return self.run(update)
+            else:
+                return False
+
+        def run(self,
+                update):
+            """Run handler, with admin check, for an already matched update."""
             chat_id = update.message.chat_id
             mesg_id = update.message.message_id
             user_id = update.message.from_user.id
 
-            if 'q_kw' in self.strs.keys():
-                cond = mesg.startswith(self.strs['q_kw'])
-            else:
-                cond = self.cond_callback(update)
-
-            if cond:
-                if (self.bot.do_adm_auth(user_id) and self.need_adm) or not self.need_adm:
+            if (self.bot.do_adm_auth(user_id) and self.need_adm) or not self.need_adm:
+                # Admin replies go ahead of everything else.
+                prio = SendScheduler.PRIO_ADM if self.need_adm else SendScheduler.PRIO_NORMAL
+                with self.bot.send_priority(prio), self.bot.metrics.timer('callback', self.name):
                     if self.handler_callback:
                         self.handler_callback(update)
 
                     if 'r_ok' in self.strs.keys():
                         self.bot.send_generic_mesg(chat_id, self.strs['r_ok'], mesg_id)
 
-                    return True
-                else:
-                    if 'r_ok' in self.strs.keys():
-                        self.bot.send_generic_mesg(chat_id, self.strs['r_ng'], mesg_id)
-
-                    return True
+                return True
             else:
-                return False
+                if 'r_ok' in self.strs.keys():
+                    self.bot.send_generic_mesg(chat_id, self.strs['r_ng'], mesg_id)
+
+                return True
+
+def shard_worker_main(conf_file_name,
+                      index,
+                      count,
+                      updates,
+                      acks):
+    """Entry of shard worker process index of count, see AFXBot.run_sharded."""
+    bot = AFXBot(conf_file_name, shard = (index, count))
+    bot.run_shard(updates, acks)
 
 def main():
     bot = AFXBot('config.json')
-    bot.run()
+    if bot.config.get('runner') == 'async':
+        bot.run_async()
+    elif bot.config.get('runner') == 'sharded':
+        bot.run_sharded()
+    else:
+        bot.run()
 
 if __name__ == '__main__':
     main()
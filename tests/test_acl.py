@@ -0,0 +1,60 @@
+import json
+import os
+import unittest
+
+from afxbot import AFXBot
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.example.json')
+
+LISTS = ['adm_ids', 'operational_chats', 'restricted_chats', 'motd_only_chats', 'invasive_washsnake_chats']
+
+# Checks as done on the config lists before they were compiled into roles.
+OLD_CHECKS = [
+    ('adm', AFXBot.do_adm_auth,
+     lambda c, id: id in c['adm_ids']),
+    ('operational', AFXBot.do_operational_auth,
+     lambda c, id: id in c['operational_chats'] or id in c['adm_ids']),
+    ('augmented', AFXBot.do_augmented_auth,
+     lambda c, id: id in c['operational_chats'] or id in c['adm_ids']
+                   or id in c['restricted_chats'] or id in c['motd_only_chats']),
+    ('restricted', lambda bot, id: bool(bot.get_roles(id) & AFXBot.ROLE_RESTRICTED),
+     lambda c, id: id in c['restricted_chats']),
+    ('motd_only', lambda bot, id: bool(bot.get_roles(id) & AFXBot.ROLE_MOTD_ONLY),
+     lambda c, id: id in c['motd_only_chats']),
+    ('invasive', lambda bot, id: bool(bot.get_roles(id) & AFXBot.ROLE_INVASIVE_WASHSNAKE),
+     lambda c, id: id in c['invasive_washsnake_chats']),
+]
+
+
+class AclTest(unittest.TestCase):
+
+    def check(self, config):
+        for name in LISTS:
+            config.setdefault(name, [])
+        bot = AFXBot.__new__(AFXBot)
+        bot.config = config
+        bot.acl = AFXBot.build_acl(config)
+
+        ids = {id for name in LISTS for id in config[name]} | {0, 1, -1, 424242}
+        for id in sorted(ids):
+            for name, new, old in OLD_CHECKS:
+                self.assertEqual(new(bot, id), old(config, id), '{0} of {1}'.format(name, id))
+
+    def test_example_config(self):
+        with open(EXAMPLE_CONFIG, 'r', encoding = 'utf8') as f:
+            self.check(json.load(f))
+
+    def test_overlapping_lists(self):
+        self.check({'adm_ids': [5, 6],
+                    'operational_chats': [-10, 5],
+                    'restricted_chats': [-20, -10],
+                    'motd_only_chats': [-30, -20],
+                    'invasive_washsnake_chats': [-10, -40]})
+
+    def test_missing_lists(self):
+        acl = AFXBot.build_acl({'adm_ids': [5], 'restricted_chats': None})
+        self.assertEqual(acl, {5: AFXBot.ROLE_ADM})
+
+
+if __name__ == '__main__':
+    unittest.main()
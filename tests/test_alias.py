@@ -0,0 +1,95 @@
+import random
+import unittest
+from collections import Counter, OrderedDict, deque
+from unittest import mock
+
+from afxbot import AFXBot, ResponseStore
+
+
+class BuildAliasTest(unittest.TestCase):
+
+    def test_uniform(self):
+        self.assertIsNone(ResponseStore.build_alias([1, 1, 1]))
+        self.assertIsNone(ResponseStore.build_alias([2.5]))
+
+    def test_nothing_to_pick(self):
+        self.assertEqual(ResponseStore.build_alias([0, 0]), ())
+
+    def test_probabilities(self):
+        weights = [1, 2, 0, 5]
+        prob, alias = ResponseStore.build_alias(weights)
+        n = len(weights)
+        share = [0.0] * n
+        for i in range(n):
+            share[i] += prob[i] / n
+            share[alias[i]] += (1 - prob[i]) / n
+        for i, w in enumerate(weights):
+            self.assertAlmostEqual(share[i], w / sum(weights))
+
+
+class SampleTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1234)
+        self.store = ResponseStore()
+
+    def test_weighted_frequencies(self):
+        for iidx, weight in ((1, 1), (2, 3), (3, 0)):
+            self.store.add_resp(iidx, 'kw', 'c', weight)
+        counts = Counter(self.store.pick_resp('kw')['IIDX'] for _ in range(4000))
+        self.assertEqual(counts[3], 0)
+        self.assertAlmostEqual(counts[2] / 4000, 0.75, delta = 0.03)
+
+    def test_all_zero_weights_pick_nothing(self):
+        self.store.add_resp(1, 'kw', 'c', 0)
+        self.store.add_resp(2, 'kw', 'c', 0)
+        self.assertIsNone(self.store.pick_resp('kw'))
+
+    def test_zero_weight_partition_falls_back_to_global(self):
+        self.store.add_get(1, 'kw', 'local', None, -100, 0)
+        self.store.add_get(2, 'kw', 'global', None, -1, 1)
+        self.assertEqual(self.store.pick_get('kw', gid = -100)['cont'], 'global')
+
+    def test_recent_is_avoided(self):
+        for iidx in range(1, 5):
+            self.store.add_resp(iidx, 'kw', 'c', 1)
+        picks = []
+        window = deque(maxlen = 2)
+        for _ in range(50):
+            picks.append(self.store.pick_resp('kw', window)['IIDX'])
+        self.assertTrue(all(a != b for a, b in zip(picks, picks[1:])))
+
+
+class RecentPicksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.config = {'no_repeat_window': 3, 'no_repeat_ttl': 60, 'no_repeat_max_entries': 2}
+        self.bot.recent = OrderedDict()
+
+    @mock.patch('afxbot.time.monotonic')
+    def test_window_kept_and_expired(self, monotonic):
+        monotonic.return_value = 100.0
+        recent = self.bot.recent_picks(1, 'resp', 'kw')
+        recent.append(7)
+        monotonic.return_value = 150.0
+        self.assertEqual(list(self.bot.recent_picks(1, 'resp', 'kw')), [7])
+        monotonic.return_value = 210.0
+        self.assertEqual(list(self.bot.recent_picks(1, 'resp', 'kw')), [])
+
+    @mock.patch('afxbot.time.monotonic')
+    def test_cap_drops_least_recently_used(self, monotonic):
+        monotonic.return_value = 100.0
+        self.bot.recent_picks(1, 'resp', 'a')
+        self.bot.recent_picks(1, 'resp', 'b')
+        self.bot.recent_picks(1, 'resp', 'a')
+        self.bot.recent_picks(1, 'resp', 'c')
+        self.assertEqual(list(self.bot.recent), [(1, 'resp', 'a'), (1, 'resp', 'c')])
+
+    def test_disabled(self):
+        self.bot.config['no_repeat_window'] = 0
+        self.assertIsNone(self.bot.recent_picks(1, 'resp', 'kw'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import random
+import threading
+import time
+import types
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from afxbot import AFXBot
+
+
+def update(update_id, chat_id):
+    return types.SimpleNamespace(update_id = update_id, message = types.SimpleNamespace(chat_id = chat_id))
+
+
+class AsyncDispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.config = {'async_idle_timeout': 0.2}
+        self.bot.logger = mock.Mock()
+        self.bot.chat_queues = dict()
+        self.bot.inflight_updates = set()
+        self.bot.webhook_server = None
+        self.bot.handler_executor = ThreadPoolExecutor(max_workers = 4)
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.bot.handler_executor.shutdown()
+
+    def run_dispatch(self, updates):
+        async def main():
+            for u in updates:
+                self.bot.inflight_updates.add(u.update_id)
+                self.bot.dispatch_async(u)
+            while self.bot.chat_queues:
+                await asyncio.sleep(0.05)
+
+        asyncio.run(asyncio.wait_for(main(), timeout = 10))
+
+    def test_order_within_each_chat(self):
+        rnd = random.Random(3)
+
+        def handle(u):
+            time.sleep(rnd.uniform(0, 0.01))
+            with self.lock:
+                self.handled.append((u.message.chat_id, u.update_id))
+
+        self.bot.handle_update_retrying = handle
+        updates = [update(i, -1 if i % 3 else -2) for i in range(1, 31)]
+        self.run_dispatch(updates)
+
+        for chat_id in (-1, -2):
+            ids = [i for c, i in self.handled if c == chat_id]
+            self.assertEqual(ids, [u.update_id for u in updates if u.message.chat_id == chat_id])
+        self.assertEqual(self.bot.inflight_updates, set())
+
+    def test_chats_run_concurrently(self):
+        # The first update of chat -1 only finishes once chat -2 was handled.
+        other_done = threading.Event()
+
+        def handle(u):
+            if u.message.chat_id == -1:
+                self.assertTrue(other_done.wait(5))
+            else:
+                other_done.set()
+            with self.lock:
+                self.handled.append(u.update_id)
+
+        self.bot.handle_update_retrying = handle
+        self.run_dispatch([update(1, -1), update(2, -1), update(3, -2)])
+        self.assertEqual(self.handled, [3, 1, 2])
+
+    def test_handler_error_does_not_stop_the_chat(self):
+        def handle(u):
+            if u.update_id == 1:
+                raise RuntimeError('boom')
+            self.handled.append(u.update_id)
+
+        self.bot.handle_update_retrying = handle
+        self.run_dispatch([update(1, -1), update(2, -1)])
+        self.assertEqual(self.handled, [2])
+        self.assertEqual(self.bot.inflight_updates, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from afxbot import KeywordAutomaton
+
+
+def naive_find_all(keywords, text):
+    return {kw for kw in keywords if kw and kw in text}
+
+
+class KeywordAutomatonTest(unittest.TestCase):
+
+    def test_overlapping_keywords(self):
+        automaton = KeywordAutomaton(['he', 'she', 'his', 'hers'])
+        self.assertEqual(automaton.find_all('ushers'), {'he', 'she', 'hers'})
+        self.assertEqual(automaton.find_all('this'), {'his'})
+        self.assertEqual(automaton.find_all('nothing'), set())
+
+    def test_cjk(self):
+        automaton = KeywordAutomaton(['香蕉', '蕉姐', '測試'])
+        self.assertEqual(automaton.find_all('香蕉姐要測試'), {'香蕉', '蕉姐', '測試'})
+
+    def test_add_and_remove(self):
+        automaton = KeywordAutomaton(['abc'])
+        automaton.add('bc')
+        automaton.add('')
+        self.assertEqual(automaton.find_all('xabcx'), {'abc', 'bc'})
+
+        automaton.remove('abc')
+        automaton.remove('missing')
+        self.assertEqual(automaton.find_all('xabcx'), {'bc'})
+        self.assertEqual(automaton.words, {'bc'})
+
+        automaton.add('abc')
+        self.assertEqual(automaton.find_all('abc'), {'abc', 'bc'})
+
+    def test_matches_naive_search(self):
+        rnd = random.Random(42)
+        keywords = {''.join(rnd.choice('ab') for _ in range(rnd.randint(1, 4))) for _ in range(12)}
+        automaton = KeywordAutomaton(keywords)
+        for _ in range(200):
+            text = ''.join(rnd.choice('abc') for _ in range(rnd.randint(0, 12)))
+            self.assertEqual(automaton.find_all(text), naive_find_all(keywords, text), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
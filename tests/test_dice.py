@@ -0,0 +1,47 @@
+import unittest
+
+from afxbot import DiceRoller
+
+
+class DiceRollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dice = DiceRoller()
+
+    def test_parse_terms(self):
+        text, terms = DiceRoller.parse('4d6kh3 + 2')
+        self.assertEqual(text, '4d6kh3+2')
+        self.assertEqual(terms, ((1, 4, 6, ('h', 3), False, None), (1, 2)))
+
+    def test_parse_modifiers(self):
+        _, terms = DiceRoller.parse('6d10!s8-1d%kl1')
+        self.assertEqual(terms, ((1, 6, 10, None, True, 8), (-1, 1, 100, ('l', 1), False, None)))
+
+    def test_parse_rejects_trailing_text(self):
+        for expr in ('1d6++2', '2d6 hello', '1d6+', 'd6x'):
+            with self.assertRaises(ValueError, msg = expr):
+                DiceRoller.parse(expr)
+
+    def test_parse_rejects_empty(self):
+        with self.assertRaises(ValueError):
+            DiceRoller.parse('')
+
+    def test_roll_total_in_range(self):
+        for _ in range(50):
+            total = int(self.dice.roll('2d6+3').rsplit('=', 1)[1])
+            self.assertTrue(5 <= total <= 15)
+
+    def test_roll_success_count(self):
+        self.assertEqual(self.dice.roll('3d1s1'), '3d1s1 : (1, 1, 1) >= 1, 成功 3 次')
+
+    def test_roll_guards(self):
+        with self.assertRaises(ValueError):
+            DiceRoller(max_dice = 10).roll('11d6')
+        with self.assertRaises(ValueError):
+            self.dice.roll('1d1!')
+        with self.assertRaises(ValueError):
+            DiceRoller(max_terms = 2).roll('1+2+3')
+
+
+if __name__ == '__main__':
+    unittest.main()
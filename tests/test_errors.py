@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+
+import telegram
+
+from afxbot import AFXBot, Backoff, CircuitOpen, ReadWriteLock, classify_error
+
+
+class ClassifyErrorTest(unittest.TestCase):
+
+    def test_kinds(self):
+        self.assertEqual(classify_error(telegram.error.RetryAfter(3)), 'retry_after')
+        self.assertEqual(classify_error(telegram.error.TimedOut()), 'transient')
+        self.assertEqual(classify_error(telegram.error.NetworkError('reset')), 'transient')
+        self.assertEqual(classify_error(ConnectionResetError()), 'transient')
+        self.assertEqual(classify_error(CircuitOpen(1.0)), 'transient')
+        self.assertEqual(classify_error(telegram.error.BadRequest('chat not found')), 'fatal')
+        self.assertEqual(classify_error(KeyError('x')), 'fatal')
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_jittered_bounds(self):
+        for attempt in range(8):
+            d = min(10.0, 0.5 * 2 ** attempt)
+            for _ in range(20):
+                delay = Backoff.jittered(attempt, 0.5, 10.0)
+                self.assertTrue(d / 2 <= delay <= d)
+
+    def test_next_and_reset(self):
+        backoff = Backoff(1.0, 4.0)
+        delays = [backoff.next() for _ in range(5)]
+        self.assertEqual(backoff.attempts, 5)
+        self.assertTrue(all(delay <= 4.0 for delay in delays))
+        self.assertTrue(delays[-1] >= 2.0)
+
+        backoff.reset()
+        self.assertEqual(backoff.attempts, 0)
+        self.assertTrue(backoff.next() <= 1.0)
+
+
+class HandleUpdateRetryingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.config = {'update_max_attempts': 3, 'retry_base': 0.001, 'retry_cap': 0.001}
+        self.bot.logger = mock.Mock()
+        self.bot.reload_lock = ReadWriteLock()
+        self.update = mock.Mock(update_id = 1)
+
+    def test_transient_is_retried(self):
+        self.bot.handle_update = mock.Mock(side_effect = [telegram.error.NetworkError('reset'), None])
+        self.bot.handle_update_retrying(self.update)
+        self.assertEqual(self.bot.handle_update.call_count, 2)
+
+    def test_gives_up_after_max_attempts(self):
+        self.bot.handle_update = mock.Mock(side_effect = telegram.error.TimedOut())
+        self.bot.handle_update_retrying(self.update)
+        self.assertEqual(self.bot.handle_update.call_count, 3)
+
+    def test_fatal_is_dropped(self):
+        self.bot.handle_update = mock.Mock(side_effect = ValueError('bug'))
+        self.bot.handle_update_retrying(self.update)
+        self.assertEqual(self.bot.handle_update.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import threading
+import types
+import unittest
+from unittest import mock
+
+from afxbot import AFXBot, ResponseStore
+
+ADMIN = 1
+MEMBER = 2
+
+
+def update(text, chat_id, user_id = MEMBER):
+    return types.SimpleNamespace(message = types.SimpleNamespace(
+        text = text, chat_id = chat_id, message_id = 7, from_user = types.SimpleNamespace(id = user_id)))
+
+
+class GetIdTest(unittest.TestCase):
+
+    def setUp(self):
+        bot = AFXBot.__new__(AFXBot)
+        bot.acl = AFXBot.build_acl({'adm_ids': [ADMIN], 'operational_chats': [-100, -200],
+                                    'restricted_chats': [], 'motd_only_chats': [], 'invasive_washsnake_chats': []})
+        bot.resp_lock = threading.RLock()
+        bot.resp_store = ResponseStore()
+        bot.resp_store.add_get(1, 'cat', 'FILE_HERE', None, -100)
+        bot.resp_store.add_get(2, 'cat', 'FILE_OTHER', None, -200)
+        bot.resp_store.add_get(3, 'cat', 'FILE_GLOBAL', None, -1)
+        bot.send_photo = mock.Mock()
+        bot.send_generic_mesg = mock.Mock()
+        self.bot = bot
+
+    def getid(self, text, chat_id, user_id = MEMBER):
+        self.bot.send_photo.reset_mock()
+        self.bot.send_generic_mesg.reset_mock()
+        self.assertTrue(self.bot.cmd_getid(update(text, chat_id, user_id), text.split()))
+        if self.bot.send_photo.called:
+            return self.bot.send_photo.call_args[0][1]
+        self.assertIn('You get nothing!', self.bot.send_generic_mesg.call_args[0][1])
+        return None
+
+    def test_own_and_global(self):
+        self.assertEqual(self.getid('/getid 1', -100), 'FILE_HERE')
+        self.assertEqual(self.getid('/getid_3', -100), 'FILE_GLOBAL')
+        self.assertEqual(self.getid('/getid_3@afx_bot', 5), 'FILE_GLOBAL')
+
+    def test_other_chat_refused(self):
+        self.assertIsNone(self.getid('/getid 2', -100))
+        self.assertIsNone(self.getid('/getid_1', -200))
+        # Private chats only see the global partition.
+        self.assertIsNone(self.getid('/getid 1', MEMBER))
+
+    def test_admin_gets_any(self):
+        self.assertEqual(self.getid('/getid 2', -100, ADMIN), 'FILE_OTHER')
+        self.assertEqual(self.getid('/getid 1', ADMIN, ADMIN), 'FILE_HERE')
+
+    def test_unknown(self):
+        self.assertIsNone(self.getid('/getid 99', -100, ADMIN))
+        self.assertIsNone(self.getid('/getid x', -100, ADMIN))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import io
+import json
+import logging
+import queue
+import random
+import sys
+import unittest
+from unittest import mock
+
+from afxbot import AFXBot, JsonLogFormatter, LogQueueHandler
+
+
+class JsonLogFormatterTest(unittest.TestCase):
+
+    def record(self, exc_info = None):
+        return logging.LogRecord('afxbot', logging.WARNING, __file__, 1, 'hello %s', ('world',), exc_info)
+
+    def test_shape(self):
+        record = self.record()
+        record.category = 'update'
+        entry = json.loads(JsonLogFormatter().format(record))
+        self.assertEqual(entry, {'ts': record.created,
+                                 'level': 'WARNING',
+                                 'logger': 'afxbot',
+                                 'thread': record.threadName,
+                                 'msg': 'hello world',
+                                 'category': 'update'})
+
+    def test_exception_and_one_line(self):
+        try:
+            raise ValueError('oops\nsecond line')
+        except ValueError:
+            record = self.record(exc_info = sys.exc_info())
+        line = JsonLogFormatter().format(record)
+        self.assertNotIn('\n', line)
+        entry = json.loads(line)
+        self.assertNotIn('category', entry)
+        self.assertIn('ValueError: oops', entry['exc'])
+
+
+class LogSamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.logger = logging.getLogger('afxbot.test_logging')
+        self.bot.logger.setLevel(logging.DEBUG)
+        self.bot.log_sampling = {'update': 0.25, 'never': 0}
+
+    def test_rate(self):
+        rng = random.Random(1)
+        with mock.patch('afxbot.random.random', rng.random):
+            kept = sum(self.bot.log_enabled('update', logging.INFO) for _ in range(10000))
+        self.assertTrue(2300 < kept < 2700, kept)
+
+    def test_unsampled_and_zero(self):
+        self.assertTrue(all(self.bot.log_enabled('other') for _ in range(100)))
+        self.assertFalse(any(self.bot.log_enabled('never') for _ in range(100)))
+
+    def test_level_checked_first(self):
+        self.bot.logger.setLevel(logging.WARNING)
+        with mock.patch('afxbot.random.random') as rand:
+            self.assertFalse(self.bot.log_enabled('update', logging.INFO))
+        rand.assert_not_called()
+
+
+class AsyncJsonLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.saved = (self.root.level, list(self.root.handlers))
+        self.out = io.StringIO()
+        self.root.handlers = [logging.StreamHandler(self.out)]
+
+    def tearDown(self):
+        self.root.setLevel(self.saved[0])
+        self.root.handlers = self.saved[1]
+
+    def test_records_go_through_the_listener_as_json(self):
+        bot = AFXBot.__new__(AFXBot)
+        bot.logger = logging.getLogger('afxbot.test_logging.async')
+        bot.config = {'log_level': 'info', 'log_json': True, 'log_async': True, 'log_sampling': {'update': 0.5}}
+
+        with mock.patch('afxbot.atexit.register') as register:
+            bot.init_logging()
+        stop = register.call_args[0][0]
+
+        self.assertEqual(len(self.root.handlers), 1)
+        self.assertIsInstance(self.root.handlers[0], LogQueueHandler)
+        self.assertEqual(bot.log_sampling, {'update': 0.5})
+
+        bot.logger.debug('dropped')
+        bot.logger.info('Update: %s', 42, extra = {'category': 'update'})
+        stop()
+
+        lines = self.out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        entry = json.loads(lines[0])
+        self.assertEqual((entry['level'], entry['msg'], entry['category']), ('INFO', 'Update: 42', 'update'))
+
+    def test_queue_handler_leaves_formatting_to_listener(self):
+        log_queue = queue.SimpleQueue()
+        logger = logging.getLogger('afxbot.test_logging.queue')
+        logger.propagate = False
+        logger.addHandler(LogQueueHandler(log_queue))
+        try:
+            logger.warning('hello %s', 'world')
+        finally:
+            logger.handlers = []
+            logger.propagate = True
+
+        record = log_queue.get_nowait()
+        self.assertEqual((record.msg, record.args), ('hello %s', ('world',)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import http.client
+import sqlite3
+import unittest
+from unittest import mock
+
+from afxbot import Metrics, MetricsServer, MeteredConnection
+
+
+def samples(text):
+    """Returns: dict of sample line name{labels} -> value, comments skipped."""
+    out = dict()
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            key, value = line.rsplit(' ', 1)
+            out[key] = value
+    return out
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def timed_calls(self, durations):
+        # perf_counter is read at start and end of every call.
+        ticks = []
+        for d in durations:
+            ticks += [100.0, 100.0 + d]
+        return mock.patch('afxbot.time.perf_counter', side_effect = ticks)
+
+    def test_histogram_buckets(self):
+        with self.timed_calls([0.0003, 0.003, 0.3, 20]):
+            for _ in range(4):
+                with self.metrics.timer('api', 'sendMessage'):
+                    pass
+
+        s = samples(self.metrics.render())
+        labels = 'kind="api",name="sendMessage"'
+        self.assertEqual(s['afx_calls_total{' + labels + '}'], '4')
+        self.assertEqual(s['afx_errors_total{' + labels + '}'], '0')
+        self.assertEqual(s['afx_latency_seconds_bucket{' + labels + ',le="0.0005"}'], '1')
+        self.assertEqual(s['afx_latency_seconds_bucket{' + labels + ',le="0.0025"}'], '1')
+        self.assertEqual(s['afx_latency_seconds_bucket{' + labels + ',le="0.005"}'], '2')
+        self.assertEqual(s['afx_latency_seconds_bucket{' + labels + ',le="0.5"}'], '3')
+        self.assertEqual(s['afx_latency_seconds_bucket{' + labels + ',le="10"}'], '3')
+        self.assertEqual(s['afx_latency_seconds_bucket{' + labels + ',le="+Inf"}'], '4')
+        self.assertEqual(s['afx_latency_seconds_count{' + labels + '}'], '4')
+        self.assertAlmostEqual(float(s['afx_latency_seconds_sum{' + labels + '}']), 20.3033)
+
+    def test_errors_and_timed(self):
+        def fail():
+            raise ValueError()
+
+        wrapped = self.metrics.timed('handler', 'fail', fail)
+        with self.timed_calls([0.01, 0.01]):
+            for _ in range(2):
+                with self.assertRaises(ValueError):
+                    wrapped()
+
+        s = samples(self.metrics.render())
+        self.assertEqual(s['afx_calls_total{kind="handler",name="fail"}'], '2')
+        self.assertEqual(s['afx_errors_total{kind="handler",name="fail"}'], '2')
+
+    def test_gauges(self):
+        self.metrics.gauge('afx_queue', 'Queued sends.', lambda: 3)
+        self.metrics.gauge('afx_unknown', 'Not known yet.', lambda: None)
+        self.metrics.gauge('afx_broken', 'Raises.', lambda: 1 / 0)
+
+        text = self.metrics.render()
+        self.assertIn('# TYPE afx_queue gauge\nafx_queue 3\n', text)
+        self.assertIn('afx_unknown NaN\n', text)
+        self.assertNotIn('afx_broken', text)
+
+    def test_metered_connection(self):
+        db = sqlite3.connect(':memory:', factory = MeteredConnection)
+        db.metrics = self.metrics
+        c = db.cursor()
+        c.execute('CREATE TABLE t (x)')
+        c.execute('insert into t VALUES (?)', (1, ))
+        c.execute('SELECT x FROM t').fetchall()
+        db.close()
+
+        self.assertEqual(sorted(name for kind, name in self.metrics.series), ['CREATE', 'INSERT', 'SELECT'])
+
+    def test_server(self):
+        self.metrics.gauge('afx_queue', 'Queued sends.', lambda: 3)
+        server = MetricsServer(self.metrics, port = 0)
+        server.start()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.httpd.server_address[1], timeout = 5)
+            conn.request('GET', '/metrics')
+            res = conn.getresponse()
+            body = res.read().decode('utf-8')
+            conn.close()
+        finally:
+            server.stop()
+
+        self.assertEqual(res.status, 200)
+        self.assertTrue(res.getheader('Content-Type').startswith('text/plain; version=0.0.4'))
+        self.assertIn('afx_queue 3', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
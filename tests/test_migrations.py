@@ -0,0 +1,119 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from afxbot import AFXBot
+
+EXAMPLE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resp_db.example.sqlite')
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'resp_db.sqlite')
+        shutil.copy(EXAMPLE_DB, self.file_name)
+        self.bot = self.open_bot()
+
+    def tearDown(self):
+        self.bot.resp_db.close()
+        shutil.rmtree(self.dir)
+
+    def open_bot(self):
+        bot = AFXBot.__new__(AFXBot)
+        bot.config = dict()
+        bot.logger = mock.Mock()
+        bot.resp_db = sqlite3.connect(self.file_name)
+        bot.resp_db.row_factory = sqlite3.Row
+        return bot
+
+    def user_version(self):
+        return self.bot.resp_db.execute('PRAGMA user_version').fetchone()[0]
+
+    def names(self, kind):
+        return {row[0] for row in self.bot.resp_db.execute('SELECT name FROM sqlite_master WHERE type = ?', (kind, ))}
+
+    def test_migrates_to_latest(self):
+        self.bot.migrate_resp_db()
+        self.assertEqual(self.user_version(), len(AFXBot.RESP_DB_MIGRATIONS))
+        self.assertTrue({'photo_cache', 'bot_state'} <= self.names('table'))
+        self.assertIn('resp_keyword', self.names('index'))
+        columns = [row['name'] for row in self.bot.resp_db.execute('PRAGMA table_info(resp)')]
+        self.assertIn('weight', columns)
+
+    def test_second_run_is_noop(self):
+        self.bot.migrate_resp_db()
+        self.bot.logger.reset_mock()
+        self.bot.migrate_resp_db()
+        self.bot.logger.info.assert_not_called()
+        self.assertEqual(self.user_version(), len(AFXBot.RESP_DB_MIGRATIONS))
+
+    def test_open_transaction_is_committed_first(self):
+        self.bot.resp_db.execute("INSERT INTO resp (keyword, cont) VALUES ('mig', 'kept')")
+        self.assertTrue(self.bot.resp_db.in_transaction)
+        self.bot.migrate_resp_db()
+        row = self.bot.resp_db.execute("SELECT cont FROM resp WHERE keyword = 'mig'").fetchone()
+        self.assertEqual(row['cont'], 'kept')
+
+    def test_migrated_by_another_process(self):
+        other = self.open_bot()
+        other.migrate_resp_db()
+        other.resp_db.close()
+
+        self.bot.migrate_resp_db()
+        self.bot.logger.info.assert_not_called()
+
+    def test_failed_migration_rolls_back(self):
+        migrations = AFXBot.RESP_DB_MIGRATIONS + [['CREATE TABLE broken_a (x)', 'NOT SQL']]
+        with mock.patch.object(AFXBot, 'RESP_DB_MIGRATIONS', migrations):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.bot.migrate_resp_db()
+        self.assertEqual(self.user_version(), len(migrations) - 1)
+        self.assertNotIn('broken_a', self.names('table'))
+
+    def test_search_index(self):
+        self.bot.migrate_resp_db()
+        self.bot.init_search_index()
+        if self.bot.search_tokenizer is None:
+            self.skipTest('SQLite without FTS5')
+
+        self.bot.resp_db.execute("INSERT INTO resp (keyword, cont) VALUES ('searchkw', 'needle in haystack')")
+        self.bot.resp_db.commit()
+        resp_hits, get_hits = self.bot.search_resp(['needle'])
+        self.assertEqual(len(resp_hits), 1)
+
+    def test_old_search_triggers_are_replaced(self):
+        # As built before the search index was a migration: updates of any column reindex.
+        c = self.bot.resp_db.cursor()
+        try:
+            c.execute("CREATE VIRTUAL TABLE resp_fts USING fts5(keyword, cont, content='resp', content_rowid='IIDX')")
+        except sqlite3.OperationalError:
+            self.skipTest('SQLite without FTS5')
+        c.execute("CREATE TRIGGER resp_fts_update AFTER UPDATE ON resp BEGIN SELECT 1; END")
+        self.bot.resp_db.commit()
+
+        self.bot.migrate_resp_db()
+        sql = c.execute("SELECT sql FROM sqlite_master WHERE name = 'resp_fts_update'").fetchone()[0]
+        self.assertIn('UPDATE OF keyword, cont', sql)
+
+    def test_missing_fts5_is_logged_by_bot(self):
+        def execute(sql, *args):
+            if sql.startswith('CREATE VIRTUAL TABLE'):
+                raise sqlite3.OperationalError('no such module: fts5')
+            return real.execute(sql, *args)
+
+        real = self.bot.resp_db.cursor()
+        c = mock.Mock(execute = execute)
+
+        with mock.patch('afxbot.logging.warning') as root_warning:
+            AFXBot.RESP_DB_MIGRATIONS[4](c, self.bot.logger)
+        root_warning.assert_not_called()
+        self.assertIn('FTS5 unavailable', self.bot.logger.warning.call_args[0][0])
+        self.assertIsNone(real.execute("SELECT 1 FROM sqlite_master WHERE name = 'resp_fts'").fetchone())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import types
+import unittest
+from datetime import date
+from unittest import mock
+
+from afxbot import AFXBot, MotdStore
+
+
+def update(text, chat_id = -1):
+    return types.SimpleNamespace(message = types.SimpleNamespace(text = text, chat_id = chat_id, message_id = 7))
+
+
+class MotdStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'motd.sqlite')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.db.close()
+        shutil.rmtree(self.dir)
+
+    def store(self, delay = 60):
+        store = MotdStore(mock.Mock(), self.file_name, delay)
+        self.stores.append(store)
+        return store
+
+    def rows(self):
+        db = sqlite3.connect(self.file_name)
+        try:
+            return db.execute('SELECT chat_id, date, msg FROM motd ORDER BY IIDX').fetchall()
+        finally:
+            db.close()
+
+    def test_burst_is_written_once(self):
+        store = self.store(delay = 0.3)
+        for i in range(3):
+            store.set(-1, 'motd {0}'.format(i), date(2020, 1, 2))
+        self.assertEqual(store.current['-1']['msg'], 'motd 2')
+        self.assertEqual(self.rows(), [])
+
+        deadline = time.monotonic() + 5
+        while store.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.1)
+
+        self.assertEqual(len(self.rows()), 3)
+        store.logger.info.assert_called_once_with('wrote 3 MOTD updates')
+
+    def test_load_takes_latest_row_of_each_chat(self):
+        store = self.store()
+        store.set(-1, 'old', date(2020, 1, 2))
+        store.set(-2, 'other', date(2020, 1, 1))
+        store.set(-1, 'new', date(2020, 1, 1))
+        store.flush()
+
+        loaded = self.store()
+        loaded.load()
+        self.assertEqual(loaded.current, {'-1': {'msg': 'new', 'date': date(2020, 1, 1)},
+                                          '-2': {'msg': 'other', 'date': date(2020, 1, 1)}})
+
+    def test_history_sees_pending_and_written(self):
+        store = self.store()
+        store.set(-1, 'first', date(2020, 1, 1))
+        store.set(-1, 'second', date(2020, 1, 1))
+        store.flush()
+        store.set(-1, 'pending', date(2020, 1, 2))
+
+        self.assertEqual(store.history(-1, date(2020, 1, 1)), 'second')
+        self.assertEqual(store.history(-1, date(2020, 1, 2)), 'pending')
+        self.assertIsNone(store.history(-1, date(2020, 1, 3)))
+        self.assertIsNone(store.history(-2, date(2020, 1, 1)))
+
+    def test_failed_write_is_kept(self):
+        store = self.store()
+        store.set(-1, 'kept', date(2020, 1, 1))
+        store.db.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            store.flush()
+        self.assertEqual(store.pending, [(-1, '2020-01-01', 'kept')])
+
+        store.db = sqlite3.connect(self.file_name, check_same_thread = False)
+        store.flush()
+        self.assertEqual(self.rows(), [(-1, '2020-01-01', 'kept')])
+
+
+class HandleMotdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = MotdStore(mock.Mock(), os.path.join(self.dir, 'motd.sqlite'), 60)
+
+        bot = AFXBot.__new__(AFXBot)
+        bot.logger = mock.Mock()
+        bot.motd_store = self.store
+        bot.motds = self.store.current
+        bot.strs = {'r_motd_no': 'none',
+                    'r_motd_ok': '{date}: {motd}',
+                    'r_motd_old': 'old {date}: {motd}',
+                    'r_motd_updated': 'updated {date}',
+                    'q_motd_kws': []}
+        self.sent = []
+        bot.send_generic_mesg = lambda chat_id, text, mesg_id = None: self.sent.append(text)
+        self.bot = bot
+
+    def tearDown(self):
+        self.store.db.close()
+        shutil.rmtree(self.dir)
+
+    def test_history(self):
+        self.store.set(-1, 'hello', date(2020, 1, 1))
+        self.store.flush()
+
+        self.bot.handle_motd(update('/motd history 2020-01-01'))
+        self.bot.handle_motd(update('/motd history 2020-01-02'))
+        self.bot.handle_motd(update('/motd history yesterday'))
+        self.assertEqual(self.sent, ['2020-01-01: hello', 'none', 'none'])
+
+    def test_update_then_query(self):
+        self.bot.handle_motd(update('/motd  today '))
+        self.bot.handle_motd(update('/motd'))
+        today = date.today().isoformat()
+        self.assertEqual(self.sent, ['updated ' + today, today + ': today'])
+        self.assertEqual(self.store.history(-1, date.today()), 'today')
+
+    def test_private_chat_is_refused(self):
+        self.bot.handle_motd(update('/motd history 2020-01-01', chat_id = 1))
+        self.assertEqual(self.sent, ['MotD Function is for groups only.'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import types
+import unittest
+from unittest import mock
+
+from afxbot import AFXBot
+
+
+def update(update_id):
+    return types.SimpleNamespace(update_id = update_id, message = None)
+
+
+class OffsetCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        # Only the state get_mesg touches; no config, db or Telegram.
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.config = dict()
+        self.bot.logger = mock.Mock()
+        self.bot.LAST_UPDATE_ID = 10
+        self.bot.saved_offset = 10
+        self.bot.newest_update_id = None
+        self.bot.pending_updates = 0
+        self.saved = []
+        self.bot.set_state = lambda key, value: self.saved.append((key, value))
+
+    def test_checkpoint_once_per_batch(self):
+        self.bot.fetch_updates = lambda: [update(10), update(11), update(12)]
+        handled = []
+
+        def handle(u):
+            # Nothing is saved until the whole batch is handled.
+            self.assertEqual(self.saved, [])
+            handled.append(u.update_id)
+
+        self.bot.handle_update_retrying = handle
+        self.bot.get_mesg()
+
+        self.assertEqual(handled, [10, 11, 12])
+        self.assertEqual(self.saved, [('last_update_id', 13)])
+        self.assertEqual(self.bot.LAST_UPDATE_ID, 13)
+
+    def test_empty_batch_saves_nothing(self):
+        self.bot.fetch_updates = lambda: []
+        self.bot.get_mesg()
+        self.assertEqual(self.saved, [])
+
+    def test_crash_keeps_unhandled_offset(self):
+        self.bot.fetch_updates = lambda: [update(10), update(11), update(12)]
+
+        def handle(u):
+            if u.update_id == 11:
+                raise KeyboardInterrupt()
+
+        self.bot.handle_update_retrying = handle
+        with self.assertRaises(KeyboardInterrupt):
+            self.bot.get_mesg()
+
+        # Update 10 is checkpointed on the way out; 11 is polled again.
+        self.assertEqual(self.saved, [('last_update_id', 11)])
+        self.assertEqual(self.bot.saved_offset, 11)
+
+    def test_is_new_update(self):
+        self.assertFalse(self.bot.is_new_update(update(9)))
+        self.assertTrue(self.bot.is_new_update(update(10)))
+
+        self.bot.LAST_UPDATE_ID = None
+        self.assertTrue(self.bot.is_new_update(update(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+from afxbot import AFXBot, ResponseStore
+
+
+class KeysetPagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ResponseStore()
+        for iidx in (5, 1, 9, 3, 7):
+            self.store.add_resp(iidx, 'kw', 'cont{0}'.format(iidx), 1)
+        self.store.add_get(2, 'kw', 'pic2', None, -1, 1)
+        self.store.add_get(4, 'kw', 'pic4', None, -100, 1)
+
+    def test_page(self):
+        self.assertEqual(ResponseStore.page([5, 1, 9, 3, 7]), [1, 3, 5, 7, 9])
+        self.assertEqual(ResponseStore.page([5, 1, 9, 3, 7], 3, 2), [5, 7])
+        self.assertEqual(ResponseStore.page([5, 1, 9, 3, 7], 9, 2), [])
+        self.assertEqual(ResponseStore.page(['b', 'a', 'c'], 'a'), ['b', 'c'])
+
+    def test_list_resp_pages(self):
+        seen = []
+        after = 0
+        while True:
+            rows = self.store.list_resp('kw', after, 2)
+            if not rows:
+                break
+            seen += [row['IIDX'] for row in rows]
+            after = rows[-1]['IIDX']
+        self.assertEqual(seen, [1, 3, 5, 7, 9])
+
+    def test_insert_does_not_shift_next_page(self):
+        first = self.store.list_resp('kw', 0, 2)
+        self.store.add_resp(2, 'kw', 'cont2', 1)
+        second = self.store.list_resp('kw', first[-1]['IIDX'], 2)
+        self.assertEqual([row['IIDX'] for row in second], [5, 7])
+
+    def test_list_get_by_partition(self):
+        self.assertEqual([row['IIDX'] for row in self.store.list_get('kw')], [2])
+        self.assertEqual([row['IIDX'] for row in self.store.list_get('kw', -100)], [4])
+
+
+class ListingCursorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.config = {'ls_cursor_ttl': 60, 'ls_cursor_max': 2}
+        self.bot.state_lock = threading.Lock()
+        self.bot.ls_cursors = OrderedDict()
+
+    def cursor(self):
+        return {'header': '', 'fetch': None, 'pages': [None], 'last': None}
+
+    @mock.patch('afxbot.time.monotonic')
+    def test_expired_cursor_is_gone(self, monotonic):
+        monotonic.return_value = 100.0
+        self.bot.put_ls_cursor(1, self.cursor())
+        monotonic.return_value = 159.0
+        self.assertIsNotNone(self.bot.get_ls_cursor(1))
+        monotonic.return_value = 160.0
+        self.assertIsNone(self.bot.get_ls_cursor(1))
+        self.assertNotIn(1, self.bot.ls_cursors)
+
+    @mock.patch('afxbot.time.monotonic')
+    def test_cap_drops_least_recently_used(self, monotonic):
+        monotonic.return_value = 100.0
+        self.bot.put_ls_cursor(1, self.cursor())
+        self.bot.put_ls_cursor(2, self.cursor())
+        self.bot.put_ls_cursor(1, self.bot.get_ls_cursor(1))
+        self.bot.put_ls_cursor(3, self.cursor())
+        self.assertEqual(list(self.bot.ls_cursors), [1, 3])
+
+    @mock.patch('afxbot.time.monotonic')
+    def test_put_sweeps_expired(self, monotonic):
+        monotonic.return_value = 100.0
+        self.bot.put_ls_cursor(1, self.cursor())
+        monotonic.return_value = 200.0
+        self.bot.put_ls_cursor(2, self.cursor())
+        self.assertEqual(list(self.bot.ls_cursors), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import afxbench
+from afxbot import UpdateRecorder
+
+
+def data(update_id, chat_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': 1577836800 + update_id,
+                        'chat': {'id': chat_id, 'type': 'group'},
+                        'from': {'id': 1, 'first_name': 'u', 'is_bot': False},
+                        'text': '訊息 {0}'.format(update_id)}}
+
+
+class RecorderReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sent = [data(i, -100 - i % 3) for i in range(1, 31)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def capture(self, **kwargs):
+        recorder = UpdateRecorder(self.dir, **kwargs)
+        for i, d in enumerate(self.sent):
+            recorder.record(d, received = 1000.0 + i)
+        recorder.close()
+        return sorted(glob.glob(os.path.join(self.dir, '*.afxrec')))
+
+    def replay(self, files, batch_size = 7):
+        afx = mock.Mock()
+        fake = afxbench.FakeBot()
+        fed = []
+        afx.get_mesg.side_effect = lambda: fed.append([u.update_id for u in fake.updates])
+
+        self.assertEqual(afxbench.replay(afx, fake, files, 0, batch_size), len(self.sent))
+        return fed
+
+    def check(self, files):
+        records = [r for f in files for r in UpdateRecorder.read(f)]
+        self.assertEqual([d for received, d in records], self.sent)
+        self.assertEqual([received for received, d in records], [1000.0 + i for i in range(len(self.sent))])
+
+        fed = self.replay(files)
+        self.assertEqual([u for batch in fed for u in batch], list(range(1, 31)))
+        self.assertTrue(all(0 < len(batch) <= 7 for batch in fed))
+        self.assertEqual(afxbench.capture_chats(files), [-102, -101, -100])
+
+    def test_plain(self):
+        files = self.capture(compress = False)
+        self.assertEqual(len(files), 1)
+        self.check(files)
+
+    def test_compressed(self):
+        files = self.capture(compress = True)
+        self.assertEqual(len(files), 1)
+        with open(files[0], 'rb') as f:
+            self.assertEqual(f.read(len(UpdateRecorder.MAGIC) + 1), UpdateRecorder.MAGIC + bytes([UpdateRecorder.FLAG_ZLIB]))
+        self.check(files)
+
+    def test_rotated(self):
+        for compress in [False, True]:
+            with self.subTest(compress = compress):
+                files = self.capture(compress = compress, max_bytes = 600)
+                self.assertGreater(len(files), 2)
+                self.check(files)
+                for f in files:
+                    os.remove(f)
+
+    def test_truncated_last_record(self):
+        files = self.capture(compress = True)
+        with open(files[0], 'r+b') as f:
+            f.truncate(os.path.getsize(files[0]) - 3)
+
+        records = list(UpdateRecorder.read(files[0]))
+        self.assertEqual([d for received, d in records], self.sent[:-1])
+
+    def test_not_a_capture(self):
+        name = os.path.join(self.dir, 'other.afxrec')
+        with open(name, 'wb') as f:
+            f.write(b'{"update_id": 1}')
+        with self.assertRaises(ValueError):
+            list(UpdateRecorder.read(name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import types
+import unittest
+
+from afxbot import AFXBot, CommandRouter
+
+
+def update(text, chat_id = -1):
+    return types.SimpleNamespace(message = types.SimpleNamespace(text = text, chat_id = chat_id))
+
+
+class FakeCallback:
+
+    def __init__(self, name, log, q_kw = None, cond = None):
+        self.name = name
+        self.log = log
+        self.strs = {'q_kw': q_kw} if q_kw is not None else {}
+        self.cond = cond
+
+    def execute(self, update):
+        if 'q_kw' in self.strs:
+            if not update.message.text.startswith(self.strs['q_kw']):
+                return False
+        elif not self.cond(update):
+            return False
+        return self.run(update)
+
+    def run(self, update):
+        self.log.append(self.name)
+        return True
+
+
+class CommandRouterTest(unittest.TestCase):
+
+    def route(self, callbacks, text):
+        log = []
+        router = CommandRouter([cls(name, log, *args) for cls, name, *args in callbacks])
+        handled = router.execute(update(text))
+        return handled, log
+
+    def test_first_registered_prefix_wins(self):
+        callbacks = [(FakeCallback, 'adm', '/adm'), (FakeCallback, 'slash', '/'), (FakeCallback, 'adm_ls', '/adm ls')]
+        self.assertEqual(self.route(callbacks, '/adm ls x'), (True, ['adm']))
+        self.assertEqual(self.route(callbacks, '/roll'), (True, ['slash']))
+
+    def test_no_match(self):
+        callbacks = [(FakeCallback, 'adm', '/adm')]
+        self.assertEqual(self.route(callbacks, '/ad'), (False, []))
+        self.assertEqual(self.route(callbacks, 'hello /adm'), (False, []))
+        self.assertEqual(self.route(callbacks, ''), (False, []))
+
+    def test_conditional_callbacks_keep_registration_order(self):
+        fortune = lambda u: '運勢' in u.message.text
+        before = [(FakeCallback, 'cond', None, fortune), (FakeCallback, 'slash', '/')]
+        after = [(FakeCallback, 'slash', '/'), (FakeCallback, 'cond', None, fortune)]
+
+        self.assertEqual(self.route(before, '/x 運勢'), (True, ['cond']))
+        self.assertEqual(self.route(after, '/x 運勢'), (True, ['slash']))
+        self.assertEqual(self.route(after, '今日運勢'), (True, ['cond']))
+
+    def test_declining_conditional_falls_through(self):
+        callbacks = [(FakeCallback, 'cond', None, lambda u: False), (FakeCallback, 'slash', '/')]
+        self.assertEqual(self.route(callbacks, '/x'), (True, ['slash']))
+
+
+class HandleCmdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.acl = {-1: AFXBot.ROLE_OPERATIONAL, -2: AFXBot.ROLE_RESTRICTED}
+        self.bot.cmd_table = dict()
+        self.calls = []
+        for name, auth in (('/get', AFXBot.AUTH_OPERATIONAL), ('/getid', AFXBot.AUTH_OPERATIONAL), ('/roll', 0)):
+            self.bot.register_command(name, self.handler(name), auth)
+
+    def handler(self, name):
+        def handle(update, cmd_toks):
+            self.calls.append((name, cmd_toks))
+            return True
+        return handle
+
+    def test_routes_exact_commands(self):
+        self.assertTrue(self.bot.handle_cmd(update('/get cat')))
+        self.assertTrue(self.bot.handle_cmd(update('/ROLL 2d6')))
+        self.assertEqual(self.calls, [('/get', ['/get', 'cat']), ('/roll', ['/ROLL', '2d6'])])
+
+    def test_bot_name_suffix(self):
+        self.assertTrue(self.bot.handle_cmd(update('/roll@AFX_bot')))
+        self.assertFalse(self.bot.handle_cmd(update('/roll@other_bot')))
+        self.assertEqual([name for name, toks in self.calls], ['/roll'])
+
+    def test_getid_shortcut(self):
+        self.assertTrue(self.bot.handle_cmd(update('/getid_12@afx_bot')))
+        self.assertEqual(self.calls, [('/getid', ['/getid_12@afx_bot'])])
+
+    def test_prefix_and_unknown_commands(self):
+        for text in ['/get_x', '/ge', '/gets cat', '/nope', 'get cat', '', '   ']:
+            self.assertFalse(self.bot.handle_cmd(update(text)), text)
+        self.assertEqual(self.calls, [])
+
+    def test_chat_roles(self):
+        self.assertFalse(self.bot.handle_cmd(update('/get cat', chat_id = -2)))
+        self.assertFalse(self.bot.handle_cmd(update('/get cat', chat_id = -3)))
+        self.assertTrue(self.bot.handle_cmd(update('/roll', chat_id = -3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import threading
+import unittest
+
+from afxbot import ReadWriteLock
+
+
+class ReadWriteLockTest(unittest.TestCase):
+
+    def test_writer_waits_for_reader(self):
+        lock = ReadWriteLock()
+        written = threading.Event()
+
+        def write():
+            with lock.write():
+                written.set()
+
+        with lock.read():
+            t = threading.Thread(target = write)
+            t.start()
+            self.assertFalse(written.wait(0.1))
+        t.join(1)
+        self.assertTrue(written.is_set())
+
+    def test_released_lets_writer_in(self):
+        lock = ReadWriteLock()
+        written = threading.Event()
+
+        def write():
+            with lock.write():
+                written.set()
+
+        with lock.read():
+            t = threading.Thread(target = write)
+            t.start()
+            with lock.released():
+                self.assertTrue(written.wait(1))
+            t.join(1)
+            self.assertEqual(lock.readers, 1)
+        self.assertEqual(lock.readers, 0)
+
+    def test_released_without_read_is_noop(self):
+        lock = ReadWriteLock()
+        with lock.released():
+            self.assertEqual(lock.readers, 0)
+        with lock.write():
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import unittest
+from unittest import mock
+
+import telegram
+
+from afxbot import SendDropped, SendScheduler, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    @mock.patch('afxbot.time.monotonic', return_value = 100.0)
+    def test_refill(self, monotonic):
+        bucket = TokenBucket(2, 4)
+        self.assertEqual(bucket.delay(100.0), 0)
+        for _ in range(4):
+            bucket.take()
+        self.assertAlmostEqual(bucket.delay(100.0), 0.5)
+        self.assertAlmostEqual(bucket.delay(100.25), 0.25)
+        self.assertEqual(bucket.delay(100.5), 0)
+        # Refill stops at capacity.
+        self.assertEqual(bucket.delay(200.0), 0)
+        self.assertEqual(bucket.tokens, 4)
+
+
+def send(**kwargs):
+    return kwargs['text']
+
+
+class SendSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('afxbot.time.monotonic', return_value = 100.0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # No scheduler thread: the tests pick and run jobs themselves.
+        with mock.patch('afxbot.threading.Thread'):
+            self.sched = SendScheduler(mock.Mock(), global_rate = 1000, group_per_min = 60000,
+                                       private_rate = 1000, max_queue = 2, auto_max_age = 30)
+        self.addCleanup(self.sched.executor.shutdown)
+
+    def now(self, t):
+        self.monotonic.return_value = t
+        return t
+
+    def submit(self, chat_id, text, priority = SendScheduler.PRIO_NORMAL, **kwargs):
+        return self.sched.submit(chat_id, send, {'text': text}, priority, **kwargs)
+
+    def run_next(self, now = 100.0):
+        with self.sched.cond:
+            picked, wait = self.sched.next_job(self.now(now))
+        if picked:
+            self.sched.run_job(*picked)
+        return picked, wait
+
+    def test_priority_lanes(self):
+        auto = self.submit(-1, 'auto', SendScheduler.PRIO_AUTO)
+        normal = self.submit(-2, 'normal')
+        adm = self.submit(-3, 'adm', SendScheduler.PRIO_ADM)
+
+        order = []
+        for _ in range(3):
+            (chat_id, job), _ = self.run_next()
+            order.append(job[2].result())
+        self.assertEqual(order, ['adm', 'normal', 'auto'])
+        self.assertTrue(auto.done() and normal.done() and adm.done())
+
+    def test_chat_in_flight_waits(self):
+        self.submit(-1, 'a')
+        self.submit(-1, 'b')
+        with self.sched.cond:
+            picked, _ = self.sched.next_job(100.0)
+            self.assertEqual(picked[1][1]['text'], 'a')
+            # Chat -1 is busy until run_job finishes.
+            self.assertEqual(self.sched.next_job(100.0), (None, None))
+        self.sched.run_job(*picked)
+        (chat_id, job), _ = self.run_next()
+        self.assertEqual(job[2].result(), 'b')
+
+    def test_round_robin_within_lane(self):
+        for text in ['a1', 'a2']:
+            self.submit(-1, text, droppable = False)
+        self.submit(-2, 'b1')
+
+        order = [self.run_next()[0][1][2].result() for _ in range(3)]
+        self.assertEqual(order, ['a1', 'b1', 'a2'])
+
+    def test_chat_bucket_paces(self):
+        with mock.patch('afxbot.threading.Thread'):
+            sched = SendScheduler(mock.Mock(), global_rate = 1000, private_rate = 1)
+        self.addCleanup(sched.executor.shutdown)
+        sched.submit(1, send, {'text': 'a'})
+        sched.submit(1, send, {'text': 'b'})
+
+        with sched.cond:
+            picked, _ = sched.next_job(100.0)
+        sched.run_job(*picked)
+        with sched.cond:
+            self.assertEqual(sched.next_job(100.0), (None, 1.0))
+            picked, _ = sched.next_job(101.0)
+        self.assertEqual(picked[1][1]['text'], 'b')
+
+    def test_retry_after_requeues_at_head(self):
+        calls = []
+
+        def flood(**kwargs):
+            calls.append(kwargs['text'])
+            if len(calls) == 1:
+                raise telegram.error.RetryAfter(5)
+            return kwargs['text']
+
+        fut = self.sched.submit(-1, flood, {'text': 'a'})
+        self.submit(-1, 'b')
+        self.run_next()
+        self.assertFalse(fut.done())
+
+        self.assertEqual(self.run_next(102.0), (None, 3.0))
+        (chat_id, job), _ = self.run_next(105.0)
+        self.assertEqual(fut.result(), 'a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_transient_error_is_retried_then_fails(self):
+        def down(**kwargs):
+            raise telegram.error.NetworkError('reset')
+
+        fut = self.sched.submit(-1, down, {})
+        t = 100.0
+        for _ in range(self.sched.max_attempts):
+            with self.sched.cond:
+                picked, wait = self.sched.next_job(self.now(t))
+            if not picked:
+                t += wait
+                with self.sched.cond:
+                    picked, wait = self.sched.next_job(self.now(t))
+            self.sched.run_job(*picked)
+        with self.assertRaises(telegram.error.NetworkError):
+            fut.result(0)
+
+    def test_full_lane_drops_oldest_auto(self):
+        first = self.submit(-1, 'a1', SendScheduler.PRIO_AUTO)
+        second = self.submit(-1, 'a2', SendScheduler.PRIO_AUTO)
+        third = self.submit(-1, 'a3', SendScheduler.PRIO_AUTO)
+
+        with self.assertRaises(SendDropped):
+            first.result(0)
+        self.assertEqual(self.sched.dropped, 1)
+        self.assertEqual([job[1]['text'] for job in self.sched.lanes[SendScheduler.PRIO_AUTO][-1]], ['a2', 'a3'])
+        self.assertFalse(second.done() or third.done())
+
+    def test_full_lane_refuses_non_droppable(self):
+        self.submit(-1, 'n1')
+        self.submit(-1, 'n2')
+        refused = self.submit(-1, 'n3')
+        with self.assertRaises(SendDropped):
+            refused.result(0)
+        self.assertEqual(self.sched.pending(), 2)
+
+    def test_stale_auto_is_dropped(self):
+        stale = self.submit(-1, 'late', SendScheduler.PRIO_AUTO)
+        kept = self.submit(-2, 'normal')
+
+        (chat_id, job), _ = self.run_next(131.0)
+        self.assertEqual(job[2].result(), 'normal')
+        # Expired at the head of its lane, dropped instead of sent.
+        self.assertEqual(self.run_next(131.0), (None, None))
+        with self.assertRaises(SendDropped):
+            stale.result(0)
+        self.assertTrue(kept.done())
+        self.assertEqual(self.sched.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import telegram
+
+from afxbot import AFXBot
+
+EXAMPLE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resp_db.example.sqlite')
+
+
+def update(update_id, chat_id):
+    chat = telegram.Chat(chat_id, 'group')
+    return telegram.Update(update_id, message = telegram.Message(update_id, datetime(2020, 1, 1), chat, text = 'hi'))
+
+
+class SyncSharedStateTest(unittest.TestCase):
+    """Two shards on two connections to one resp_db."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'resp_db.sqlite')
+        shutil.copy(EXAMPLE_DB, self.file_name)
+        self.a = self.shard()
+        self.b = self.shard()
+
+    def tearDown(self):
+        self.a.resp_db.close()
+        self.b.resp_db.close()
+        shutil.rmtree(self.dir)
+
+    def shard(self):
+        bot = AFXBot.__new__(AFXBot)
+        bot.config = dict()
+        bot.logger = mock.Mock()
+        bot.resp_lock = threading.RLock()
+        bot.state_lock = threading.Lock()
+        bot.is_running = True
+        bot.is_accepting_photos = False
+        bot.resp_db = sqlite3.connect(self.file_name, check_same_thread = False)
+        bot.resp_db.row_factory = sqlite3.Row
+        bot.migrate_resp_db()
+        bot.resp_data_version = bot.resp_db.execute('PRAGMA data_version').fetchone()[0]
+        bot.resp_version = bot.get_state('resp_version')
+        # Only count reloads.
+        bot.init_kw_lists = mock.Mock()
+        bot.resp_store = mock.Mock()
+        return bot
+
+    def add_resp(self, bot, kw):
+        with bot.resp_write():
+            bot.resp_db.execute('INSERT INTO resp (keyword, cont) VALUES (?, ?)', (kw, kw))
+            bot.resp_db.commit()
+
+    def reloads(self, bot):
+        return bot.resp_store.load.call_count
+
+    def test_nothing_changed(self):
+        self.a.sync_shared_state()
+        self.assertEqual(self.reloads(self.a), 0)
+
+    def test_other_shard_write_reloads_once(self):
+        self.add_resp(self.b, 'new')
+        self.b.sync_shared_state()
+        self.assertEqual(self.reloads(self.b), 0)
+
+        self.a.sync_shared_state()
+        self.a.sync_shared_state()
+        self.assertEqual(self.reloads(self.a), 1)
+        self.assertEqual(self.a.resp_version, self.b.resp_version)
+
+    def test_own_write_does_not_reload(self):
+        self.add_resp(self.a, 'mine')
+        self.add_resp(self.a, 'mine too')
+        # Any commit of the other shard moves data_version.
+        self.b.set_state('is_running', 0)
+
+        self.a.sync_shared_state()
+        self.assertEqual(self.reloads(self.a), 0)
+        self.assertFalse(self.a.is_running)
+
+    def test_own_write_after_unseen_write_reloads(self):
+        self.add_resp(self.b, 'theirs')
+        self.add_resp(self.a, 'mine')
+
+        self.a.sync_shared_state()
+        self.assertEqual(self.reloads(self.a), 1)
+
+    def test_own_write_after_unrelated_commit_does_not_reload(self):
+        self.b.set_state('is_accepting_photos', 1)
+        self.add_resp(self.a, 'mine')
+
+        self.a.sync_shared_state()
+        self.assertEqual(self.reloads(self.a), 0)
+        self.assertTrue(self.a.is_accepting_photos)
+
+    def test_failed_write_keeps_version(self):
+        version = self.a.resp_version
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.a.resp_write():
+                self.a.resp_db.execute('INSERT INTO no_such_table VALUES (1)')
+        self.assertEqual(self.a.resp_version, version)
+
+
+class ShardRoutingTest(unittest.TestCase):
+
+    def test_chat_sticks_to_one_shard(self):
+        updates = [update(i, chat_id) for i, chat_id in enumerate([-100, -101, 5, -100, 5, -102, -101, -100], 1)]
+        shards = dict()
+        for u in updates:
+            shards.setdefault(u.message.chat_id, set()).add(AFXBot.shard_of(u, 3))
+
+        self.assertTrue(all(len(s) == 1 for s in shards.values()))
+        self.assertTrue(all(0 <= s.pop() < 3 for s in shards.values()))
+        self.assertEqual(AFXBot.shard_of(telegram.Update(9), 3), 0)
+
+    def test_shard_handles_in_order(self):
+        bot = AFXBot.__new__(AFXBot)
+        bot.bot = None
+        bot.sync_shared_state = mock.Mock()
+        handled = []
+        bot.handle_update_retrying = lambda u: handled.append((u.message.chat_id, u.update_id))
+
+        updates, acks = queue.Queue(), queue.Queue()
+        for i, chat_id in enumerate([-100, -200, -100, -100, -200], 1):
+            updates.put(update(i, chat_id).to_dict())
+        updates.put(None)
+        bot.run_shard(updates, acks)
+
+        self.assertEqual(handled, [(-100, 1), (-200, 2), (-100, 3), (-100, 4), (-200, 5)])
+        self.assertEqual([acks.get_nowait() for _ in range(5)], [1, 2, 3, 4, 5])
+        self.assertEqual(bot.sync_shared_state.call_count, 5)
+        self.assertEqual(bot.LAST_UPDATE_ID, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from afxbot import AFXBot, ResponseStore
+
+EXAMPLE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resp_db.example.sqlite')
+
+
+class StoreTestCase(unittest.TestCase):
+    """A migrated copy of resp_db.example.sqlite with some more rows."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        file_name = os.path.join(self.dir, 'resp_db.sqlite')
+        shutil.copy(EXAMPLE_DB, file_name)
+
+        bot = AFXBot.__new__(AFXBot)
+        bot.config = dict()
+        bot.logger = mock.Mock()
+        bot.resp_db = sqlite3.connect(file_name)
+        bot.resp_db.row_factory = sqlite3.Row
+        bot.migrate_resp_db()
+        self.db = bot.resp_db
+
+        rnd = random.Random(7)
+        c = self.db.cursor()
+        for i in range(40):
+            c.execute('INSERT INTO resp (keyword, cont, weight) VALUES (?, ?, ?)',
+                      ('kw{0}'.format(i % 5), 'cont{0}'.format(i), rnd.choice([1, 1, 2, 0.5])))
+            c.execute('INSERT INTO resp_get (keyword, cont, tag, gid, weight) VALUES (?, ?, ?, ?, ?)',
+                      ('pic{0}'.format(i % 4), 'file{0}'.format(i), rnd.choice([None, 'a', 'b']),
+                       rnd.choice([-1, -100, -200]), rnd.choice([1, 3])))
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def rows(self, sql):
+        return {row['IIDX']: dict(row) for row in self.db.execute(sql)}
+
+
+class LoadTest(StoreTestCase):
+
+    def test_rows(self):
+        store = ResponseStore()
+        store.load(self.db)
+        self.assertEqual(store.resp_rows, self.rows('SELECT IIDX, keyword, cont, weight FROM resp'))
+        self.assertEqual(store.get_rows, self.rows('SELECT IIDX, keyword, cont, tag, gid, weight FROM resp_get'))
+
+    def test_load_replaces_previous_content(self):
+        store = ResponseStore()
+        store.add_resp(99999, 'stale', 'x')
+        store.load(self.db)
+        self.assertFalse(store.has_resp('stale'))
+        self.assertNotIn(99999, store.resp_rows)
+
+    def test_picks_come_from_the_database(self):
+        store = ResponseStore()
+        store.load(self.db)
+
+        resp = self.rows('SELECT IIDX, keyword, cont, weight FROM resp WHERE weight > 0')
+        for kw in {row['keyword'] for row in resp.values()}:
+            for _ in range(20):
+                row = store.pick_resp(kw)
+                self.assertEqual(row, resp[row['IIDX']])
+                self.assertEqual(row['keyword'], kw)
+
+        gets = self.rows('SELECT IIDX, keyword, cont, tag, gid, weight FROM resp_get')
+        for (gid, kw) in {(row['gid'], row['keyword']) for row in gets.values()}:
+            for _ in range(20):
+                row = store.pick_get(kw, gid = gid)
+                self.assertEqual(row, gets[row['IIDX']])
+                self.assertEqual(row['keyword'], kw)
+                self.assertIn(row['gid'], (gid, -1))
+
+        self.assertIsNone(store.pick_resp('no such keyword'))
+        self.assertIsNone(store.pick_get('no such keyword'))
+
+
+
+class IncrementalTest(StoreTestCase):
+
+    def assert_same_index(self, store, fresh):
+        self.assertEqual(store.resp_rows, fresh.resp_rows)
+        self.assertEqual(store.get_rows, fresh.get_rows)
+        self.assertEqual(store.get_kw_count, fresh.get_kw_count)
+
+        for idx, pos, fresh_idx in ((store.resp_idx, store.resp_pos, fresh.resp_idx),
+                                    (store.get_idx, store.get_pos, fresh.get_idx),
+                                    (store.get_tag_idx, store.get_tag_pos, fresh.get_tag_idx)):
+            # Same members per key; order inside an array is free.
+            self.assertEqual({k: sorted(v) for k, v in idx.items()}, {k: sorted(v) for k, v in fresh_idx.items()})
+            for arr in idx.values():
+                for i, iidx in enumerate(arr):
+                    self.assertEqual(pos[iidx], i)
+            self.assertEqual(len(pos), sum(len(arr) for arr in idx.values()))
+
+    def test_matches_fresh_load(self):
+        rnd = random.Random(11)
+        store = ResponseStore()
+        store.load(self.db)
+        c = self.db.cursor()
+
+        for step in range(400):
+            op = rnd.randrange(6)
+            if op == 0:
+                kw = 'kw{0}'.format(rnd.randrange(7))
+                c.execute('INSERT INTO resp (keyword, cont) VALUES (?, ?)', (kw, 'new{0}'.format(step)))
+                store.add_resp(c.lastrowid, kw, 'new{0}'.format(step), 1)
+            elif op == 1 and store.resp_rows:
+                iidx = rnd.choice(list(store.resp_rows))
+                c.execute('DELETE FROM resp WHERE IIDX = ?', (iidx, ))
+                store.remove_resp(iidx)
+            elif op == 2:
+                kw, tag, gid = 'pic{0}'.format(rnd.randrange(6)), rnd.choice([None, 'a', 'c']), rnd.choice([-1, -100, -300])
+                c.execute('INSERT INTO resp_get (keyword, cont, tag, gid) VALUES (?, ?, ?, ?)', (kw, 'f', tag, gid))
+                store.add_get(c.lastrowid, kw, 'f', tag, gid, 1)
+            elif op == 3 and store.get_rows:
+                iidx = rnd.choice(list(store.get_rows))
+                c.execute('DELETE FROM resp_get WHERE IIDX = ?', (iidx, ))
+                store.remove_get(iidx)
+            elif op == 4 and store.get_rows:
+                iidx, gid = rnd.choice(list(store.get_rows)), rnd.choice([-1, -100, -300])
+                c.execute('UPDATE resp_get SET gid = ? WHERE IIDX = ?', (gid, iidx))
+                store.move_get(iidx, gid)
+            elif op == 5 and store.resp_rows:
+                iidx, weight = rnd.choice(list(store.resp_rows)), rnd.choice([0, 1, 2.5])
+                c.execute('UPDATE resp SET weight = ? WHERE IIDX = ?', (weight, iidx))
+                store.set_resp_weight(iidx, weight)
+        self.db.commit()
+
+        fresh = ResponseStore()
+        fresh.load(self.db)
+        self.assert_same_index(store, fresh)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import types
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from afxbot import AFXBot, TokenBucket
+
+EXAMPLE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resp_db.example.sqlite')
+
+
+def filename(photo):
+    return os.path.basename(getattr(photo, 'filename', None) or photo.name)
+
+
+class FakeBot:
+
+    def __init__(self):
+        self.calls = []
+        self.n = 0
+
+    def sent(self, handle):
+        self.n += 1
+        return types.SimpleNamespace(photo = [types.SimpleNamespace(file_id = 'FID-' + filename(handle))])
+
+    def sendPhoto(self, chat_id, photo):
+        self.calls.append(('sendPhoto', [filename(photo)]))
+        return self.sent(photo)
+
+    def sendMediaGroup(self, chat_id, media):
+        self.calls.append(('sendMediaGroup', [filename(m.media) for m in media]))
+        return [self.sent(m.media) for m in media]
+
+
+class FakeSender:
+    """Runs every call at once, keeping what was submitted."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, chat_id, func, kwargs, priority, droppable = None, cost = 1):
+        self.submitted.append(cost)
+        fut = Future()
+        fut.set_result(func(**kwargs))
+        return fut
+
+
+class BulkUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        bot = AFXBot.__new__(AFXBot)
+        bot.config = dict()
+        bot.logger = mock.Mock()
+        file_name = os.path.join(self.dir, 'resp_db.sqlite')
+        shutil.copy(EXAMPLE_DB, file_name)
+        bot.resp_db = sqlite3.connect(file_name, check_same_thread = False)
+        bot.resp_db.row_factory = sqlite3.Row
+        bot.migrate_resp_db()
+        bot.resp_lock = threading.RLock()
+        bot.bot = FakeBot()
+        bot.sender = FakeSender()
+        self.replies = []
+        bot.send_generic_mesg = lambda chat_id, text, mesg_id = None: self.replies.append(text)
+        self.bot = bot
+
+    def tearDown(self):
+        self.bot.resp_db.close()
+        shutil.rmtree(self.dir)
+
+    def photo(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_same_bytes_are_uploaded_once(self):
+        files = [self.photo('a.jpg', b'AAA'), self.photo('b.jpg', b'AAA'), self.photo('c.jpg', b'CCC')]
+        self.bot.bulk_upload_photos(-1, 1, files)
+
+        self.assertEqual(self.bot.bot.calls, [('sendMediaGroup', ['a.jpg', 'c.jpg'])])
+        self.assertEqual(self.bot.sender.submitted, [2])
+        self.assertIn('b.jpg: FID-a.jpg', self.replies[-1])
+
+        # Renamed copies of known content never reach the Bot.
+        renamed = [self.photo('d.jpg', b'AAA'), self.photo('e.jpg', b'CCC')]
+        self.bot.bulk_upload_photos(-1, 2, renamed)
+        self.assertEqual(len(self.bot.bot.calls), 1)
+        self.assertIn('0 uploaded, 2 cached', self.replies[-1])
+        self.assertIn('e.jpg: FID-c.jpg', self.replies[-1])
+
+    def test_single_photo_uses_send_photo(self):
+        self.bot.bulk_upload_photos(-1, 1, [self.photo('a.jpg', b'AAA')])
+        self.assertEqual(self.bot.bot.calls, [('sendPhoto', ['a.jpg'])])
+
+    def test_batches_of_ten_cost_their_size(self):
+        files = [self.photo('{0:02d}.jpg'.format(i), bytes([i])) for i in range(12)]
+        self.bot.bulk_upload_photos(-1, 1, files)
+        self.assertEqual(self.bot.sender.submitted, [10, 2])
+        self.assertEqual(self.bot.bot.n, 12)
+
+
+class TokenBucketCostTest(unittest.TestCase):
+
+    @mock.patch('afxbot.time.monotonic', return_value = 100.0)
+    def test_cost_above_capacity_leaves_debt(self, monotonic):
+        bucket = TokenBucket(1, 2)
+        self.assertEqual(bucket.delay(100.0, 10), 0)
+        bucket.take(10)
+        self.assertAlmostEqual(bucket.delay(100.0), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
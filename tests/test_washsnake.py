@@ -0,0 +1,45 @@
+import unittest
+
+from afxbot import WashSnake, WashSnakeTable
+
+
+class WashSnakeTableTest(unittest.TestCase):
+    # The table is clocked by message dates, so times are passed in.
+
+    def test_ttl_expiry_on_lookup(self):
+        table = WashSnakeTable(ttl = 60)
+        table.put((1, 2), WashSnake(100.0, 'x'), 100.0)
+        self.assertIsNotNone(table.get((1, 2), 159.0))
+        self.assertIsNone(table.get((1, 2), 160.0))
+        self.assertEqual(len(table), 0)
+
+    def test_put_sweeps_expired(self):
+        table = WashSnakeTable(ttl = 60)
+        table.put((1, 1), WashSnake(100.0, 'a'), 100.0)
+        table.put((1, 2), WashSnake(150.0, 'b'), 150.0)
+        table.put((1, 3), WashSnake(170.0, 'c'), 170.0)
+        self.assertEqual(list(table.entries), [(1, 2), (1, 3)])
+
+    def test_lru_eviction_at_max_entries(self):
+        table = WashSnakeTable(ttl = 60, max_entries = 2)
+        table.put((1, 1), WashSnake(100.0, 'a'), 100.0)
+        table.put((1, 2), WashSnake(100.0, 'b'), 100.0)
+        # A lookup makes (1, 1) the most recently used.
+        table.get((1, 1), 101.0)
+        table.put((1, 3), WashSnake(101.0, 'c'), 101.0)
+        self.assertEqual(list(table.entries), [(1, 1), (1, 3)])
+
+    def test_hit_counts_a_run(self):
+        table = WashSnakeTable(ttl = 60)
+        self.assertIsNone(table.hit((1, 2), 'x', 100.0))
+        self.assertEqual(table.hit((1, 2), 'x', 101.0), (1, False))
+        self.assertEqual(table.hit((1, 2), 'x', 102.0), (2, True))
+        self.assertEqual(table.hit((1, 2), 'x', 103.0), (3, False))
+        # Other content starts a new run.
+        self.assertIsNone(table.hit((1, 2), 'y', 103.0))
+        # So does the same content after the ttl.
+        self.assertIsNone(table.hit((1, 2), 'y', 163.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import http.client
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from afxbot import AFXBot, ReadWriteLock
+
+UPDATE = {'update_id': 7,
+          'message': {'message_id': 1, 'date': 1700000000, 'text': 'hi',
+                      'chat': {'id': -1, 'type': 'group'},
+                      'from': {'id': 2, 'first_name': 'x', 'is_bot': False}}}
+
+
+class WebhookServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = AFXBot.__new__(AFXBot)
+        self.bot.config = {'webhook_port': 0, 'webhook_secret': 'sesame', 'webhook_max_pending': 1}
+        self.bot.logger = mock.Mock()
+        self.bot.bot = None
+        self.bot.recorder = None
+        self.bot.webhook_server = None
+        self.bot.reload_lock = ReadWriteLock()
+
+        self.handled = []
+        self.release = threading.Event()
+        self.release.set()
+
+        def handle(update):
+            self.handled.append(update)
+            self.release.wait(5)
+
+        self.bot.handle_update = handle
+
+        # run_webhook serves forever; the thread dies with the test process.
+        threading.Thread(target = self.bot.run_webhook, daemon = True).start()
+        for _ in range(100):
+            if self.bot.webhook_server:
+                break
+            time.sleep(0.01)
+        self.port = self.bot.webhook_server.httpd.server_address[1]
+
+    def tearDown(self):
+        self.release.set()
+        self.bot.webhook_server.stop()
+
+    def post(self, body, secret = 'sesame', path = '/webhook'):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout = 5)
+        headers = {'Content-Type': 'application/json'}
+        if secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+        conn.request('POST', path, body, headers)
+        res = conn.getresponse()
+        res.read()
+        conn.close()
+        return res
+
+    def wait_handled(self, n):
+        for _ in range(200):
+            if len(self.handled) >= n:
+                return
+            time.sleep(0.01)
+        self.fail('update not handled')
+
+    def test_update_reaches_handle_update(self):
+        self.assertEqual(self.post(json.dumps(UPDATE)).status, 200)
+        self.wait_handled(1)
+        self.assertEqual(self.handled[0].update_id, 7)
+        self.assertEqual(self.handled[0].message.text, 'hi')
+
+    def test_malformed_body(self):
+        self.assertEqual(self.post('{not json').status, 400)
+        # The slot of a refused body is given back.
+        self.assertEqual(self.post(json.dumps(UPDATE)).status, 200)
+
+    def test_max_pending(self):
+        self.release.clear()
+        self.assertEqual(self.post(json.dumps(UPDATE)).status, 200)
+        self.wait_handled(1)
+
+        res = self.post(json.dumps(dict(UPDATE, update_id = 8)))
+        self.assertEqual(res.status, 503)
+        self.assertEqual(res.getheader('Retry-After'), '1')
+
+        self.release.set()
+        for _ in range(200):
+            res = self.post(json.dumps(dict(UPDATE, update_id = 9)))
+            if res.status == 200:
+                break
+            time.sleep(0.01)
+        self.assertEqual(res.status, 200)
+
+    def test_secret_token(self):
+        self.assertEqual(self.post(json.dumps(UPDATE), secret = None).status, 403)
+        self.assertEqual(self.post(json.dumps(UPDATE), secret = 'wrong').status, 403)
+        self.assertEqual(self.handled, [])
+
+    def test_unknown_path(self):
+        self.assertEqual(self.post(json.dumps(UPDATE), path = '/other').status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()